@@ -1,12 +1,21 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import List
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional, Tuple
 import os
-import uuid
-import imghdr
+import time
+import secrets
+import contextvars
 
 from app import create_reimbursement_agent
+from payload_buffer import PayloadBuffer
+from resilience import deadline
+from singleflight import content_key
+from near_dup import NEAR_DUP, PHASH_ENABLED, dhash, confirm_by_qr
+from einvoice_xml import is_einvoice_xml
+import metrics
+import profiler
 
 # 启动时全局只创建一次 agent
 agent = create_reimbursement_agent()
@@ -23,35 +32,181 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # 用路由模板做标签，避免路径参数撑爆基数
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - t0, route=route, status=status)
+
 @app.get("/api/ping")
 def ping():
     return {"pong": True}
 
-async def save_tmp(up: UploadFile):
-    data = await up.read()
-    suffix = os.path.splitext(up.filename or "")[-1].lower()
-    p = os.path.join("/tmp", f"upload_{uuid.uuid4().hex}{suffix or '.bin'}")
-    with open(p, "wb") as w:
-        w.write(data)
-
-    # 判定文件类型（魔数优先）
-    head = data[:1024]
-    if b"%PDF" in head:
-        ftype = "pdf"
-    elif imghdr.what(None, h=data) in {"jpeg","png","bmp","gif","tiff","webp"}:
-        ftype = "image"
-    else:
-        # 用文件名/Content-Type兜底
-        if suffix == ".pdf" or "pdf" in (up.content_type or "").lower():
-            ftype = "pdf"
-        else:
-            ftype = "image"
-
-    return p, ftype
+@app.get("/metrics")
+def prometheus_metrics():
+    # 进程内指标；多 worker 部署时每个进程各自暴露
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+UPLOAD_CHUNK = 256 * 1024
+MAX_FILE_BYTES = int(os.getenv("MAX_UPLOAD_FILE_BYTES", str(20 * 1024 * 1024)))       # 单文件上限
+MAX_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", str(60 * 1024 * 1024)))  # 单请求合计上限
+REQUEST_BUDGET_S = float(os.getenv("REQUEST_BUDGET_S", "15"))                          # 单请求总时间预算（SLA p99 < 15s）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")                                             # 为空则 /admin/* 一律 404
+MULTIPART_SLACK = 64 * 1024                                                            # multipart 边界/表单字段的余量
+
+class BodySizeLimit:
+    """
+    ASGI 层的请求体上限，在 multipart 解析（和落盘）之前生效：
+    - Content-Length 超限：不读 body 直接 413
+    - 没有长度头（chunked）或长度头不实：边收边计数，超限当场回 413，对下游表现为客户端断开（其后的响应丢弃）
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    def _too_large(self, size: int) -> dict:
+        return {"filename": "", "error": f"请求体过大（{size} 字节，上限 {self.max_bytes - MULTIPART_SLACK}）"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        try:
+            length = int(dict(scope["headers"]).get(b"content-length") or 0)
+        except ValueError:
+            length = 0
+        if length > self.max_bytes:
+            return await JSONResponse({"detail": self._too_large(length)}, status_code=413)(scope, receive, send)
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    await JSONResponse({"detail": self._too_large(received)}, status_code=413)(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+app.add_middleware(BodySizeLimit, max_bytes=MAX_REQUEST_BYTES + MULTIPART_SLACK)
+
+def sniff_type(head: bytes, filename: str = "") -> Optional[str]:
+    """只看首块魔数：pdf / ofd / xml / image；不支持的返回 None。"""
+    if b"%PDF" in head[:1024]:
+        return "pdf"
+    if is_einvoice_xml(head):                                         # 数电票官方 XML（根节点 EInvoice）
+        return "xml"
+    if head.startswith(b"PK\x03\x04"):
+        # OFD 是 ZIP 包，首个条目一般就是 OFD.xml；否则看后缀
+        if b"OFD.xml" in head[:1024] or (filename or "").lower().endswith(".ofd"):
+            return "ofd"
+        return None
+    if head.startswith(b"\xff\xd8\xff"):                             # JPEG
+        return "image"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):                      # PNG
+        return "image"
+    if head.startswith(b"BM"):                                        # BMP
+        return "image"
+    if head.startswith((b"II*\x00", b"MM\x00*")):                    # TIFF
+        return "image"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":                 # WEBP
+        return "image"
+    return None
+
+def request_budget(request: Request) -> float:
+    """上游网关可用 X-Request-Budget-Ms 传入剩余预算，只会比本地配置更紧"""
+    try:
+        ms = float(request.headers.get("x-request-budget-ms") or 0)
+    except ValueError:
+        ms = 0
+    return min(REQUEST_BUDGET_S, ms / 1000) if ms > 0 else REQUEST_BUDGET_S
+
+def wants_profile(request: Request) -> bool:
+    """X-Profile: 1 或 ?profile=1 请求采样（是否真的采由 profiler 限流决定）"""
+    flag = request.headers.get("x-profile") or request.query_params.get("profile") or ""
+    return flag.lower() in ("1", "true", "yes")
+
+def require_admin(request: Request):
+    token = request.headers.get("x-admin-token") or ""
+    if not ADMIN_TOKEN or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=404)
+
+def _reject(status: int, filename: str, msg: str):
+    raise HTTPException(status_code=status, detail={"filename": filename, "error": msg})
+
+async def read_upload(up: UploadFile, budget: int = MAX_REQUEST_BYTES):
+    """
+    分块读进 PayloadBuffer（大文件自动落盘），边读边计数：
+    - 首块做魔数判定，不支持直接 415
+    - 超过单文件 / 本请求剩余额度直接 413
+    都发生在任何 OCR 调用之前。
+    """
+    name = up.filename or ""
+    limit = min(MAX_FILE_BYTES, budget)
+    if up.size is not None and up.size > limit:
+        _reject(413, name, f"文件过大（{up.size} 字节，上限 {limit}）")
+
+    buf = PayloadBuffer(name)
+    try:
+        ftype = None
+        while True:
+            chunk = await up.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            if ftype is None:
+                ftype = sniff_type(chunk, name)
+                if ftype is None:
+                    _reject(415, name, "不支持的文件类型（仅支持 PDF/OFD/数电XML/JPEG/PNG/BMP/TIFF/WEBP）")
+            if buf.size + len(chunk) > limit:
+                _reject(413, name, f"文件过大（上限 {limit} 字节）")
+            buf.write(chunk)
+        if ftype is None:
+            _reject(415, name, "空文件")
+    except BaseException:
+        buf.close()
+        raise
+    return buf, ftype
+
+async def check_upload(up: UploadFile, budget: int = MAX_REQUEST_BYTES) -> Tuple[int, str]:
+    """佐证文件先做首块类型 + 大小校验（不整读），返回 (字节数, 类型)。"""
+    name = up.filename or ""
+    size = up.size
+    if size is None:
+        up.file.seek(0, os.SEEK_END)
+        size = up.file.tell()
+        up.file.seek(0)
+    if size > min(MAX_FILE_BYTES, budget):
+        _reject(413, name, f"文件过大（{size} 字节，上限 {min(MAX_FILE_BYTES, budget)}）")
+    head = await up.read(UPLOAD_CHUNK)
+    await up.seek(0)
+    ftype = sniff_type(head, name)
+    if ftype is None:
+        _reject(415, name, "不支持的文件类型（仅支持 PDF/OFD/数电XML/JPEG/PNG/BMP/TIFF/WEBP）")
+    return size, ftype
 
 @app.post("/api/invoices")
-async def upload_invoices(files: List[UploadFile] = File(...), note: str = Form("")):
+async def upload_invoices(request: Request, files: List[UploadFile] = File(...), note: str = Form("")):
     assert files, "至少上传一个文件"
+    # 整个请求体的上限由 BodySizeLimit 在解析表单之前把关
+
     # 选择主票据
     main = next(
         (f for f in files if any(k in (f.filename or "").lower() for k in ["发票","invoice","fp","fapiao"])),
@@ -59,14 +214,69 @@ async def upload_invoices(files: List[UploadFile] = File(...), note: str = Form(
     )
     evidences = [f for f in files if f is not main]
 
-    # 保存到临时路径
-    main_path, ftype = await save_tmp(main)
+    # 先校验佐证（类型/大小），再读主票据；任何一个不合格都在 OCR 之前拒掉
+    budget = MAX_REQUEST_BYTES
+    evidence_files = []
+    with metrics.span("upload_read"):
+        for e in evidences:
+            size, etype = await check_upload(e, budget)
+            budget -= size
+            # 类型/大小合格再整读：佐证交给后台并行抽取（行程单/订单的日期、金额、行程段）
+            evidence_files.append((await e.read(), e.filename or "", etype))
+
+        # 读入内存缓冲（超过阈值才落盘；请求结束一定清理）
+        main_buf, ftype = await read_upload(main, budget)
     evidence_data = [{"type":"佐证材料","filename":e.filename} for e in evidences]
 
-    result = agent.process_reimbursement(
-        file_path=main_path,
-        user_input=note,
-        evidence_data=evidence_data,   # 关键：把其余文件作为 evidence 传入
-        file_type=ftype,   # <- 这里把类型传进去
-    )
-    return JSONResponse(result)
\ No newline at end of file
+    def run_pipeline():
+        # 照片先算感知哈希；近似命中后再用二维码里的代码+号码确认（同版式的不同发票也会命中），
+        # 确认是同一张票才复用上次的识别结果、跳过 OCR
+        phash = near = same = None
+        if PHASH_ENABLED and ftype == "image":
+            with metrics.span("phash"):
+                phash = dhash(main_buf.view())
+                near = NEAR_DUP.lookup(phash) if phash is not None else None
+                same = confirm_by_qr(near, main_buf.view()) if near else None
+        # 多页 PDF 可能一页一张票：批量入口逐张处理，顶层仍是第一张的结果
+        # 截止时间随 contextvar 传到 OCR / 验真 / LLM 每一次外部调用
+        with profiler.maybe_profile(wants_profile(request)) as prof, deadline(request_budget(request)):
+            result = agent.process_reimbursement_batch(
+                file_bytes=main_buf.view(),
+                filename=main.filename or "",
+                user_input=note,
+                evidence_data=evidence_data,   # 关键：把其余文件作为 evidence 传入
+                file_type=ftype,   # <- 这里把类型传进去
+                reuse_invoices=near["invoices"] if same else None,
+                evidence_files=evidence_files,
+            )
+        if same:
+            result["possible_duplicate"] = {**{k: near[k] for k in ("distance", "filename", "first_seen")},
+                                            "same_invoice": same}
+        elif phash is not None:
+            NEAR_DUP.add(phash, content_key(main_buf.view()), main.filename or "")
+        return result, prof
+
+    try:
+        # 整条流程是同步阻塞的：放进线程池跑，事件循环继续接别的请求（重复提交才会在 singleflight 里合并）
+        result, prof = await run_in_threadpool(contextvars.copy_context().run, run_pipeline)
+    finally:
+        main_buf.close()
+    headers = {}
+    if wants_profile(request):
+        headers["X-Profile-Id"] = prof.id if prof else "rate_limited"
+    with metrics.span("serialization"):
+        return JSONResponse(result, headers=headers)
+
+@app.get("/admin/profiles")
+def admin_list_profiles(request: Request):
+    require_admin(request)
+    return {"profiles": profiler.list_profiles()}
+
+@app.get("/admin/profiles/{profile_id}")
+def admin_get_profile(profile_id: str, request: Request):
+    # 折叠栈文本：flamegraph.pl / speedscope / inferno 直接可读
+    require_admin(request)
+    text = profiler.load(profile_id)
+    if text is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return PlainTextResponse(text, headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'})
\ No newline at end of file
@@ -6,13 +6,13 @@ import json
 import logging
 from typing import Dict, Any, Optional
 
-import httpx
-
+from baidu_vat_client import get_token_manager
 from invoice_extractor import InvoiceExtractor
 from expense_analyzer import ExpenseAnalyzer
 from knowledge_retriever import KnowledgeRetriever
 from invoice_verifier import InvoiceVerifier
 from reimbursement_processor import ReimbursementProcessor
+from log_utils import setup_logging
 
 def _sanitize_env(value: Optional[str]) -> Optional[str]:
     if value is None:
@@ -21,7 +21,7 @@ def _sanitize_env(value: Optional[str]) -> Optional[str]:
     return v if v else None
 
 log = logging.getLogger("app")
-logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
+setup_logging()   # LOG_LEVEL 控制级别；输出走后台队列线程
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # 优先环境变量，其次项目内的 knowledge_base 目录
@@ -33,26 +33,15 @@ def _norm_base_url(url: str) -> str:
         url = "https://" + url
     return url.rstrip("/")
 
-# ---------- Baidu OAuth: 按需获取 access_token ----------
+# ---------- Baidu OAuth: 交给进程级 token manager（内存常驻 + 后台刷新） ----------
 def fetch_baidu_access_token(api_key: str, secret_key: str) -> Optional[str]:
     if not api_key or not secret_key:
         return None
-    url = (
-        "https://aip.baidubce.com/oauth/2.0/token"
-        f"?grant_type=client_credentials&client_id={api_key}&client_secret={secret_key}"
-    )
     try:
-        with httpx.Client(timeout=15) as client:
-            resp = client.get(url)
-        if resp.status_code == 200:
-            data = resp.json()
-            token = data.get("access_token")
-            if token:
-                log.info("Baidu access_token 获取成功（OAuth）")
-                return token
-            log.warning(f"Baidu OAuth 无 token: {data}")
-        else:
-            log.warning(f"Baidu OAuth HTTP {resp.status_code}: {resp.text[:200]}")
+        token = get_token_manager(api_key, secret_key).start().get()
+        if token:
+            log.info("Baidu access_token 获取成功（token manager）")
+            return token
     except Exception as e:
         log.warning(f"Baidu OAuth 调用异常: {e}")
     return None
@@ -103,12 +92,11 @@ def _load_config() -> Dict[str, Any]:
     return cfg
 
 def _ensure_baidu_tokens(cfg: Dict[str, Any]) -> Dict[str, Any]:
-    """确保百度OCR的access_token存在，缺了就OAuth获取。"""
+    """确保百度OCR的access_token存在；有 ak/sk 时统一交给 token manager，临期自动后台刷新。"""
     ocr = cfg["baidu_ocr"]
-    if not ocr.get("access_token"):
-        token = fetch_baidu_access_token(ocr.get("api_key", ""), ocr.get("secret_key", ""))
-        if token:
-            ocr["access_token"] = token
+    token = fetch_baidu_access_token(ocr.get("api_key", ""), ocr.get("secret_key", ""))
+    if token:
+        ocr["access_token"] = token
     return cfg
 
 def create_reimbursement_agent() -> ReimbursementProcessor:
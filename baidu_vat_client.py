@@ -1,41 +1,221 @@
 # baidu_vat_client.py
-import os, json, time, base64, requests
-from typing import Optional, Tuple
+import os, io, json, time, base64, hashlib, requests, threading, tempfile
+from urllib.parse import quote_plus
+from typing import Optional, Tuple, Dict
 
-BAIDU_TOKEN_CACHE = "/tmp/baidu_token.json"
-BAIDU_OAUTH = "https://aip.baidubce.com/oauth/2.0/token"
-BAIDU_VAT_URL = "https://aip.baidubce.com/rest/2.0/ocr/v1/vat_invoice"
+from resilience import guarded_call, has_budget, CircuitOpenError, DeadlineExceeded
+from metrics import CACHE_EVENTS, RETRIES, UPSTREAM_ERRORS
 
-class BaiduVatClient:
-    def __init__(self, ak: str, sk: str, timeout: int = 60):
-        self.ak, self.sk, self.timeout = ak, sk, timeout
+try:  # Windows 下没有 fcntl，跨进程锁退化为进程内锁
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
-    # —— 1) token 缓存：优先用缓存，临期自动刷新 —— #
-    def _load_cached_token(self) -> Optional[str]:
-        try:
-            j = json.loads(open(BAIDU_TOKEN_CACHE, "r", encoding="utf-8").read())
-            if j.get("access_token") and j.get("expire_at", 0) - time.time() > 300:
-                return j["access_token"]
-        except Exception:
-            pass
-        return None
+BAIDU_TOKEN_CACHE = os.getenv("BAIDU_TOKEN_CACHE", "/tmp/baidu_token.json")
+# 可用环境变量指向自建网关 / 基准测试的本地回放服务
+BAIDU_OAUTH = os.getenv("BAIDU_OAUTH_URL", "https://aip.baidubce.com/oauth/2.0/token")
+BAIDU_VAT_URL = os.getenv("BAIDU_VAT_URL", "https://aip.baidubce.com/rest/2.0/ocr/v1/vat_invoice")
+BAIDU_GENERAL_URL = os.getenv("BAIDU_GENERAL_URL", "https://aip.baidubce.com/rest/2.0/ocr/v1/general_basic")  # 通用文字（佐证材料）
 
-    def _save_cached_token(self, token: str, expires_in: int):
-        expire_at = int(time.time()) + int(expires_in)
-        json.dump({"access_token": token, "expire_at": expire_at}, open(BAIDU_TOKEN_CACHE, "w"), ensure_ascii=False)
+TOKEN_REFRESH_AHEAD = 24 * 3600   # 提前 1 天后台刷新（百度 token 有效期 30 天）
+TOKEN_MIN_TTL = 60                # 热路径认为"还能用"的最小剩余秒数
 
-    def _get_token(self) -> str:
-        cached = self._load_cached_token()
-        if cached:
-            return cached
+
+class _FileLock:
+    """基于 fcntl.flock 的跨进程互斥；无 fcntl 时为空操作。"""
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        return False
+
+
+class BaiduTokenManager:
+    """
+    进程内常驻 access_token：
+    - get() 只读内存，不做文件 I/O / OAuth（仅首次或已过期时同步兜底）
+    - 后台守护线程在过期前 TOKEN_REFRESH_AHEAD 秒主动刷新
+    - 多 worker 通过文件锁 + 原子替换共享缓存，同一时刻只有一个进程去 OAuth
+    """
+    def __init__(self, ak: str, sk: str, cache_path: str = BAIDU_TOKEN_CACHE,
+                 refresh_ahead: int = TOKEN_REFRESH_AHEAD, static_token: Optional[str] = None):
+        self.ak, self.sk = ak or "", sk or ""
+        self.ak_hash = hashlib.sha256(self.ak.encode("utf-8")).hexdigest()   # 缓存文件按完整 ak 区分，不写明文
+        self.cache_path = cache_path
+        self.lock_path = cache_path + ".lock"
+        self.refresh_ahead = refresh_ahead
+        self._static = static_token or None   # 只配了 access_token、没配 ak/sk 时直接用它
+        self._token: Optional[str] = None
+        self._expire_at = 0.0
+        self._bad: Optional[str] = None
+        self._lifetime = 2592000.0        # 最近一次 OAuth 给的 expires_in
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # —— 热路径 —— #
+    def get(self) -> str:
+        token, expire_at = self._token, self._expire_at
+        if token and expire_at - time.time() > TOKEN_MIN_TTL:
+            CACHE_EVENTS.inc(cache="baidu_token", result="memory")
+            return token
+        if not (self.ak and self.sk) and self._static:
+            return self._static
+        return self.refresh()
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """服务端判定 token 失效（110/111）时调用；共享缓存里的同一枚也不再采用。"""
+        with self._lock:
+            if token is None or token == self._token:
+                self._bad = self._token
+                self._expire_at = 0.0
+
+    # —— 刷新 —— #
+    def refresh(self, min_ttl: float = TOKEN_MIN_TTL) -> str:
+        """保证返回的 token 至少还有 min_ttl 秒寿命；内存 → 共享缓存 → OAuth 逐级兜底。"""
+        with self._lock:
+            now = time.time()
+            if self._token and self._token != self._bad and self._expire_at - now > min_ttl:
+                return self._token
+            with _FileLock(self.lock_path):
+                # 别的 worker 刚刷完：直接采用共享缓存
+                cached = self._read_cache()
+                if cached and cached[0] != self._bad and cached[1] - now > min_ttl:
+                    self._token, self._expire_at = cached
+                    CACHE_EVENTS.inc(cache="baidu_token", result="file")
+                    return self._token
+                CACHE_EVENTS.inc(cache="baidu_token", result="oauth")
+                token, expires_in = self._oauth()
+                self._token, self._expire_at = token, time.time() + expires_in
+                self._lifetime = float(expires_in)
+                self._write_cache(token, self._expire_at)
+            self._wake.set()
+            return token
+
+    def _oauth(self) -> Tuple[str, int]:
         r = requests.post(BAIDU_OAUTH, params={
             "grant_type": "client_credentials",
             "client_id": self.ak, "client_secret": self.sk
         }, timeout=15)
         jr = r.json()
-        token = jr["access_token"]
-        self._save_cached_token(token, jr.get("expires_in", 2592000))
-        return token
+        if not jr.get("access_token"):
+            raise RuntimeError(f"Baidu OAuth 无 token: {jr.get('error')}:{jr.get('error_description')}")
+        return jr["access_token"], int(jr.get("expires_in", 2592000))
+
+    def _read_cache(self) -> Optional[Tuple[str, float]]:
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                j = json.load(f)
+            # 同一缓存文件可能被不同 ak 的进程共用，ak 不符（含旧格式没记 ak 的）就当没有
+            if j.get("access_token") and j.get("ak_sha256") == self.ak_hash:
+                return j["access_token"], float(j.get("expire_at", 0))
+        except Exception:
+            pass
+        return None
+
+    def _write_cache(self, token: str, expire_at: float) -> None:
+        """写临时文件再 os.replace，读者永远看不到半截 JSON。"""
+        d = os.path.dirname(self.cache_path) or "."
+        fd, tmp = tempfile.mkstemp(prefix=".baidu_token.", dir=d)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"access_token": token, "expire_at": int(expire_at), "ak_sha256": self.ak_hash},
+                          f, ensure_ascii=False)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.cache_path)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    # —— 后台刷新 —— #
+    def start(self) -> "BaiduTokenManager":
+        """启动后台刷新线程（幂等）；首轮刷新在线程里做，失败按指数退避重试。"""
+        if not (self.ak and self.sk):
+            return self
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return self
+            self._thread = threading.Thread(target=self._loop, name="baidu-token-refresh", daemon=True)
+            self._thread.start()
+        return self
+
+    def _loop(self):
+        backoff = 5.0
+        while True:
+            # 短寿命 token（测试环境等）按寿命一半提前量刷新，避免空转
+            ahead = min(self.refresh_ahead, self._lifetime / 2)
+            try:
+                if self._expire_at - time.time() <= ahead:
+                    self.refresh(min_ttl=ahead)
+                backoff = 5.0
+                wait = max(5.0, self._expire_at - ahead - time.time())
+            except Exception:
+                wait, backoff = backoff, min(backoff * 2, 600.0)
+            self._wake.clear()
+            self._wake.wait(timeout=wait)
+
+
+_managers: Dict[Tuple[str, str], BaiduTokenManager] = {}
+_managers_lock = threading.Lock()
+
+def get_token_manager(ak: str, sk: str, static_token: Optional[str] = None) -> BaiduTokenManager:
+    """同一进程、同一对 ak/sk 只有一个 manager。"""
+    key = (ak or "", sk or "")
+    with _managers_lock:
+        m = _managers.get(key)
+        if m is None:
+            m = _managers[key] = BaiduTokenManager(ak, sk, static_token=static_token)
+        elif static_token and not m._static:
+            m._static = static_token
+        return m
+
+
+# —— 表单体流式编码：按 3 字节对齐分块 base64 + 百分号转义，直接写进缓冲 —— #
+FORM_CHUNK = 3 * 64 * 1024                                           # 192KB 原文 → 256KB base64
+FORM_SPOOL_LIMIT = int(os.getenv("OCR_FORM_SPOOL_BYTES", str(16 * 1024 * 1024)))  # 超过就落盘
+
+def _encode_form(fields: Dict[str, str], name: str, payload, spool_limit: int = FORM_SPOOL_LIMIT):
+    """
+    生成 application/x-www-form-urlencoded 的请求体（文件对象，可 seek 重放）。
+    payload 可以是 bytes / bytearray / memoryview，只按块切片，不整体复制；
+    不再经过 base64 str → dict → requests 内部 urlencode 的多次全量拷贝。
+    """
+    mv = memoryview(payload).cast("B")
+    est = len(mv) * 4 // 3 + 4096
+    out = tempfile.TemporaryFile(dir=os.getenv("UPLOAD_TMP_DIR", "/tmp")) if est > spool_limit else io.BytesIO()
+    out.write("&".join(f"{quote_plus(k)}={quote_plus(v)}" for k, v in fields.items()).encode("ascii"))
+    out.write(f"{'&' if fields else ''}{quote_plus(name)}=".encode("ascii"))
+    for i in range(0, len(mv), FORM_CHUNK):
+        b64 = base64.b64encode(mv[i:i + FORM_CHUNK])
+        # base64 字母表里只有 + / = 需要转义
+        out.write(b64.replace(b"+", b"%2B").replace(b"/", b"%2F").replace(b"=", b"%3D"))
+    out.seek(0)
+    return out
+
+
+class BaiduVatClient:
+    def __init__(self, ak: str, sk: str, timeout: int = 60, token_manager: Optional[BaiduTokenManager] = None):
+        self.ak, self.sk, self.timeout = ak, sk, timeout
+        self.tokens = token_manager or get_token_manager(ak, sk)
+
+    # —— 1) token：交给进程级 manager，热路径只读内存 —— #
+    def _get_token(self) -> str:
+        return self.tokens.get()
 
     # —— 2) 主调用：image / pdf_file / ofd_file 三选一；不要手动 urlencode —— #
     def recognize(self, *, image_bytes: bytes = None, pdf_bytes: bytes = None, ofd_bytes: bytes = None) -> dict:
@@ -43,27 +223,58 @@ class BaiduVatClient:
             return {"__ocr_error__": "no_input", "detail": "need image/pdf/ofd bytes"}
 
         token = self._get_token()
-        data = {"seal_tag": "false"}
         if image_bytes:
-            data["image"] = base64.b64encode(image_bytes).decode("utf-8")
+            field, payload = "image", image_bytes
         elif pdf_bytes:
-            data["pdf_file"] = base64.b64encode(pdf_bytes).decode("utf-8")
+            field, payload = "pdf_file", pdf_bytes
         else:
-            data["ofd_file"] = base64.b64encode(ofd_bytes).decode("utf-8")
+            field, payload = "ofd_file", ofd_bytes
+        body = _encode_form({"seal_tag": "false"}, field, payload)
+
+        try:
+            return self._post_with_retry(token, body)
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            # 熔断/预算耗尽：不等超时，直接给出错误，由上层路由到本地 OCR 或兜底
+            return {"__ocr_error__": f"{type(e).__name__}:{e}"}
+        finally:
+            body.close()
+
+    # —— 3) 通用文字识别（行程单/订单截图等佐证）：同一 token、同一熔断器与重试策略 —— #
+    def recognize_text(self, *, image_bytes: bytes = None, pdf_bytes: bytes = None) -> dict:
+        if not any([image_bytes, pdf_bytes]):
+            return {"__ocr_error__": "no_input", "detail": "need image/pdf bytes"}
+        token = self._get_token()
+        field, payload = ("image", image_bytes) if image_bytes else ("pdf_file", pdf_bytes)
+        body = _encode_form({}, field, payload)
+        try:
+            return self._post_with_retry(token, body, url=BAIDU_GENERAL_URL)
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            return {"__ocr_error__": f"{type(e).__name__}:{e}"}
+        finally:
+            body.close()
 
+    def _post_with_retry(self, token: str, body, url: str = BAIDU_VAT_URL) -> dict:
         # —— 指数退避重试：最多 5 次 —— #
         import time as _t
         for attempt in range(5):
-            resp = requests.post(
-                BAIDU_VAT_URL, params={"access_token": token}, data=data,
-                headers={"Content-Type": "application/x-www-form-urlencoded","Accept":"application/json"},
-                timeout=self.timeout
+            body.seek(0)
+            # 熔断 + 请求截止时间；body 是可 seek 的流，不能并发重放，所以不开对冲
+            resp = guarded_call(
+                "baidu_ocr",
+                lambda t: requests.post(
+                    url, params={"access_token": token}, data=body,
+                    headers={"Content-Type": "application/x-www-form-urlencoded","Accept":"application/json"},
+                    timeout=t
+                ),
+                timeout=self.timeout, is_failure=lambda r: r.status_code >= 500, hedge=False,
             )
             try:
                 jr = resp.json()
             except Exception:
-                if attempt == 4:
+                if attempt == 4 or not has_budget(0.2 * (2 ** attempt) + 1):
+                    UPSTREAM_ERRORS.inc(dependency="baidu_ocr", code="bad_json")
                     return {"__ocr_error__": "bad_json", "http_status": resp.status_code, "raw": resp.text}
+                RETRIES.inc(dependency="baidu_ocr", reason="bad_json")
                 _t.sleep(0.2 * (2 ** attempt)); continue
 
             # 统一错误映射
@@ -75,10 +286,19 @@ class BaiduVatClient:
                 if not code and msg.lower().startswith("open api qps"):
                     code = "18"
 
-                if code in {"18", "19"} and attempt < 4:  # QPS/并发类 → 重试
+                if code in {"110", "111"} and attempt < 4:  # token 失效/过期 → 作废后换新 token 重试
+                    RETRIES.inc(dependency="baidu_ocr", reason="token")
+                    self.tokens.invalidate(token)
+                    token = self._get_token()
+                    continue
+
+                # QPS/并发类 → 重试（剩余预算不够退避一轮就不再重试）
+                if code in {"18", "19"} and attempt < 4 and has_budget(0.2 * (2 ** attempt) + 1):
+                    RETRIES.inc(dependency="baidu_ocr", reason="throttle")
                     _t.sleep(0.2 * (2 ** attempt) + (0.05 * attempt))  # 指数退避 + 抖动
                     continue
 
+                UPSTREAM_ERRORS.inc(dependency="baidu_ocr", code=code or "unknown")
                 jr["__ocr_error__"] = f"{code}:{msg}" if code else msg
                 jr["http_status"] = resp.status_code
                 jr["log_id"] = jr.get("log_id")
@@ -0,0 +1,265 @@
+# bench_micro.py — CPU 热点函数微基准：检索 / 关键词打分 / 规则投票 / 上下文拼装 / 来源去重
+# -*- coding: utf-8 -*-
+"""
+在合成语料上把各函数的输入放大 1×/10×/100×/1000×（相对随仓库发布的知识库），看单次调用耗时怎么增长：
+
+    python benchmarks/bench_micro.py                       # 默认 1,10,100,1000
+    python benchmarks/bench_micro.py --scales 1,10 --only search_policy_documents,score_accounts
+    python benchmarks/bench_micro.py --json micro.json
+
+基准规模：文档数取 KB_DIR（缺省 benchmarks/fixtures/kb）里的 .txt/.md 数；关键词表取其中
+《发票关键词-会计科目map表.txt》行数（没有就按 BASE_KEYWORDS 行）；规则库/关键词集取代码里的 RULE_BOOK / KEYSETS。
+不访问任何外部服务。
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import timeit
+from typing import Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import expense_analyzer as ea              # noqa: E402
+import reimbursement_processor as rp       # noqa: E402
+from knowledge_retriever import KnowledgeRetriever, CitationResolver  # noqa: E402
+from invoice_record import InvoiceRecord  # noqa: E402
+
+BASE_KEYWORDS = 60        # 没有关键词表时的基准行数
+BASE_CONTEXTS = 6         # 一次分析塞进 prompt 的检索片段数
+BASE_SOURCES = 8          # 一个分析块里 sources_used + sources 的条数
+KEYWORD_MAP = "发票关键词-会计科目map表.txt"
+
+_FILLER = ["费用", "报销", "发票", "审批", "制度", "凭证", "金额", "日期", "部门", "员工", "标准", "超标",
+           "说明", "附件", "流程", "财务", "核对", "税额", "抬头", "税号", "合规", "要求", "原则", "期限"]
+
+
+def _vocab() -> List[str]:
+    words = set(_FILLER)
+    for keys in rp.KEYSETS.values():
+        words.update(keys)
+    for rule in ea.RULE_BOOK:
+        words.update(rule["keys"])
+    return sorted(words)
+
+
+def _doc_text(rnd: random.Random, vocab: List[str], paragraphs: int = 12) -> str:
+    out = []
+    for i in range(paragraphs):
+        body = "".join(rnd.choice(vocab) + ("，" if rnd.random() < 0.2 else "") for _ in range(40))
+        out.append(f"## 第{i + 1}条\n{body}。")
+    return "\n\n".join(out)
+
+
+def build_corpus(base_dir: str, scale: int, rnd: random.Random) -> str:
+    """把随仓库的 KB 复制一份，再补足到 原文档数×scale 篇合成文档 + 放大后的关键词表"""
+    vocab = _vocab()
+    out = tempfile.mkdtemp(prefix=f"kb_x{scale}_")
+    shipped = [fn for fn in os.listdir(base_dir) if fn.endswith((".txt", ".md"))] if os.path.isdir(base_dir) else []
+    for fn in shipped:
+        shutil.copy(os.path.join(base_dir, fn), out)
+    for i in range(max(0, len(shipped) * scale - len(shipped))):
+        with open(os.path.join(out, f"合成制度_{i:05d}.md"), "w", encoding="utf-8") as f:
+            f.write(_doc_text(rnd, vocab))
+
+    rows = []
+    if KEYWORD_MAP in shipped:
+        with open(os.path.join(base_dir, KEYWORD_MAP), "r", encoding="utf-8", errors="ignore") as f:
+            rows = [ln for ln in f.read().splitlines() if ln.strip() and not ln.startswith(("#", "keyword"))]
+    base_rows = len(rows) or BASE_KEYWORDS
+    accounts = ea.ACCOUNT_SUBJECTS
+    while len(rows) < base_rows * scale:
+        kw = rnd.choice(vocab) + (rnd.choice(vocab) if rnd.random() < 0.5 else "")
+        rows.append(f"{kw}\t{rnd.choice(accounts)}\t{rnd.choice((0.3, 0.5, 0.8, 1.0))}\t合成")
+    with open(os.path.join(out, KEYWORD_MAP), "w", encoding="utf-8") as f:
+        f.write("keyword\taccount\tweight\tnote\n" + "\n".join(rows) + "\n")
+    return out
+
+
+def _scaled_rules(scale: int, rnd: random.Random, vocab: List[str]):
+    rules = list(ea.RULE_BOOK)
+    while len(rules) < len(ea.RULE_BOOK) * scale:
+        src = rnd.choice(ea.RULE_BOOK)
+        rules.append({**src, "keys": [rnd.choice(vocab) + rnd.choice(vocab) for _ in range(len(src["keys"]))]})
+    return rules
+
+
+def _scaled_keysets(scale: int, rnd: random.Random, vocab: List[str]):
+    out = {k: list(v) for k, v in rp.KEYSETS.items()}
+    for i in range(len(rp.KEYSETS) * (scale - 1)):
+        out[f"合成类别{i}"] = [rnd.choice(vocab) + rnd.choice(vocab) for _ in range(10)]
+    return out
+
+
+def _invoice() -> Dict:
+    return {
+        "service_type": "住宿服务", "service_type_detail": "*住宿服务*住宿费",
+        "remark": "入住 2025-01-01 离店 2025-01-02 出差上海", "seller_name": "杭州某某酒店管理有限公司",
+        "total_amount": "566.04", "total_tax": "33.96", "amount_in_figures": "",
+        "verify_result": {"data": {"goodsData": [{"name": "*住宿服务*住宿费"}, {"name": "*餐饮服务*早餐"}]}},
+    }
+
+
+def _sources(n: int, rnd: random.Random) -> List:
+    """混合形态的来源：字符串路径 / dict / 脏 title；约一半重复"""
+    pool = [f"/srv/kb/制度文件_{i}.md" for i in range(max(1, n // 2))]
+    out = []
+    for _ in range(n):
+        p = rnd.choice(pool)
+        r = rnd.random()
+        if r < 0.4:
+            out.append(p)
+        elif r < 0.8:
+            out.append({"title": os.path.basename(p), "url": f"https://kb.example/{os.path.basename(p)}",
+                        "score": round(rnd.random(), 4)})
+        else:
+            out.append({"title": "{'title': '%s', 'url': ''}" % os.path.basename(p), "score": "0"})
+    return out
+
+
+# —— 各用例：setup(scale) → (无参可调用, 规模说明) —— #
+def case_search(scale, rnd, ctx):
+    r = ctx["retriever"](scale)
+    q = "出差 住宿 酒店 标准 超标 审批"
+    return (lambda: r.search_policy_documents(q, top_k=3)), f"docs={len(r.docs)}"
+
+
+def case_score_accounts(scale, rnd, ctx):
+    r = ctx["retriever"](scale)
+    text = "*住宿服务*住宿费 杭州某某酒店管理有限公司 入住 2025-01-01 出差上海 早餐 打车"
+    return (lambda: r.score_accounts(text)), f"keywords={len(r.keyword_map)}"
+
+
+def case_rule_vote(scale, rnd, ctx):
+    rules = _scaled_rules(scale, rnd, ctx["vocab"])
+    signals = ea._collect_signal_texts(_invoice(), "出差上海 住宿两晚")
+    orig = ea.RULE_BOOK
+
+    def call():
+        ea.RULE_BOOK = rules
+        try:
+            return ea._rule_vote(signals)
+        finally:
+            ea.RULE_BOOK = orig
+    return call, f"rules={len(rules)}"
+
+
+def case_infer_category(scale, rnd, ctx):
+    keysets = _scaled_keysets(scale, rnd, ctx["vocab"])
+    inv = _invoice()
+    orig = rp.KEYSETS
+
+    def call():
+        rp.KEYSETS = keysets
+        try:
+            return rp.infer_category_from_invoice(inv)
+        finally:
+            rp.KEYSETS = orig
+    return call, f"categories={len(keysets)}"
+
+
+def case_context_block(scale, rnd, ctx):
+    contexts = [{"source": f"制度文件_{i}.md", "content": _doc_text(rnd, ctx["vocab"], 1)[:240],
+                 "score": rnd.random()} for i in range(BASE_CONTEXTS * scale)]
+    return (lambda: ea._build_context_block(contexts)), f"contexts={len(contexts)}"
+
+
+def case_invoice_record(scale, rnd, ctx):
+    invs = [dict(_invoice(), total_amount=f"{rnd.uniform(1, 9999):.2f}") for _ in range(scale)]
+
+    def call():
+        for inv in invs:
+            InvoiceRecord.from_invoice(inv).apply_to(dict(inv))
+    return call, f"invoices={len(invs)}"
+
+
+def case_resolve_citations(scale, rnd, ctx):
+    names = [f"制度文件_{i}.md" for i in range(max(1, BASE_SOURCES * scale // 2))]
+    resolver = CitationResolver(names, lambda fn: f"https://kb.example/{fn}")
+    a, b = _sources(BASE_SOURCES * scale // 2 or 1, rnd), _sources(BASE_SOURCES * scale // 2 or 1, rnd)
+    return (lambda: resolver.resolve(a, b)), f"sources={len(a) + len(b)}"
+
+
+CASES: Dict[str, Callable] = {
+    "search_policy_documents": case_search,
+    "score_accounts": case_score_accounts,
+    "_rule_vote": case_rule_vote,
+    "infer_category_from_invoice": case_infer_category,
+    "_build_context_block": case_context_block,
+    "InvoiceRecord": case_invoice_record,
+    "resolve_citations": case_resolve_citations,
+}
+
+
+def measure(fn: Callable, repeat: int, min_time: float) -> float:
+    """返回单次调用的最好耗时（秒）：先定 number 让一轮 ≥ min_time，再取 repeat 轮里最快的"""
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if t < min_time / 10 else 2
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(args) -> List[Dict]:
+    rnd = random.Random(args.seed)
+    base_kb = os.getenv("KB_DIR") or os.path.join(HERE, "fixtures", "kb")
+    corpora: Dict[int, str] = {}
+    retrievers: Dict[int, KnowledgeRetriever] = {}
+
+    def retriever(scale: int) -> KnowledgeRetriever:
+        if scale not in retrievers:
+            corpora[scale] = build_corpus(base_kb, scale, random.Random(args.seed + scale))
+            retrievers[scale] = KnowledgeRetriever(local_knowledge_base_path=corpora[scale])
+        return retrievers[scale]
+
+    ctx = {"retriever": retriever, "vocab": _vocab()}
+    names = [n.strip() for n in args.only.split(",")] if args.only else list(CASES)
+    scales = [int(s) for s in args.scales.split(",")]
+    rows = []
+    try:
+        for name in names:
+            base = None
+            for scale in scales:
+                fn, size = CASES[name](scale, rnd, ctx)
+                fn()   # 预热（含惰性初始化）
+                per_call = measure(fn, args.repeat, args.min_time)
+                base = base or per_call
+                rows.append({"function": name, "scale": scale, "size": size,
+                             "us_per_call": round(per_call * 1e6, 2), "vs_1x": round(per_call / base, 2)})
+                print(f"{name:<30}{scale:>6}x  {size:<18}{per_call * 1e6:>14.2f} us{per_call / base:>10.2f}x",
+                      flush=True)
+    finally:
+        for d in corpora.values():
+            shutil.rmtree(d, ignore_errors=True)
+    return rows
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="检索/分类热点函数微基准（合成语料放大）")
+    ap.add_argument("--scales", default="1,10,100,1000")
+    ap.add_argument("--only", help="逗号分隔的函数名，缺省全部：" + ",".join(CASES))
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="每轮最少计时秒数")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--json", help="结果写成 JSON")
+    args = ap.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)   # 建库时的 info 日志不计入
+
+    print(f"{'function':<30}{'scale':>7}  {'size':<18}{'per call':>17}{'vs 1x':>10}")
+    rows = run(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# bench_pipeline.py — 端到端基准：回放上游 + 并发驱动 process_reimbursement 或 /api/invoices
+# -*- coding: utf-8 -*-
+"""
+上游（百度 OCR / 阿里云验真 / LLM）全部由 stub_server 回放 fixtures，可注入延迟，离线可跑：
+
+    python benchmarks/bench_pipeline.py --mode processor -n 50 -c 8 --latency baidu=600,aliyun=200,llm=1200
+    python benchmarks/bench_pipeline.py --mode api -n 50 -c 8 --input 某张发票.pdf --json out.json
+
+输出：吞吐、端到端与各阶段（metrics.span）/各依赖的 p50/p95/p99、降级次数、内存高水位。
+业务模块在读取环境变量后才 import，所以本脚本必须先起 stub、写好环境变量再 import。
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import stub_server  # noqa: E402
+
+
+def percentile(xs: List[float], p: float) -> float:
+    """最近秩百分位"""
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    k = max(0, min(len(xs) - 1, int(round(p / 100 * len(xs) + 0.5)) - 1))
+    return xs[k]
+
+
+def summarize(xs: List[float]) -> Dict[str, float]:
+    return {"count": len(xs), "p50_ms": round(percentile(xs, 50) * 1000, 2),
+            "p95_ms": round(percentile(xs, 95) * 1000, 2), "p99_ms": round(percentile(xs, 99) * 1000, 2),
+            "max_ms": round(max(xs) * 1000, 2) if xs else 0.0}
+
+
+def make_sample(kind: str, size: str) -> bytes:
+    """生成一张合成票面（只用于驱动流程；识别结果来自回放的 OCR fixture）"""
+    from PIL import Image, ImageDraw
+    w, h = (int(x) for x in size.lower().split("x"))
+    img = Image.new("RGB", (w, h), "white")
+    d = ImageDraw.Draw(img)
+    for y in range(0, h, max(8, h // 60)):        # 画些横线，避免被当成空白图压到极小
+        d.line([(w // 20, y), (w - w // 20, y)], fill=(90, 90, 90), width=2)
+    buf = io.BytesIO()
+    img.save(buf, "PDF" if kind == "pdf" else "JPEG", quality=90)
+    return buf.getvalue()
+
+
+class StageRecorder:
+    """旁路记录 metrics 直方图的原始样本（直方图本身只有分桶，算不准 p99）"""
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        self._restore = []
+
+    def attach(self, hist, prefix: str, label: str):
+        orig = hist.observe
+
+        def observe(value, **labels):
+            with self._lock:
+                self.samples.setdefault(f"{prefix}{labels.get(label, '')}", []).append(value)
+            orig(value, **labels)
+
+        hist.observe = observe
+        self._restore.append((hist, orig))
+
+    def reset(self):
+        with self._lock:
+            self.samples = {}
+
+    def detach(self):
+        for hist, orig in self._restore:
+            hist.observe = orig
+
+
+def rss_mb() -> Dict[str, float]:
+    # Linux 上 ru_maxrss 单位是 KB（macOS 是字节）
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self_max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, 1),
+            "children_max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit, 1)}
+
+
+def processor_driver(data: bytes, filename: str, kind: str, note: str):
+    from app import create_reimbursement_agent
+    agent = create_reimbursement_agent()
+
+    def call():
+        r = agent.process_reimbursement(file_bytes=data, filename=filename, file_type=kind, user_input=note,
+                                        evidence_data=[])
+        return r.get("degraded_stages") or []
+    return call
+
+
+def api_driver(data: bytes, filename: str, kind: str, note: str):
+    import api_app
+    try:
+        import uvicorn
+        import requests
+    except ImportError:   # 没装 uvicorn 时退回进程内 TestClient（少了真实的 socket/解析开销）
+        uvicorn = None
+    if uvicorn is None:
+        print("warning: uvicorn 未安装，退回 TestClient：每个请求各用一个事件循环，并发数字不代表单个 worker",
+              file=sys.stderr)
+        from fastapi.testclient import TestClient
+        client = TestClient(api_app.app)
+        post = client.post
+    else:
+        config = uvicorn.Config(api_app.app, host="127.0.0.1", port=0, log_level="warning")
+        server = uvicorn.Server(config)
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        base = f"http://127.0.0.1:{port}"
+        session = requests.Session()
+
+        def post(path, **kw):
+            return session.post(base + path, **kw)
+
+    def call():
+        resp = post("/api/invoices", files={"files": (filename, data)}, data={"note": note})
+        if resp.status_code != 200:
+            raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+        return resp.json().get("degraded_stages") or []
+    return call
+
+
+def run(args) -> Dict:
+    latency = stub_server.parse_latency(args.latency)
+    server, state, base = stub_server.start(latency=latency, jitter=args.jitter,
+                                            unique_numbers=not args.same_invoice)
+    env = stub_server.upstream_env(base)
+    env.setdefault("KB_DIR", os.path.join(HERE, "fixtures", "kb"))
+    env["BAIDU_TOKEN_CACHE"] = os.path.join(tempfile.mkdtemp(prefix="bench_"), "baidu_token.json")
+    # 去重索引/感知哈希会在预热后直接命中内容哈希、跳过 OCR，基准要量的是完整流程
+    env["INVOICE_INDEX_DB"] = ""
+    env["PHASH_ENABLED"] = "0"
+    env.setdefault("LOG_LEVEL", args.log_level)
+    for k, v in env.items():
+        if k == "KB_DIR" and os.getenv("KB_DIR"):
+            continue
+        os.environ[k] = v
+
+    if args.input:
+        with open(args.input, "rb") as f:
+            data = f.read()
+        filename = os.path.basename(args.input)
+        kind = "pdf" if filename.lower().endswith(".pdf") else "ofd" if filename.lower().endswith(".ofd") else "image"
+    else:
+        kind = args.kind
+        data = make_sample(kind, args.image_size)
+        filename = f"invoice_bench.{'pdf' if kind == 'pdf' else 'jpg'}"
+
+    import metrics
+    rec = StageRecorder()
+    rec.attach(metrics.STAGE_SECONDS, "", "stage")
+    rec.attach(metrics.UPSTREAM_SECONDS, "upstream:", "dependency")
+
+    driver = (api_driver if args.mode == "api" else processor_driver)(data, filename, kind, args.note)
+
+    for _ in range(args.warmup):
+        driver()
+    rec.reset()
+    state.counts.clear()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    latencies: List[float] = []
+    degraded: Dict[str, int] = {}
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def one():
+        t0 = time.perf_counter()
+        try:
+            stages = driver()
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+            for s in stages:
+                degraded[s] = degraded.get(s, 0) + 1
+
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for f in as_completed([pool.submit(one) for _ in range(args.requests)]):
+            f.result()
+    wall = time.perf_counter() - t_start
+
+    mem = rss_mb()
+    if args.tracemalloc:
+        mem["python_heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+    rec.detach()
+    server.shutdown()
+
+    return {
+        "mode": args.mode, "input": filename, "bytes": len(data),
+        "requests": args.requests, "concurrency": args.concurrency, "latency_ms": args.latency or "0",
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else 0.0,
+        "wall_s": round(wall, 3),
+        "errors": len(errors), "error_samples": errors[:5],
+        "end_to_end": summarize(latencies),
+        "stages": {k: summarize(v) for k, v in sorted(rec.samples.items())},
+        "degraded": degraded,
+        "upstream_hits": dict(state.counts),
+        "memory": mem,
+    }
+
+
+def print_report(r: Dict):
+    print(f"\n== {r['mode']} | {r['input']} ({r['bytes']} B) | n={r['requests']} c={r['concurrency']} "
+          f"| upstream latency: {r['latency_ms']}")
+    print(f"throughput {r['throughput_rps']} req/s, wall {r['wall_s']}s, errors {r['errors']}")
+    for e in r["error_samples"]:
+        print(f"  ! {e}")
+    print(f"{'stage':<28}{'count':>7}{'p50ms':>10}{'p95ms':>10}{'p99ms':>10}{'maxms':>10}")
+    rows = [("end_to_end", r["end_to_end"])] + list(r["stages"].items())
+    for name, s in rows:
+        print(f"{name:<28}{s['count']:>7}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    if r["degraded"]:
+        print("degraded:", ", ".join(f"{k}×{v}" for k, v in sorted(r["degraded"].items())))
+    print("upstream hits:", r["upstream_hits"])
+    print("memory:", r["memory"])
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="报销全流程基准（上游回放）")
+    ap.add_argument("--mode", choices=("processor", "api"), default="processor")
+    ap.add_argument("-n", "--requests", type=int, default=20)
+    ap.add_argument("-c", "--concurrency", type=int, default=4)
+    ap.add_argument("--warmup", type=int, default=1)
+    ap.add_argument("--latency", default="", help="注入上游延迟（毫秒），如 baidu=600,aliyun=200,llm=1200")
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--input", help="真实发票文件；缺省生成一张合成图")
+    ap.add_argument("--kind", choices=("image", "pdf"), default="image")
+    ap.add_argument("--image-size", default="2480x1748", help="合成票面尺寸（A5 @300dpi）")
+    ap.add_argument("--note", default="出差住宿")
+    ap.add_argument("--same-invoice", action="store_true", help="OCR 回放固定发票号（默认每次不同）")
+    ap.add_argument("--tracemalloc", action="store_true", help="记录 Python 堆峰值（有额外开销）")
+    ap.add_argument("--log-level", default="WARNING")
+    ap.add_argument("--json", help="把结果写成 JSON，便于对比回归")
+    ap.add_argument("--expect-upstream", default="",
+                    help="断言上游调用次数，如 baidu=1（重复提交合并检查）；不符时退出码 1")
+    args = ap.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    expect = {k.strip(): int(v) for k, v in (p.split("=", 1) for p in args.expect_upstream.split(",") if "=" in p)}
+    wrong = {dep: (report["upstream_hits"].get(dep, 0), want) for dep, want in expect.items()
+             if report["upstream_hits"].get(dep, 0) != want}
+    if wrong:
+        print("upstream hits mismatch:", ", ".join(f"{d} {got} != {want}" for d, (got, want) in wrong.items()))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# stub_server.py — 基准测试用的上游回放服务：百度 OAuth/增值税发票 OCR/通用文字 OCR、阿里云验真、OpenAI 兼容 LLM
+# -*- coding: utf-8 -*-
+"""
+只回放 fixtures/ 下录制好的响应，可按依赖注入延迟：
+
+    python benchmarks/stub_server.py --port 18080 --latency baidu=800,aliyun=300,llm=1500 --jitter 0.2
+
+被测进程通过环境变量指过来（bench_pipeline.py 会自动设置）：
+    BAIDU_OAUTH_URL / BAIDU_VAT_URL / BAIDU_GENERAL_URL / ALIYUN_FAPIAO_HOST / LLM_BASE_URL
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+ROUTES = {
+    "/oauth/2.0/token": "oauth",
+    "/rest/2.0/ocr/v1/vat_invoice": "baidu",
+    "/rest/2.0/ocr/v1/general_basic": "baidu_text",
+    "/v2/invoice/query": "aliyun",
+    "/v1/chat/completions": "llm",
+}
+
+
+def _load(name: str):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_latency(spec: str) -> Dict[str, float]:
+    """'baidu=800,aliyun=300,llm=1500'（毫秒）→ {"baidu": 0.8, ...}（秒）"""
+    out: Dict[str, float] = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = float(v) / 1000
+    return out
+
+
+class StubState:
+    def __init__(self, latency: Optional[Dict[str, float]] = None, jitter: float = 0.0,
+                 unique_numbers: bool = True):
+        self.latency = latency or {}
+        self.jitter = jitter
+        self.unique_numbers = unique_numbers   # 每次 OCR 换一个发票号，避免任何按内容的缓存/合并命中
+        self.baidu = _load("baidu_vat_invoice.json")
+        self.baidu_text = _load("baidu_general_trip.json")     # 佐证（行程单）的通用文字识别
+        self.aliyun = _load("aliyun_verify.json")
+        self.llm = _load("llm_responses.json")
+        self.counts: Dict[str, int] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def hit(self, dep: str) -> int:
+        with self._lock:
+            self.counts[dep] = self.counts.get(dep, 0) + 1
+            self._seq += 1
+            return self._seq
+
+    def sleep(self, dep: str):
+        base = self.latency.get(dep, 0.0)
+        if base > 0:
+            time.sleep(max(0.0, base * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    def baidu_response(self, seq: int) -> dict:
+        jr = deepcopy(self.baidu)
+        if self.unique_numbers:
+            for wr in jr.get("words_result") or []:
+                res = wr.get("result") or {}
+                num = str(res.get("InvoiceNum") or "")
+                if num:
+                    res["InvoiceNum"] = num[:-8] + f"{seq % 10 ** 8:08d}"
+        return jr
+
+    def llm_response(self, payload: dict) -> dict:
+        msgs = payload.get("messages") or []
+        system = next((m.get("content", "") for m in msgs if m.get("role") == "system"), "")
+        content = self.llm.get("default")
+        for r in self.llm.get("routes") or []:
+            if r["match"] in system:
+                content = r["content"]
+                break
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "model": payload.get("model", "bench"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps(content, ensure_ascii=False)}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):   # 安静
+            pass
+
+        def _send(self, code: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            dep = ROUTES.get(urlparse(self.path).path)
+            if dep is None:
+                return self._send(404, {"error": f"no stub for {self.path}"})
+            seq = state.hit(dep)
+            state.sleep(dep)
+            if dep == "oauth":
+                return self._send(200, {"access_token": "bench-token", "expires_in": 2592000})
+            if dep == "baidu":
+                return self._send(200, state.baidu_response(seq))
+            if dep == "baidu_text":
+                return self._send(200, state.baidu_text)
+            if dep == "aliyun":
+                return self._send(200, state.aliyun)
+            try:
+                payload = json.loads(raw or b"{}")
+            except ValueError:
+                payload = {}
+            return self._send(200, state.llm_response(payload))
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                return self._send(200, state.counts)
+            return self._send(404, {})
+
+    return Handler
+
+
+def start(port: int = 0, **kw):
+    """后台线程起服务，返回 (server, state, base_url)；port=0 取随机端口"""
+    state = StubState(**kw)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-upstream", daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def upstream_env(base_url: str) -> Dict[str, str]:
+    """被测进程需要的环境变量（必须在 import 业务模块之前设置）"""
+    return {
+        "BAIDU_OAUTH_URL": f"{base_url}/oauth/2.0/token",
+        "BAIDU_VAT_URL": f"{base_url}/rest/2.0/ocr/v1/vat_invoice",
+        "BAIDU_GENERAL_URL": f"{base_url}/rest/2.0/ocr/v1/general_basic",
+        "ALIYUN_FAPIAO_HOST": base_url,
+        "LLM_BASE_URL": f"{base_url}/v1",
+        "BAIDU_OCR_API_KEY": "bench-ak",
+        "BAIDU_OCR_SECRET_KEY": "bench-sk",
+        "BAIDU_AK": "bench-ak",            # OCR 路由里的百度后端走 load_ak_sk()
+        "BAIDU_SK": "bench-sk",
+        "ZHUBAJIE_VERIFY_APP_CODE": "bench-appcode",
+        "LLM_API_KEY": "bench-key",
+        "LLM_MODEL": "bench-model",
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="上游回放服务")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--latency", default="", help="按依赖注入延迟（毫秒），如 baidu=800,aliyun=300,llm=1500")
+    ap.add_argument("--jitter", type=float, default=0.0, help="延迟抖动比例，0.2 表示 ±20%%")
+    args = ap.parse_args(argv)
+    server, _, base = start(args.port, latency=parse_latency(args.latency), jitter=args.jitter)
+    print(f"stub upstream on {base}")
+    for k, v in upstream_env(base).items():
+        print(f"export {k}={v}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
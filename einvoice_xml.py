@@ -0,0 +1,112 @@
+# einvoice_xml.py — 数电（全电）发票官方 XML → 发票要素 + 明细 goodsData，纯本地、毫秒级
+# -*- coding: utf-8 -*-
+"""
+税务数字账户/财务系统导出的数电票 XML（根节点 EInvoice）本身就是开票数据：
+- TaxSupervisionInfo：发票号码、开票日期
+- EInvoiceData/SellerInformation、BuyerInformation：名称、纳税人识别号
+- EInvoiceData/BasicInformation：合计金额、合计税额、价税合计（含大写）
+- EInvoiceData/IssuItemInformation（可多条）：项目名称、规格、单位、数量、单价、金额、税率、税额
+不做任何识别，字段原样搬过来；明细按验真接口 goodsData 的键名给出，分类/风控不必等验真。
+OFD 包里附带的 original_invoice.xml 也走这里。
+"""
+import re
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional
+
+XML_MAX_BYTES = 4 * 1024 * 1024
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _find(el: Optional[ET.Element], *path: str) -> Optional[ET.Element]:
+    """按本地名逐级找第一个子孙（忽略命名空间）；路径中任一级缺失返回 None"""
+    for name in path:
+        if el is None:
+            return None
+        el = next((c for c in el.iter() if c is not el and _local(c.tag) == name), None)
+    return el
+
+
+def _text(el: Optional[ET.Element], *path: str) -> str:
+    node = _find(el, *path) if path else el
+    return (node.text or "").strip() if node is not None else ""
+
+
+def _any(el: Optional[ET.Element], *names: str) -> str:
+    """不同版本的导出文件同一栏目名字略有出入：按顺序取第一个非空"""
+    for name in names:
+        v = _text(el, name)
+        if v:
+            return v
+    return ""
+
+
+def is_einvoice_xml(head: bytes) -> bool:
+    """首块里有 EInvoice 根节点（允许 BOM / XML 声明 / 命名空间前缀）"""
+    head = bytes(head[:2048])
+    return head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<") and bool(re.search(rb"<(?:\w+:)?EInvoice[\s>]", head))
+
+
+def _items(data: ET.Element) -> List[Dict[str, str]]:
+    goods = []
+    for it in (c for c in data.iter() if _local(c.tag) == "IssuItemInformation"):
+        name = _text(it, "ItemName")
+        if not name:
+            continue
+        goods.append({
+            "name": name,
+            "ggxh": _text(it, "SpecMod"),
+            "dw": _text(it, "MeaUnits"),
+            "num": _text(it, "Quantity"),
+            "dj": _text(it, "UnPrice"),
+            "je": _text(it, "Amount"),
+            "sl": _text(it, "TaxRate"),
+            "se": _text(it, "ComTaxAm"),
+        })
+    return goods
+
+
+def parse_einvoice_xml(data) -> Optional[Dict[str, Any]]:
+    """
+    返回 {"fields": {EMPTY_OCR 字段: 值}, "goodsData": [...]}；
+    不是数电票 XML / 解析失败返回 None。金额、税率保持 XML 里的原始写法，由调用方统一规整。
+    """
+    if data is None or len(data) > XML_MAX_BYTES:
+        return None
+    try:
+        root = ET.fromstring(bytes(data))
+    except ET.ParseError:
+        return None
+    if _local(root.tag) != "EInvoice":
+        return None
+
+    header = _find(root, "Header")
+    body = _find(root, "EInvoiceData")
+    sup = _find(root, "TaxSupervisionInfo")
+    if body is None:
+        return None
+    basic = _find(body, "BasicInformation")
+    seller = _find(body, "SellerInformation")
+    buyer = _find(body, "BuyerInformation")
+
+    number = _text(sup, "InvoiceNumber") or _text(header, "EIid")
+    issued = _text(sup, "IssueTime") or _text(basic, "RequestTime")
+    kind = _text(header, "EInvoiceType", "LabelName") or _text(header, "GeneralOrSpecialVAT", "LabelName")
+    fields = {
+        "invoice_number": re.sub(r"\s+", "", number),
+        "invoice_code": "",
+        "invoice_date": issued[:10],
+        "seller_name": _any(seller, "SellerName"),
+        "seller_register_num": _any(seller, "SellerIdNum", "SellerTaxID"),
+        "buyer_name": _any(buyer, "BuyerName"),
+        "buyer_register_num": _any(buyer, "BuyerIdNum", "BuyerTaxID"),
+        "total_amount": _any(basic, "TotalAmWithoutTax"),
+        "total_tax": _any(basic, "TotalTaxAm"),
+        "amount_in_figures": _any(basic, "TotalTax-includedAmount", "TotalTaxIncludedAmount"),
+        "amount_in_words": _any(basic, "TotalTax-includedAmountInChinese", "TotalTaxIncludedAmountInChinese"),
+        "invoice_type": f"电子发票（{kind}）" if kind else "",
+        "remark": _text(body, "AdditionalInformation", "Remark") or _text(body, "Remark"),
+    }
+    return {"fields": fields, "goodsData": _items(body)}
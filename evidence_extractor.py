@@ -0,0 +1,238 @@
+# evidence_extractor.py — 佐证材料（行程单、订单截图、水单…）的并行抽取：文字 → 日期/金额/行程段
+# -*- coding: utf-8 -*-
+"""
+主票据 OCR/验真/LLM 的同时，佐证文件在后台线程池里各自抽取：
+- PDF 先读文本层（本地、无网络）；扫描件或图片走通用文字 OCR（与发票 OCR 共用节流/熔断/配额路由）
+- 文本 → 类型、日期、金额、行程段（起点/终点/金额）；文件名里的日期/金额也算线索
+结果只在风控比对（_evidence_enrich_and_align）时才取，不占主流程的关键路径；
+预算用完还没抽完的佐证按“未抽取”处理。
+"""
+import os
+import re
+import logging
+import threading
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Dict, List, Optional, Tuple
+
+from invoice_extractor import ocr_text_from_bytes, pdf_page_texts
+from invoice_validator import calendar_date, money
+from resilience import submit_in_context, remaining, mark_degraded
+from metrics import span
+
+logger = logging.getLogger("evidence_extractor")
+
+EVIDENCE_WORKERS = int(os.getenv("EVIDENCE_WORKERS", "4"))
+EVIDENCE_OCR = os.getenv("EVIDENCE_OCR", "1") == "1"          # 0：只读 PDF 文本层和文件名，不调 OCR
+EVIDENCE_MAX_LEGS = 50
+
+# —— 文本解析 —— #
+_DATE_PAT = re.compile(r"(20\d{2})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?")
+_DATE8_PAT = re.compile(r"(?<!\d)(20\d{2})(\d{2})(\d{2})(?!\d)")
+_MD_PAT = re.compile(r"(?<![\d\-/.])(\d{1,2})[-/.月](\d{1,2})日?(?![\d\-/.])")
+_TIME_PAT = re.compile(r"(?<!\d)([01]?\d|2[0-3]):[0-5]\d(?!\d)")
+# “共计/总计”后面常是件数、晚数（共计2件）：必须带 ¥/元 或两位小数才算金额
+_TOTAL_PAT = re.compile(r"(?:合\s*计|总金额|实付(?:金额|款)?|支付金额|订单金额|应付金额|金额合计)"
+                        r"[^\d\-\n]{0,10}(-?\d[\d,]*(?:\.\d{1,2})?)\s*元?"
+                        r"|(?:共\s*计|总\s*计)[^\d\-\n]{0,10}?"
+                        r"(?:[¥￥]\s*(\d[\d,]*(?:\.\d{1,2})?)|(\d[\d,]*\.\d{1,2})|(\d[\d,]*)\s*元)")
+_AMOUNT_PAT = re.compile(r"[¥￥]\s*(\d[\d,]*(?:\.\d{1,2})?)|(\d[\d,]*\.\d{1,2})\s*元")
+_LEG_AMOUNT_PAT = re.compile(r"(\d[\d,]*\.\d{1,2})\s*元?\s*$")
+_LEG_NOISE = re.compile(r"(\d+(?:\.\d+)?\s*(?:km|公里))|周[一二三四五六日天]|星期[一二三四五六日天]|"
+                        r"特惠快车|快车|专车|出租车|顺风车|优享|经济型|舒适型", re.I)
+
+EVIDENCE_TYPES: List[Tuple[str, Tuple[str, ...]]] = [
+    ("机票行程单", ("电子客票", "航班", "登机", "航空运输")),
+    ("火车票", ("车次", "12306", "铁路", "二等座", "一等座")),
+    ("行程单", ("行程单", "上车时间", "起点", "终点", "上车地点")),
+    ("酒店水单", ("水单", "入住", "离店", "房费", "结账单")),
+    ("订单截图", ("订单", "实付", "支付成功", "交易成功")),
+    ("出差审批单", ("审批", "出差申请", "事由")),
+]
+
+
+def guess_evidence_type(text: str, filename: str = "") -> str:
+    blob = f"{filename}\n{text}"
+    for name, keys in EVIDENCE_TYPES:
+        if any(k in blob for k in keys):
+            return name
+    return "佐证材料"
+
+
+def _dates(text: str) -> List[str]:
+    out = []
+    for pat in (_DATE_PAT, _DATE8_PAT):
+        for m in pat.finditer(text):
+            d = calendar_date(f"{m.group(1)}-{m.group(2)}-{m.group(3)}")
+            if d:
+                out.append(d.isoformat())
+    return list(dict.fromkeys(out))
+
+
+def _amount(s: str) -> Optional[float]:
+    v = money(s)
+    return float(v) if v is not None else None
+
+
+def _with_year(month: str, day: str, known: List[str]) -> Optional[str]:
+    """行程单里只有“月-日”：在表头日期的年份里挑落在起止范围内的那个（跨年行程也对）"""
+    if not known:
+        return None
+    lo, hi = min(known), max(known)
+    cands = []
+    for y in sorted({k[:4] for k in known}):
+        d = calendar_date(f"{y}-{month}-{day}")
+        if d:
+            cands.append(d.isoformat())
+    inside = [c for c in cands if lo <= c <= hi]
+    before = [c for c in cands if c <= hi]
+    pick = inside or before or cands
+    return pick[-1] if pick else None
+
+
+def _trip_legs(lines: List[str], known_dates: List[str]) -> List[Dict[str, Any]]:
+    """
+    行程单表格行：序号 车型 上车时间 城市 起点 终点 里程 金额。
+    一行里有“时刻 + 行尾金额”就当一段；起点/终点取去掉时间、车型、里程后的最后两段文字。
+    """
+    legs = []
+    for line in lines:
+        t = _TIME_PAT.search(line)
+        a = _LEG_AMOUNT_PAT.search(line)
+        if not t or not a or a.start() < t.end():
+            continue
+        d = _DATE_PAT.search(line)
+        date = None
+        if d:
+            cd = calendar_date(d.group(0))
+            date = cd.isoformat() if cd else None
+        else:
+            md = _MD_PAT.search(line[:t.start()])
+            if md:
+                date = _with_year(md.group(1), md.group(2), known_dates)
+        middle = _LEG_NOISE.sub(" ", line[t.end():a.start()])
+        parts = [p for p in re.split(r"\s{1,}|→|->|—|至", middle) if len(p) >= 2]
+        legs.append({"date": date, "time": t.group(0),
+                     "from": parts[-2] if len(parts) >= 2 else None,
+                     "to": parts[-1] if parts else None,
+                     "amount": _amount(a.group(1))})
+        if len(legs) >= EVIDENCE_MAX_LEGS:
+            break
+    return legs
+
+
+def parse_evidence_text(text: str, filename: str = "") -> Dict[str, Any]:
+    """
+    文本 → {"type", "dates", "amounts", "trip_legs", "derived_date", "derived_amount"}。
+    derived_date 取最晚的日期（行程结束/下单日，发票一般在它之后开）；
+    derived_amount 优先“合计/实付”等标注金额，其次行程段金额之和，再次唯一出现的金额；拿不准就留空，不制造误报。
+    """
+    text = text or ""
+    blob = f"{text}\n{os.path.basename(filename or '')}"
+    dates = _dates(blob)
+    legs = _trip_legs(text.splitlines(), dates)
+
+    totals = [v for v in (_amount(next(g for g in m.groups() if g)) for m in _TOTAL_PAT.finditer(blob)) if v is not None]
+    amounts = [v for v in (_amount(m.group(1) or m.group(2)) for m in _AMOUNT_PAT.finditer(blob)) if v is not None]
+    amounts = list(dict.fromkeys(totals + amounts))
+
+    derived_amount = None
+    if totals:
+        derived_amount = max(totals)      # 小计/优惠/运费也常带“合计”类标注，总计是其中最大的
+    elif legs and all(l["amount"] is not None for l in legs):
+        derived_amount = round(sum(l["amount"] for l in legs), 2)
+    elif len(amounts) == 1:
+        derived_amount = amounts[0]
+
+    leg_dates = [l["date"] for l in legs if l["date"]]
+    all_dates = sorted(set(dates + leg_dates))
+    return {
+        "type": guess_evidence_type(text, filename),
+        "dates": all_dates,
+        "amounts": amounts,
+        "trip_legs": legs,
+        "derived_date": all_dates[-1] if all_dates else None,
+        "derived_amount": derived_amount,
+    }
+
+
+# —— 单个文件 —— #
+def evidence_text(data, filename: str, kind: str) -> Tuple[str, str]:
+    """返回 (文本, 来源)：pdf_text / ocr / none"""
+    if kind == "pdf":
+        text = "\n".join(pdf_page_texts(data)).strip()
+        if text:
+            return text, "pdf_text"
+    if kind in ("pdf", "image") and EVIDENCE_OCR:
+        text = ocr_text_from_bytes(data, filename, kind=kind).strip()
+        if text:
+            return text, "ocr"
+    return "", "none"
+
+
+def extract_evidence(data, filename: str, kind: str) -> Dict[str, Any]:
+    with span("evidence_extract"):
+        text, source = evidence_text(data, filename, kind)
+        info = parse_evidence_text(text, filename)
+    info.update({"filename": filename, "text_source": source, "text_chars": len(text)})
+    return info
+
+
+# —— 一次请求的全部佐证：提交即返回，用到时再等 —— #
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=EVIDENCE_WORKERS, thread_name_prefix="evidence")
+    return _pool
+
+
+class PendingEvidence:
+    """
+    files: [(bytes, filename, kind), ...]。构造时即提交到后台池（继承本请求的截止时间与 profile）；
+    results() 在剩余预算内等待，没等到的佐证只保留文件名并标记 extract_error。
+    """
+    def __init__(self, files: List[Tuple[Any, str, str]]):
+        self.files = files
+        self.futures: List[Future] = [submit_in_context(_get_pool(), extract_evidence, data, name, kind)
+                                      for data, name, kind in files]
+        self._results: Optional[List[Dict[str, Any]]] = None
+
+    def results(self) -> List[Dict[str, Any]]:
+        if self._results is not None:
+            return self._results
+        out = []
+        for (data, name, kind), fut in zip(self.files, self.futures):
+            left = remaining()
+            try:
+                info = fut.result(timeout=None if left is None else max(0.0, left))
+            except Exception as e:
+                if not fut.done():
+                    mark_degraded("evidence")
+                logger.warning("evidence %s not extracted: %s", name, type(e).__name__)
+                info = {"filename": name, "type": "佐证材料", "extract_error": type(e).__name__}
+            out.append(info)
+        self._results = out
+        return out
+
+
+def merge_evidence(evidence_list: List[Dict[str, Any]], extracted: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    按位置把抽取结果并进 API 层给的元数据（两者由 api_app 按同一顺序构造）；
+    不按文件名对：手机上传常常都叫 image.jpg。调用方给的 type 若不是泛称则保留。
+    """
+    merged = []
+    for e, x in zip_longest(evidence_list, extracted):
+        if x is None or e is None:
+            merged.append(e if x is None else x)
+            continue
+        m = {**e, **x}
+        if e.get("type") and e["type"] != "佐证材料":
+            m["type"] = e["type"]
+        merged.append(m)
+    return merged
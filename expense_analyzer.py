@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import os
 import json
 import httpx
 from typing import List, Dict, Any, Optional
 
+from resilience import guarded_call, has_budget, mark_degraded, LLM_STAGE_MIN_S
+from metrics import RETRIES, UPSTREAM_ERRORS
+from singleflight import LLM_FLIGHT, content_key
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))   # 单次 LLM 调用上限（还会被请求剩余预算收紧）
+
 # ===== 通用规则：候选类别、会计科目、触发关键词 =====
 RULE_BOOK = [
     # 差旅 - 住宿
@@ -37,8 +44,8 @@ def _collect_signal_texts(invoice_data: dict, user_note: str = "") -> dict:
     words = invoice_data.get("words_result") or {}
 
     goods = []
-    # goodsData.name（验真）
-    for g in vr.get("goodsData") or []:
+    # goodsData.name（验真；没有验真结果时用票据自带明细，如数电 XML）
+    for g in vr.get("goodsData") or inv.get("goodsData") or []:
         n = (g.get("name") or "").strip()
         if n: goods.append(n)
     # OCR CommodityName
@@ -183,7 +190,10 @@ def _build_context_block(contexts):
 
     lines = []
     for c in (contexts or []):
-        if isinstance(c, dict):
+        if isinstance(c, dict) and c.get("rendered"):
+            # 知识库上下文包：加载时已裁剪、渲染好，原样拼接
+            lines.append(c["rendered"])
+        elif isinstance(c, dict):
             # 名称：source/doc/title/file 任取其一
             name = c.get("source") or c.get("doc") or c.get("title") or c.get("file") or "未知来源"
             try:
@@ -235,6 +245,15 @@ def _build_context_block(contexts):
     return joined or "（无命中上下文）"
 
 
+def _sources_from_contexts(contexts, existing=None) -> list:
+    """模型给的来源 + 上下文的 source，原样拼成一个列表（不在这里规整，避免和 processor 重复做一遍）"""
+    if isinstance(existing, (str, dict)):
+        existing = [existing]
+    out = list(existing or [])
+    out.extend(c.get("source") for c in (contexts or []) if isinstance(c, dict) and c.get("source"))
+    return out
+
+
 class ExpenseAnalyzer:
     def __init__(self, api_key: str, base_url: str, model: str):
         # 兼容 OpenAI/DashScope Chat Completions
@@ -256,6 +275,16 @@ class ExpenseAnalyzer:
                 "confidence": min(0.98, 0.8 + rule_score/10.0),
             }
 
+        # 剩余预算不够一次 LLM 调用：按规则投票给结论（低置信，交给调用方仲裁）
+        if not has_budget(LLM_STAGE_MIN_S):
+            mark_degraded("llm_decision")
+            return {
+                "expense_type": rule_exp if rule_score >= 1.0 else "UNKNOWN",
+                "account_subject": rule_acc if rule_score >= 1.0 else "UNKNOWN",
+                "evidence": [f"时间预算不足，规则投票: {', '.join(rule_hits)}"] if rule_hits else [],
+                "confidence": min(0.74, 0.5 + rule_score/10.0),
+            }
+
         # 3) 让 LLM 做语义判定（保留你原有 few-shot、SYSTEM 提示）
         invoice_info = invoice_data.get("invoice_info", {})
         now_date = invoice_data.get("now_date", "")
@@ -318,7 +347,7 @@ class ExpenseAnalyzer:
     def analyze_invoice_risk(self, invoice_data: Dict[str, Any], user_input: str, contexts=None) -> Dict[str, Any]:
         ret = self.generate_risk_analysis(invoice_data, contexts)
         ret = self._postfix_basis(ret, contexts)
-         # sources_used 只做轻度去重（最终在 processor 里再统一一次）
+        # sources_used 原样带回，标题/去重在 processor 收尾时统一解析
         ret["sources_used"] = _sources_from_contexts(contexts, ret.get("sources_used"))
         return ret
     
@@ -364,10 +393,7 @@ class ExpenseAnalyzer:
                 {"role": "user", "content": user},
             ],
         }
-        with httpx.Client(timeout=60) as client:
-            resp = client.post(url, headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
+        data = self._post_llm(url, headers, payload)
         try:
             return data["choices"][0]["message"]["content"]
         except Exception:
@@ -388,15 +414,30 @@ class ExpenseAnalyzer:
             "temperature": 0.2,
             "messages": messages,
         }
-        with httpx.Client(timeout=60) as client:
-            resp = client.post(url, headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
+        data = self._post_llm(url, headers, payload)
         try:
             return data["choices"][0]["message"]["content"]
         except Exception:
             return json.dumps({"error": "LLM response parse failed", "raw": data})
 
+    def _post_llm(self, url: str, headers: Dict[str, str], payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        熔断 + 请求截止时间；熔断打开时直接抛 CircuitOpenError，由 _safe_call 兜底。
+        同一 url + 完整 payload（模型、消息、参数）的请求在飞时合并成一次。
+        """
+        def _post(t):
+            with httpx.Client(timeout=t) as client:
+                return client.post(url, headers=headers, json=payload)
+
+        def _call():
+            resp = guarded_call("llm", _post, timeout=LLM_TIMEOUT,
+                                is_failure=lambda r: r.status_code >= 500 or r.status_code == 429)
+            if resp.status_code >= 400:
+                UPSTREAM_ERRORS.inc(dependency="llm", code=str(resp.status_code))
+            resp.raise_for_status()
+            return resp.json()
+        return LLM_FLIGHT.do(content_key(url, payload), _call)
+
     @staticmethod
     def _safe_json(text: str, fallback: Dict[str, Any]) -> Dict[str, Any]:
         try:
@@ -600,7 +641,7 @@ class ExpenseAnalyzer:
         # 验真 goodsData 名称
         try:
             vr = (inv.get("verify_result") or {}).get("data", {}) if isinstance(inv.get("verify_result"), dict) else {}
-            for g in (vr.get("goodsData") or []):
+            for g in (vr.get("goodsData") or inv.get("goodsData") or []):
                 name = str(g.get("name") or "").strip()
                 if name:
                     q_terms.append(f"goods:{name}")
@@ -641,8 +682,11 @@ class ExpenseAnalyzer:
         # 6) 第一次生成
         res = _call_once()
 
-        # 7) 自动重试（只用知识库、必须引用；提示模型优先在命中词附近找）
-        if not _looks_good(res):
+        # 7) 自动重试（只用知识库、必须引用；提示模型优先在命中词附近找）；预算不够就跳过重试
+        if not _looks_good(res) and not has_budget(LLM_STAGE_MIN_S):
+            mark_degraded("approval_retry")
+        elif not _looks_good(res):
+            RETRIES.inc(dependency="llm", reason="approval_no_citation")
             hint = (
                 "\n【复核提醒】你上次输出存在'无引用/数组为空'问题。"
                 "请仅在【知识库摘录】中检索'差旅/交通/审批阈值/报销时限/证据链/发票要素'等关键词邻近段落，"
@@ -671,37 +715,7 @@ class ExpenseAnalyzer:
             notes = [s.lstrip("•-·* ").strip() for s in notes.splitlines() if s.strip()]
         res["approval_notes"] = notes
 
-        # --- 统一 sources_used：只保留"标题字符串"，过滤 dict/字典样式字符串 ---
-        import ast
-        raw_sources = (res.get("sources_used") or []) + [c.get("source") for c in (contexts or []) if isinstance(c, dict) and c.get("source")]
-
-        clean_titles = []
-        for x in raw_sources:
-            title = None
-            if isinstance(x, dict):
-                title = x.get("title") or x.get("source") or x.get("doc") or x.get("name")
-            elif isinstance(x, str):
-                xs = x.strip()
-                # 尝试把 "{'title': '...', 'url': ''}" 解析回 dict
-                if xs.startswith("{") and xs.endswith("}"):
-                    try:
-                        obj = ast.literal_eval(xs)
-                        if isinstance(obj, dict):
-                            title = obj.get("title") or obj.get("source") or obj.get("doc") or obj.get("name")
-                    except Exception:
-                        pass
-                if title is None:
-                    title = xs
-            if title:
-                # 去掉路径/扩展名
-                base = title.rsplit("/", 1)[-1]
-                base = base.rsplit("\\", 1)[-1]
-                if "." in base:
-                    base = base.rsplit(".", 1)[0]
-                clean_titles.append(base)
-
-        # 去重
-        seen = set()
-        res["sources_used"] = [t for t in clean_titles if not (t in seen or seen.add(t))]
+        # --- sources_used：并上上下文来源；标题/URL/去重由 processor 按 KB 来源表一次解析 ---
+        res["sources_used"] = _sources_from_contexts(contexts, res.get("sources_used"))
 
         return res
@@ -0,0 +1,116 @@
+# image_preprocess.py — 发票照片本地预处理：EXIF 转正 → 可选裁边 → 缩放 → 按质量目标重编码
+# -*- coding: utf-8 -*-
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+from resilience import call_timeout, DeadlineExceeded
+
+try:  # Pillow 可选：没装就整段跳过，原图直送 OCR
+    from PIL import Image, ImageOps, ImageFilter
+except ImportError:  # pragma: no cover
+    Image = ImageOps = ImageFilter = None
+
+MAX_EDGE = int(os.getenv("OCR_IMG_MAX_EDGE", "2200"))                        # 长边上限（像素）
+QUALITY = int(os.getenv("OCR_IMG_QUALITY", "85"))                            # 初始 JPEG 质量
+MIN_QUALITY = int(os.getenv("OCR_IMG_MIN_QUALITY", "60"))                    # 质量下探底线
+TARGET_BYTES = int(os.getenv("OCR_IMG_TARGET_BYTES", str(3 * 1024 * 1024)))  # 重编码目标体积
+MIN_BYTES = int(os.getenv("OCR_IMG_MIN_BYTES", str(1024 * 1024)))            # 小于它不处理
+CROP = os.getenv("OCR_IMG_CROP", "0") == "1"                                 # 是否裁到票面区域
+WORKERS = int(os.getenv("OCR_PREPROC_WORKERS", "2"))
+TIMEOUT = float(os.getenv("OCR_PREPROC_TIMEOUT", "10"))
+
+
+def _crop_to_content(img):
+    """
+    票面（浅色纸张）通常比桌面背景亮：在缩略图上中值滤波去噪后取亮区外接框。
+    框太小（<30% 面积）或几乎就是整图时不裁。
+    """
+    w, h = img.size
+    scale = 400.0 / max(w, h)
+    small = img.convert("L").resize((max(1, int(w * scale)), max(1, int(h * scale))))
+    small = ImageOps.autocontrast(small).filter(ImageFilter.MedianFilter(5))
+    box = small.point(lambda p: 255 if p > 170 else 0).getbbox()
+    if not box:
+        return img, False
+    box = tuple(int(v / scale) for v in box)
+    bw, bh = box[2] - box[0], box[3] - box[1]
+    if bw * bh < 0.3 * w * h or (bw >= w * 0.95 and bh >= h * 0.95):
+        return img, False
+    pad_x, pad_y = int(w * 0.01), int(h * 0.01)
+    box = (max(0, box[0] - pad_x), max(0, box[1] - pad_y), min(w, box[2] + pad_x), min(h, box[3] + pad_y))
+    return img.crop(box), True
+
+
+def preprocess_image(data: bytes, max_edge: int = MAX_EDGE, quality: int = QUALITY,
+                     target_bytes: int = TARGET_BYTES, crop: bool = CROP) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    纯函数（可在子进程执行）：返回 (新字节, 统计信息)。
+    处理后反而更大且没有转正/裁边时，原样返回原图。
+    """
+    info: Dict[str, Any] = {"orig_bytes": len(data), "out_bytes": len(data), "rotated": False,
+                            "cropped": False, "resized": False, "quality": None}
+    img = Image.open(io.BytesIO(data))
+    info["orig_size"] = img.size
+    orientation = img.getexif().get(0x0112, 1)
+    img = ImageOps.exif_transpose(img)
+    info["rotated"] = orientation not in (None, 1)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    if crop:
+        img, info["cropped"] = _crop_to_content(img)
+
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        info["resized"] = True
+    info["out_size"] = img.size
+
+    q = quality
+    while True:
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=q, optimize=True)
+        if out.tell() <= target_bytes or q <= MIN_QUALITY:
+            break
+        q = max(MIN_QUALITY, q - 10)
+    info["quality"] = q
+
+    if out.tell() >= len(data) and not (info["rotated"] or info["cropped"]):
+        info["out_size"] = info["orig_size"]
+        return data, info
+    info["out_bytes"] = out.tell()
+    return out.getvalue(), info
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+def preprocess_in_pool(data, timeout: float = TIMEOUT) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    """
+    在进程池里做预处理（不占主进程 GIL）；小图/未装 Pillow/失败/超时一律原样返回，info=None。
+    等待受请求剩余预算约束：预算耗尽抛 DeadlineExceeded，不再原图送 OCR。
+    """
+    if Image is None or len(data) < MIN_BYTES:
+        return data, None
+    limit = call_timeout(timeout)
+    try:
+        fut = _get_pool().submit(preprocess_image, bytes(data))
+        return fut.result(timeout=limit)
+    except TimeoutError:
+        fut.cancel()
+        if limit < timeout:
+            raise DeadlineExceeded(f"img_preprocess: request budget exhausted after {limit:.2f}s")
+        return data, None
+    except Exception:
+        return data, None
@@ -1,12 +1,26 @@
 # invoice_extractor.py
+import io
+import re
 import json
 import base64
-import requests
 import os
 import time
-from typing import Dict, Any
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
 
-from baidu_vat_client import BaiduVatClient, load_ak_sk
+from baidu_vat_client import BaiduVatClient, load_ak_sk, get_token_manager
+from image_preprocess import preprocess_in_pool
+from qr_decoder import decode_image, decode_pdf_pages, parse_vat_qr
+from ofd_parser import read_ofd, ofd_money
+from einvoice_xml import parse_einvoice_xml
+from invoice_record import tax_rate_fields
+from ocr_backends import get_router, guess_kind
+from resilience import submit_in_context, DeadlineExceeded
+from singleflight import OCR_FLIGHT, content_key
+from metrics import span
+
+logger = logging.getLogger("invoice_extractor")
 
 # === 放在 import 后面，全局节流器（每次调用间隔 ≥ 120ms） ===
 import threading, time as _rt
@@ -23,36 +37,6 @@ def _throttle(interval=0.12):
         _last_call = _rt.monotonic()
 
 # === 统一税率/服务类型 ===
-def _norm_tax_rate(raw):
-    """把各种写法统一成 ('3%', 0.03) 这样的二元组"""
-    if raw is None:
-        return ("", None)
-    # 列表形式： [{'row':'1','word':'3%'}]
-    if isinstance(raw, list):
-        for x in raw:
-            if isinstance(x, dict) and x.get("word"):
-                s = x["word"].strip()
-                if s.endswith("%"):
-                    try:
-                        return (s, float(s.rstrip("%"))/100.0)
-                    except Exception:
-                        return (s, None)
-    # 单值
-    s = str(raw).strip()
-    if s.endswith("%"):
-        try:
-            return (s, float(s.rstrip("%"))/100.0)
-        except Exception:
-            return (s, None)
-    try:
-        v = float(s)
-        if v <= 1.0:   # 0.03 -> 3%
-            return (f"{v*100:.0f}%", v)
-        else:          # 3 -> 3%
-            return (f"{v:.0f}%", v/100.0)
-    except Exception:
-        return (s, None)
-
 def _first_word(arr):
     """从 [{'word': 'xxx'}] 里拿第一个 word"""
     if isinstance(arr, list) and arr:
@@ -101,21 +85,33 @@ EMPTY_OCR = {
 }
 
 
-def _wrap_ok(jr: dict) -> dict:
+def _words_results(jr: dict) -> list:
+    """words_result 可能是 dict（单票）或 list（多票，每项带 result）；统一拆成 list。"""
     wr = jr.get("words_result", {})
-    # 如果words_result是列表且不为空，取第一个元素的result
-    if isinstance(wr, list) and len(wr) > 0:
-        wr = wr[0].get("result", {})
-    elif isinstance(wr, dict) and "result" in wr:
-        wr = wr.get("result", {})
-    
+    if isinstance(wr, list):
+        return [(x.get("result", {}) if isinstance(x, dict) else {}) for x in wr] or [{}]
+    if isinstance(wr, dict) and "result" in wr:
+        return [wr.get("result", {})]
+    return [wr]
+
+
+def _wrap_ok(jr: dict) -> dict:
+    # 只取第一张（老接口语义）；多票请用 _wrap_ok_all
+    return _wrap_one(_words_results(jr)[0], jr)
+
+
+def _wrap_ok_all(jr: dict) -> list:
+    return [_wrap_one(wr, jr) for wr in _words_results(jr)]
+
+
+def _wrap_one(wr: dict, jr: dict) -> dict:
     # 先把 OCR 原始字段取出来
     commodity_name = _first_word(wr.get("CommodityName"))
     service_type_raw = wr.get("ServiceType") or wr.get("InvoiceKind") or "服务"
 
     # 税率优先用 CommodityTaxRate；没有再回退 TaxRate / tax_rate
     tax_src = wr.get("CommodityTaxRate") or wr.get("TaxRate") or wr.get("tax_rate")
-    tax_percent_str, tax_decimal = _norm_tax_rate(tax_src)
+    tax_percent_str, tax_decimal = tax_rate_fields(tax_src)
 
     invoice_data = {
         "invoice_number": wr.get("InvoiceNum","") or wr.get("InvoiceNumDigit",""),
@@ -176,37 +172,271 @@ def _wrap_err(jr: dict) -> dict:
     }
 
 
-def ocr_vat_from_bytes(file_bytes: bytes, filename: str) -> dict:
-    ak, sk = load_ak_sk()
-    client = BaiduVatClient(ak, sk)
+# === 进程级共享 OCR client：ak/sk 只解析一次，token 由 manager 常驻内存 ===
+_client_lock = threading.Lock()
+_shared_client = None
+
+def _get_shared_client() -> BaiduVatClient:
+    global _shared_client
+    if _shared_client is None:
+        with _client_lock:
+            if _shared_client is None:
+                ak, sk = load_ak_sk()
+                client = BaiduVatClient(ak, sk)
+                client.tokens.start()
+                _shared_client = client
+    return _shared_client
+
+
+def _ocr_raw(file_bytes, filename: str, client: BaiduVatClient = None, kind: str = None) -> dict:
+    client = client or _get_shared_client()
+    kind = guess_kind(filename, kind)
+    # ……你的代码前面解析了文件 bytes 和类型……
+    # 在这里加一刀软限速（全局锁，多线程并发时同样生效）
+    _throttle()
+
+    # 然后再调百度
+    if kind == "pdf":
+        return client.recognize(pdf_bytes=file_bytes)
+    elif kind == "ofd":
+        return client.recognize(ofd_bytes=file_bytes)
+    else:
+        return client.recognize(image_bytes=file_bytes)
+
+
+def ocr_vat_from_bytes(file_bytes: bytes, filename: str, client: BaiduVatClient = None, kind: str = None) -> dict:
+    """file_bytes 可为 bytes / memoryview（上传缓冲直通，不复制）；kind 缺省按文件名后缀判断。只取第一张票。"""
+    return ocr_vat_all_from_bytes(file_bytes, filename, client, kind)[0]
 
-    name = (filename or "").lower()
+
+def ocr_vat_all_from_bytes(file_bytes, filename: str, client: BaiduVatClient = None, kind: str = None) -> list:
+    """
+    一次识别出的多张票全部返回（每张一条）。
+    不指定 client 时走 OcrRouter（百度 / 本地按配额、延迟、类型选择）；指定 client 则直连百度。
+    同一文件内容的识别正在进行时（重复提交、前端重试、多人同票）不再重发，等在途那次的结果。
+    """
+    kind = guess_kind(filename, kind)
+    if client is None:
+        return OCR_FLIGHT.do(content_key(kind, file_bytes),
+                             lambda: get_router().recognize(file_bytes, filename, kind))
+    return OCR_FLIGHT.do(content_key("baidu", kind, file_bytes),
+                         lambda: baidu_ocr_all(file_bytes, filename, client, kind))
+
+
+def baidu_ocr_all(file_bytes, filename: str, client: BaiduVatClient = None, kind: str = None) -> list:
+    """百度增值税发票 OCR → 统一结果列表（OcrRouter 的百度后端）"""
     try:
-        # ……你的代码前面解析了文件 bytes 和类型……
-        # 在这里加一刀软限速
-        _throttle()
-
-        # 然后再调百度
-        if name.endswith(".pdf"):
-            jr = client.recognize(pdf_bytes=file_bytes)
-        elif name.endswith(".ofd"):
-            jr = client.recognize(ofd_bytes=file_bytes)
-        else:
-            jr = client.recognize(image_bytes=file_bytes)
+        jr = _ocr_raw(file_bytes, filename, client, kind)
 
         # 错误直接透传，不要"假装配额"
         if "__ocr_error__" in jr:
-            return {"invoice_info": {"__ocr_error__": jr["__ocr_error__"]},
-                    "raw_ocr": jr}
-
-        # 你原来处理 jr 的地方改成：
+            return [{"invoice_info": {"__ocr_error__": jr["__ocr_error__"]}, "raw_ocr": jr}]
         if "error_code" in jr:
-            return _wrap_err(jr)
-        else:
-            return _wrap_ok(jr)
-
+            return [_wrap_err(jr)]
+        return _wrap_ok_all(jr)
     except Exception as e:
-        return {"invoice_info": {"__ocr_error__": f"client_exception:{e}"}, "raw_ocr": {}}
+        return [{"invoice_info": {"__ocr_error__": f"client_exception:{e}"}, "raw_ocr": {}}]
+
+
+def ocr_text_from_bytes(file_bytes, filename: str, kind: str = None) -> str:
+    """
+    通用文字识别（行程单/订单截图等佐证材料，不是发票版式）：
+    和发票 OCR 共用后端选择（配额/冷却/熔断）、全局节流与 token；都失败返回空串。
+    """
+    kind = guess_kind(filename, kind)
+    if kind == "ofd":
+        return ""
+
+    def _run() -> str:
+        router = get_router()
+        for backend in router.choose(kind):
+            try:
+                if backend is router.baidu:
+                    _throttle()
+                    arg = "pdf_bytes" if kind == "pdf" else "image_bytes"
+                    jr = _get_shared_client().recognize_text(**{arg: file_bytes})
+                    if "__ocr_error__" in jr or "error_code" in jr:
+                        logger.warning("[OCR_TEXT] baidu general OCR failed: %s", jr.get("__ocr_error__") or jr.get("error_code"))
+                        continue
+                    return "\n".join(w.get("words", "") for w in jr.get("words_result") or [])
+                return "\n".join(backend.text(file_bytes, kind))
+            except Exception as e:
+                logger.warning("[OCR_TEXT] %s failed: %s", backend.name, e)
+        return ""
+    return OCR_FLIGHT.do(content_key("text", kind, file_bytes), _run)
+
+
+PDF_OCR_WORKERS = int(os.getenv("PDF_OCR_WORKERS", "4"))
+
+def split_pdf_pages(data) -> list:
+    """本地按页拆 PDF（PyPDF2，无网络）；单页/加密/解析失败时原样返回 [data]。"""
+    try:
+        from PyPDF2 import PdfReader, PdfWriter
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted and not reader.decrypt(""):
+            return [data]
+        if len(reader.pages) <= 1:
+            return [data]
+        pages = []
+        for page in reader.pages:
+            w = PdfWriter()
+            w.add_page(page)
+            buf = io.BytesIO()
+            w.write(buf)
+            pages.append(buf.getvalue())
+        return pages
+    except Exception:
+        return [data]
+
+
+# === 数电/全电 PDF 文本层快速通道：本地抽字 + 正则解析，不调 OCR ===
+PDF_TEXT_FASTPATH = os.getenv("PDF_TEXT_FASTPATH", "1") == "1"
+TEXT_REQUIRED_FIELDS = ("invoice_number", "invoice_date")   # 另需 amount_in_figures / total_amount 之一
+
+_MONEY = r"[¥￥]?\s*(-?[0-9][0-9,]*\.[0-9]{2})"
+_NAME_PAT = re.compile(r"名\s*称\s*[:：]\s*([^\n:：]+?)(?=\s{2,}|\n|$|统一社会|纳税人)")
+_TAXID_PAT = re.compile(r"(?:统一社会信用代码/纳税人识别号|纳税人识别号|统一社会信用代码)\s*[:：]\s*([0-9A-Z]{15,20})")
+_TOTAL_PAT = re.compile(r"合\s*计\s*" + _MONEY + r"\s*(?:[¥￥]?\s*(-?[0-9][0-9,]*\.[0-9]{2})|\*+)?")
+_INCL_PAT = re.compile(r"[（(]\s*小写\s*[)）]\s*" + _MONEY)
+_WORDS_PAT = re.compile(r"[（(]\s*大写\s*[)）]\s*[ⓧ⊗]?\s*([零壹贰叁肆伍陆柒捌玖拾佰仟万亿圆元角分整正]+)")
+_RATE_PAT = re.compile(r"(?<![0-9.])([0-9]{1,2}(?:\.[0-9]+)?%|免税|不征税)")
+_GOODS_PAT = re.compile(r"(\*[^*\s]{1,20}\*[^\s*]{1,40})")
+_TYPE_PAT = re.compile(r"(电子发票[（(][^)）]{2,8}[)）]|增值税电子(?:专用|普通)发票|增值税(?:专用|普通)发票)")
+_REMARK_PAT = re.compile(r"备\s*注\s*[:：]?\s*([^\n]{1,200})")
+
+def _money(s) -> str:
+    return (s or "").replace(",", "")
+
+def parse_invoice_text(text: str, qr_text: str = "") -> Dict[str, Any]:
+    """
+    把发票文本层（可附二维码串）解析成 EMPTY_OCR 字段。
+    号码/代码/日期/校验码复用 reimbursement_processor.parse_from_qr_and_ocr 的正则；
+    名称/税号/金额/税率等票面栏位用本地正则补齐。解析不到的字段留空。
+    """
+    from reimbursement_processor import parse_from_qr_and_ocr
+    base = parse_from_qr_and_ocr(qr_text or "", text or "")
+    info = dict(EMPTY_OCR)
+    info["invoice_number"] = base.get("fphm") or ""
+    info["invoice_code"] = base.get("fpdm") or ""
+    info["invoice_date"] = base.get("kprq") or ""
+    info["check_code"] = base.get("jym") or ""
+
+    names = [n.strip() for n in _NAME_PAT.findall(text or "")]
+    taxids = _TAXID_PAT.findall(text or "")
+    if names:
+        info["buyer_name"] = names[0]
+        info["seller_name"] = names[1] if len(names) > 1 else ""
+    if taxids:
+        info["buyer_register_num"] = taxids[0]
+        info["seller_register_num"] = taxids[1] if len(taxids) > 1 else ""
+
+    m = _TOTAL_PAT.search(text or "")
+    if m:
+        info["total_amount"] = _money(m.group(1))
+        info["total_tax"] = _money(m.group(2)) if m.group(2) else "0.00"   # *** 免税
+    elif base.get("je"):
+        # 二维码金额：数电票是价税合计，老版增值税票是不含税金额
+        info["amount_in_figures" if base.get("is_digital") else "total_amount"] = base["je"]
+    m = _INCL_PAT.search(text or "")
+    if m:
+        info["amount_in_figures"] = _money(m.group(1))
+    m = _WORDS_PAT.search(text or "")
+    if m:
+        info["amount_in_words"] = m.group(1)
+
+    m = _RATE_PAT.search(text or "")
+    info["tax_rate"], info["tax_rate_decimal"] = tax_rate_fields(m.group(1) if m else None)
+
+    m = _GOODS_PAT.search(text or "")
+    info["service_type_detail"] = m.group(1) if m else ""
+    m = _TYPE_PAT.search(text or "")
+    info["invoice_type"] = m.group(1) if m else ""
+    m = _REMARK_PAT.search(text or "")
+    info["remark"] = m.group(1).strip() if m else ""
+    info["service_type"] = _infer_service("服务", info["service_type_detail"], info["seller_name"])
+
+    info["raw_text"] = (text or "")[:4000]
+    if qr_text:
+        info["qr_raw"] = qr_text
+    return info
+
+def text_fields_complete(info: Dict[str, Any]) -> bool:
+    return all(info.get(k) for k in TEXT_REQUIRED_FIELDS) and bool(info.get("amount_in_figures") or info.get("total_amount"))
+
+# —— 二维码本地识别 —— #
+QR_DECODE = os.getenv("QR_DECODE", "1") == "1"        # OCR 前先本地解码发票二维码
+QR_SKIP_OCR = os.getenv("QR_SKIP_OCR", "1") == "1"    # 二维码要素齐全时直接跳过百度 OCR
+
+def merge_qr_fields(info: Dict[str, Any], qr_text: str) -> Dict[str, Any]:
+    """二维码带 CRC、比 OCR 可靠：号码/代码/日期/校验码以二维码为准，金额只补空。"""
+    q = parse_vat_qr(qr_text)
+    if not q:
+        return info
+    info["qr_raw"] = qr_text
+    for key, qk in (("invoice_number", "fphm"), ("invoice_code", "fpdm"),
+                    ("invoice_date", "kprq"), ("check_code", "jym")):
+        if q[qk]:
+            info[key] = q[qk]
+    amt_key = "amount_in_figures" if q["is_digital"] else "total_amount"
+    if q["je"] and not info.get(amt_key):
+        info[amt_key] = q["je"]
+    return info
+
+# —— 数电票 XML：开票数据逐字段映射，明细直接给出 goodsData（不必等验真） —— #
+def parse_xml_invoice(data) -> Dict[str, Any]:
+    """数电票 XML → EMPTY_OCR 字段 + goodsData；不是数电票 XML 返回 None"""
+    doc = parse_einvoice_xml(data)
+    if doc is None:
+        return None
+    info = dict(EMPTY_OCR)
+    info.update(doc["fields"])
+    goods = [{**g, "sl": tax_rate_fields(g["sl"])[0]} for g in doc["goodsData"]]
+    info["goodsData"] = goods
+    info["service_type_detail"] = goods[0]["name"] if goods else ""
+    rates = list(dict.fromkeys(g["sl"] for g in doc["goodsData"] if g["sl"]))
+    info["tax_rate"], info["tax_rate_decimal"] = tax_rate_fields(rates[0] if rates else None)
+    info["service_type"] = _infer_service("服务", " ".join(g["name"] for g in goods), info["seller_name"])
+    info["extract_route"] = "einvoice_xml"
+    return info
+
+# —— OFD 版式文件本地解析：发票标签 + 票面文字，不调 OCR；解析不全再回落百度 ofd_file —— #
+OFD_LOCAL = os.getenv("OFD_LOCAL", "1") == "1"
+
+def parse_ofd_invoice(data) -> Dict[str, Any]:
+    """
+    OFD → EMPTY_OCR 字段。票面文字先按文本层规则整体解析（税率/明细/票种等），
+    再用发票标签里的结构化值覆盖（号码/日期/金额/名称/税号更可靠）。不是 OFD 返回 None。
+    """
+    doc = read_ofd(data)
+    if doc is None:
+        return None
+    for att in doc["attachments"]:          # 附带的开票原始 XML 最权威，能解析就直接用
+        info = parse_xml_invoice(att)
+        if info:
+            info["extract_route"] = "ofd_attachment_xml"
+            return info
+    info = parse_invoice_text(doc["text"])
+    for key, val in doc["fields"].items():
+        if key in ("total_amount", "total_tax", "amount_in_figures"):
+            val = ofd_money(val) or ("0.00" if key == "total_tax" and "*" in val else "")   # *** 免税
+        elif key not in ("buyer_name", "seller_name", "remark", "invoice_date"):
+            val = re.sub(r"\s+", "", val)         # 号码/校验码/税号在票面上常按 5 位分组
+        if val:
+            info[key] = val
+    info["service_type"] = _infer_service("服务", info["service_type_detail"], info["seller_name"])
+    info["extract_route"] = "ofd_xml" if doc["fields"] else "ofd_text"
+    return info
+
+def pdf_page_texts(data) -> list:
+    """逐页抽取 PDF 文本层；扫描件/加密/解析失败返回空串列表。"""
+    try:
+        from PyPDF2 import PdfReader
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted and not reader.decrypt(""):
+            return []
+        return [(pg.extract_text() or "") for pg in reader.pages]
+    except Exception:
+        return []
 
 
 class InvoiceExtractor:
@@ -214,27 +444,40 @@ class InvoiceExtractor:
         self.api_key = api_key
         self.secret_key = secret_key
         self.access_token = access_token or self._get_access_token()
+        # 图片预处理累计收益（张数 / 原始字节 / 送 OCR 字节）
+        self.preprocess_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0}
+        self._stats_lock = threading.Lock()
     
     def _get_access_token(self) -> str:
         """
-        获取百度OCR的access_token
+        获取百度OCR的access_token（走进程级 token manager，不再每次 OAuth）
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        params = {
-            "grant_type": "client_credentials",
-            "client_id": self.api_key,
-            "client_secret": self.secret_key
-        }
-        
-        response = requests.post(url, params=params)
-        result = response.json()
-        return result.get("access_token")
+        if not (self.api_key and self.secret_key):
+            return None
+        try:
+            return get_token_manager(self.api_key, self.secret_key).start().get()
+        except Exception:
+            return None
     
+    def _preprocess_image(self, image_data):
+        """送 OCR 前缩放/重编码/转正（进程池），并记录省下的字节数"""
+        with span("img_preprocess"):
+            data, info = preprocess_in_pool(image_data)
+        if info:
+            with self._stats_lock:
+                self.preprocess_stats["images"] += 1
+                self.preprocess_stats["bytes_in"] += info["orig_bytes"]
+                self.preprocess_stats["bytes_out"] += info["out_bytes"]
+            logger.debug("[IMG_PREPROCESS] %sB -> %sB size=%s->%s q=%s rotated=%s cropped=%s",
+                         info["orig_bytes"], info["out_bytes"], info.get("orig_size"), info.get("out_size"),
+                         info["quality"], info["rotated"], info["cropped"])
+        return data
+
     def _log_quota_hint(self, ocr):
         try:
             ec = str(ocr.get("error_code"))
             em = ocr.get("error_msg", "")
-            print(f"[BAIDU_OCR_ERR] code={ec} msg={em} ak_tail={self.api_key[-4:]} tz=UTC+8_reset@00:00")
+            logger.warning("[BAIDU_OCR_ERR] code=%s msg=%s ak_tail=%s tz=UTC+8_reset@00:00", ec, em, self.api_key[-4:])
         except Exception:
             pass
     
@@ -244,9 +487,9 @@ class InvoiceExtractor:
             path = "/tmp/last_ocr_error.json"
             with open(path, "w", encoding="utf-8") as f:
                 json.dump(payload, f, ensure_ascii=False, indent=2)
-            print(f"[BAIDU_OCR_ERR_DUMP] saved -> {path}")
+            logger.info("[BAIDU_OCR_ERR_DUMP] saved -> %s", path)
         except Exception as e:
-            print(f"[BAIDU_OCR_ERR_DUMP] failed: {e}")
+            logger.warning("[BAIDU_OCR_ERR_DUMP] failed: %s", e)
 
     def _safe_json(self, resp) -> dict:
         """无论返回是不是 JSON，都尽量还原；同时打印关键信息。"""
@@ -260,7 +503,8 @@ class InvoiceExtractor:
         msg  = data.get("error_msg")
         log  = data.get("log_id")
         ts   = data.get("timestamp")
-        print(f"[BAIDU_OCR_HTTP] status={resp.status_code} code={code} msg={msg} log_id={log} ts={ts}")
+        logger.log(logging.WARNING if code else logging.DEBUG,
+                   "[BAIDU_OCR_HTTP] status=%s code=%s msg=%s log_id=%s ts=%s", resp.status_code, code, msg, log, ts)
         return data
 
     def extract_from_image(self, image_path: str) -> Dict[str, Any]:
@@ -271,27 +515,32 @@ class InvoiceExtractor:
         with open(image_path, 'rb') as f:
             image_data = f.read()
         
-        # 使用新的OCR方法
-        result = ocr_vat_from_bytes(image_data, image_path)
-        if "__ocr_error__" in result["invoice_info"]:
-            return {**EMPTY_OCR, "__ocr_error__": result["invoice_info"]["__ocr_error__"]}
-        
-        invoice_info = result["invoice_info"]
-        # 补充缺失的字段
-        return self._fill_missing_fields(invoice_info)
+        # OFD 也走这里（按后缀/魔数识别），只有真图片才解码二维码/预处理
+        if image_path.lower().endswith(".ofd") or image_data[:4] == b"PK\x03\x04":
+            return self._extract_ofd(image_data, image_path)
+        return self._extract_image(image_data, image_path)
 
     def extract_from_image_data(self, image_data: bytes) -> Dict[str, Any]:
         """
         从图片数据中提取发票信息
         """
-        # 使用新的OCR方法
-        result = ocr_vat_from_bytes(image_data, "image.jpg")
-        if "__ocr_error__" in result["invoice_info"]:
-            return {**EMPTY_OCR, "__ocr_error__": result["invoice_info"]["__ocr_error__"]}
-        
-        invoice_info = result["invoice_info"]
-        # 补充缺失的字段
-        return self._fill_missing_fields(invoice_info)
+        return self._extract_image(image_data, "image.jpg")
+    
+    def extract_from_ofd(self, ofd_path: str) -> Dict[str, Any]:
+        """
+        从OFD中提取发票信息
+        """
+        with open(ofd_path, 'rb') as f:
+            ofd_data = f.read()
+        return self._extract_ofd(ofd_data, ofd_path)
+    
+    def extract_from_xml(self, xml_path: str) -> Dict[str, Any]:
+        """
+        从数电发票XML中提取发票信息
+        """
+        with open(xml_path, 'rb') as f:
+            xml_data = f.read()
+        return self._extract_xml(xml_data, xml_path)
     
     def extract_from_pdf(self, pdf_path: str) -> Dict[str, Any]:
         """
@@ -301,28 +550,171 @@ class InvoiceExtractor:
         with open(pdf_path, 'rb') as f:
             pdf_data = f.read()
         
-        # 使用新的OCR方法
-        result = ocr_vat_from_bytes(pdf_data, pdf_path)
-        if "__ocr_error__" in result["invoice_info"]:
-            return {**EMPTY_OCR, "__ocr_error__": result["invoice_info"]["__ocr_error__"]}
-        
-        invoice_info = result["invoice_info"]
-        # 补充缺失的字段
-        return self._fill_missing_fields(invoice_info)
+        return self._extract_pdf_single(pdf_data, pdf_path)
     
     def extract_from_pdf_data(self, pdf_data: bytes) -> Dict[str, Any]:
         """
         从PDF数据中提取发票信息
         """
-        # 使用新的OCR方法
-        result = ocr_vat_from_bytes(pdf_data, "document.pdf")
+        return self._extract_pdf_single(pdf_data, "document.pdf")
+    
+    def _extract_from_text_layer(self, text: str) -> Dict[str, Any]:
+        """文本层解析；必需字段不全返回 None，由调用方回落百度 OCR"""
+        if not PDF_TEXT_FASTPATH or len((text or "").strip()) < 20:
+            return None
+        info = parse_invoice_text(text)
+        if not text_fields_complete(info):
+            return None
+        info["extract_route"] = "pdf_text"
+        return self._fill_missing_fields(info)
+    
+    def _extract_from_qr(self, qr_text: str, text: str = "") -> Dict[str, Any]:
+        """二维码（+ 可选文本层）凑齐验真要素就不调 OCR；不全返回 None"""
+        if not (QR_SKIP_OCR and parse_vat_qr(qr_text)):
+            return None
+        info = parse_invoice_text(text, qr_text)
+        if not text_fields_complete(info):
+            return None
+        info["extract_route"] = "pdf_text+qr" if (text or "").strip() else "qr"
+        return self._fill_missing_fields(info)
+    
+    def _extract_xml(self, data, filename: str) -> Dict[str, Any]:
+        # XML 没有版面可供 OCR：解析不出或要素不全直接报错，不回落百度
+        with span("xml_parse"):
+            info = parse_xml_invoice(data)
+        if info and text_fields_complete(info):
+            return self._fill_missing_fields(info)
+        logger.warning("[XML] 不是数电发票 XML 或要素不全: %s", filename)
+        return {**EMPTY_OCR, "__ocr_error__": "xml_invalid:不是数电发票 XML 或缺少号码/日期/金额"}
+    
+    def _extract_ofd(self, data, filename: str) -> Dict[str, Any]:
+        # 本地读 ZIP/XML（毫秒级、零配额）；要素不全或不是合法 OFD 才交给百度 ofd_file
+        with span("ofd_parse"):
+            info = parse_ofd_invoice(data) if OFD_LOCAL else None
+        if info and text_fields_complete(info):
+            return self._fill_missing_fields(info)
+        logger.info("[OFD] 本地解析要素不全，回落百度 OCR: %s", filename)
+        return self._extract_ocr(data, filename, kind="ofd")
+    
+    def _extract_ocr(self, data, filename: str, kind: str = None, qr_text: str = None) -> Dict[str, Any]:
+        result = ocr_vat_from_bytes(data, filename, kind=kind)
         if "__ocr_error__" in result["invoice_info"]:
             return {**EMPTY_OCR, "__ocr_error__": result["invoice_info"]["__ocr_error__"]}
         
         invoice_info = result["invoice_info"]
+        if qr_text:
+            invoice_info = merge_qr_fields(invoice_info, qr_text)
         # 补充缺失的字段
         return self._fill_missing_fields(invoice_info)
     
+    def _extract_image(self, image_data, filename: str) -> Dict[str, Any]:
+        # 先解二维码（在缩到 QR_MAX_EDGE 以内的灰度副本上，只解一次）；要素齐全直接返回，省掉预处理和 OCR
+        with span("qr_decode"):
+            qr_text = decode_image(image_data) if QR_DECODE else None
+        if qr_text:
+            local = self._extract_from_qr(qr_text)
+            if local:
+                logger.debug("[QR] 本地二维码解码命中，跳过 OCR: %s", filename)
+                return local
+        try:
+            image_data = self._preprocess_image(image_data)
+        except DeadlineExceeded as e:
+            return {**EMPTY_OCR, "__ocr_error__": f"{type(e).__name__}:{e}"}
+        return self._extract_ocr(image_data, filename, qr_text=qr_text)
+    
+    def _extract_pdf_single(self, pdf_data, filename: str) -> Dict[str, Any]:
+        # 先走本地文本层（数电票毫秒级），再试页内二维码，都不全再调百度
+        with span("pdf_text"):
+            texts = pdf_page_texts(pdf_data) if PDF_TEXT_FASTPATH else []
+        if texts:
+            local = self._extract_from_text_layer(texts[0])
+            if local:
+                return local
+        with span("qr_decode"):
+            qrs = decode_pdf_pages(pdf_data, max_pages=1) if QR_DECODE else []
+        qr_text = qrs[0] if qrs else None
+        if qr_text:
+            local = self._extract_from_qr(qr_text, texts[0] if texts else "")
+            if local:
+                return local
+        
+        # 使用新的OCR方法
+        return self._extract_ocr(pdf_data, filename, kind="pdf", qr_text=qr_text)
+    
+    def extract_from_bytes(self, data, filename: str = "", file_type: str = "image") -> Dict[str, Any]:
+        """
+        直接从内存数据（bytes / memoryview）提取发票信息，不经临时文件
+        """
+        kind = file_type if file_type in ("pdf", "ofd", "xml") else None
+        if kind == "pdf" or (kind is None and (filename or "").lower().endswith(".pdf")):
+            return self._extract_pdf_single(data, filename)
+        if kind == "xml" or (kind is None and (filename or "").lower().endswith(".xml")):
+            return self._extract_xml(data, filename)
+        if kind == "ofd" or (filename or "").lower().endswith(".ofd"):
+            return self._extract_ofd(data, filename)
+        return self._extract_image(data, filename)
+    
+    def extract_all_from_bytes(self, data, filename: str = "", file_type: str = "image") -> List[Dict[str, Any]]:
+        """
+        一份文件里可能有多张票（多页 PDF 每页一张 / 一页多张）：
+        逐页先走本地文本层，解析不全的页再本地拆分、并发 OCR；每张票各返回一条 invoice_info。
+        全部失败时返回一条带 __ocr_error__ 的记录。
+        """
+        is_pdf = file_type == "pdf" or (filename or "").lower().endswith(".pdf")
+        if not is_pdf:
+            return [self.extract_from_bytes(data, filename, file_type=file_type)]
+
+        with span("pdf_text"):
+            texts = pdf_page_texts(data) if PDF_TEXT_FASTPATH else []
+        local = [self._extract_from_text_layer(t) for t in texts]
+        if local and all(local):
+            if len(local) > 1:
+                for page_no, info in enumerate(local, start=1):
+                    info["page_no"] = page_no
+            return local
+
+        pages = split_pdf_pages(data)
+        if len(local) != len(pages):
+            local = [None] * len(pages)
+        # 文本层不全的页再试二维码
+        todo = [i for i, x in enumerate(local) if not x]
+        with span("qr_decode"):
+            qrs = decode_pdf_pages(data, max_pages=len(pages), only=set(todo)) if QR_DECODE else []
+        qrs += [None] * (len(pages) - len(qrs))
+        for i in todo:
+            if qrs[i]:
+                local[i] = self._extract_from_qr(qrs[i], texts[i] if i < len(texts) else "")
+        todo = [i for i, x in enumerate(local) if not x]
+        ocr = lambda i: ocr_vat_all_from_bytes(pages[i], filename, kind="pdf")
+        if not todo:
+            groups = {}
+        elif len(todo) == 1:
+            groups = {todo[0]: ocr(todo[0])}
+        else:
+            with ThreadPoolExecutor(max_workers=min(PDF_OCR_WORKERS, len(todo))) as ex:
+                groups = {i: f.result() for i, f in [(i, submit_in_context(ex, ocr, i)) for i in todo]}
+
+        out, first_err = [], None
+        for idx in range(len(pages)):
+            if local[idx]:
+                results = [{"invoice_info": local[idx]}]
+            else:
+                results = groups.get(idx, [])
+            for r in results:
+                info = r["invoice_info"]
+                if "__ocr_error__" in info:
+                    first_err = first_err or info["__ocr_error__"]
+                    continue
+                if qrs[idx] and not local[idx] and len(results) == 1:
+                    info = merge_qr_fields(info, qrs[idx])
+                info = self._fill_missing_fields(info)
+                if len(pages) > 1:
+                    info["page_no"] = idx + 1
+                out.append(info)
+        if not out:
+            return [{**EMPTY_OCR, "__ocr_error__": first_err or "no_invoice_found"}]
+        return out
+    
     def _fill_missing_fields(self, invoice_info: Dict[str, Any]) -> Dict[str, Any]:
         """
         补充缺失的字段以匹配EMPTY_OCR结构
@@ -348,7 +740,7 @@ class InvoiceExtractor:
         
         Args:
             file_path: 文件路径
-            file_type: 文件类型 ('image' 或 'pdf')
+            file_type: 文件类型 ('image' / 'pdf' / 'ofd' / 'xml')
             
         Returns:
             提取的发票信息字典
@@ -357,6 +749,10 @@ class InvoiceExtractor:
             return self.extract_from_image(file_path)
         elif file_type == 'pdf':
             return self.extract_from_pdf(file_path)
+        elif file_type == 'ofd':
+            return self.extract_from_ofd(file_path)
+        elif file_type == 'xml':
+            return self.extract_from_xml(file_path)
         else:
             # 默认使用图片提取方法
             return self.extract_from_image(file_path)
\ No newline at end of file
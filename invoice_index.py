@@ -0,0 +1,216 @@
+# invoice_index.py — 历史发票去重索引（sqlite 本地持久化，跨进程重启、跨请求）
+# -*- coding: utf-8 -*-
+"""
+三张“表”都走 B-tree 索引，百万行量级下查一次仍是 O(log n)、亚毫秒：
+- invoices.inv_key（唯一）：数电票 = 20 位号码；其余 = 代码:号码  → 精确重复
+- invoices(seller, date, amount_cents)：销方税号 + 开票日期 + 价税合计 → 翻拍/号码识别错的疑似重复
+- contents.hash：上传文件内容哈希 → 同一文件再次上传时在 OCR 之前就命中，直接复用上次的识别结果
+- phashes：照片感知哈希 → 内容哈希，只做持久化，启动时灌进 near_dup 的 BK 树（汉明距离检索在内存里做）
+
+INVOICE_INDEX_DB 指定库文件（生产放持久盘，缺省在 /tmp 下）；设为空串关闭。
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import functools
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from invoice_validator import calendar_date, money
+
+logger = logging.getLogger("invoice_index")
+
+INVOICE_INDEX_DB = os.getenv("INVOICE_INDEX_DB", "/tmp/reimburse_index/invoice_index.sqlite3")   # 运行期数据，不写进源码目录
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id           INTEGER PRIMARY KEY,
+    inv_key      TEXT NOT NULL UNIQUE,
+    code         TEXT,
+    number       TEXT NOT NULL,
+    seller       TEXT,
+    date         TEXT,
+    amount_cents INTEGER,
+    filename     TEXT,
+    first_seen   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_invoices_fuzzy ON invoices(seller, date, amount_cents);
+CREATE TABLE IF NOT EXISTS contents (
+    hash       TEXT PRIMARY KEY,
+    invoices   TEXT NOT NULL,
+    first_seen REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS phashes (
+    phash        TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    filename     TEXT,
+    first_seen   REAL NOT NULL
+);
+"""
+
+
+# —— 键规整 —— #
+def invoice_key(inv: Dict[str, Any]) -> Optional[str]:
+    """数电票只看 20 位号码（代码为空或被误识别都不影响）；其余看 代码:号码"""
+    number = "".join(ch for ch in str(inv.get("invoice_number") or "") if ch.isdigit())
+    if not number:
+        return None
+    if len(number) == 20:
+        return number
+    code = "".join(ch for ch in str(inv.get("invoice_code") or "") if ch.isdigit())
+    return f"{code}:{number}"
+
+
+def fuzzy_key(inv: Dict[str, Any]):
+    """(销方税号, YYYY-MM-DD, 价税合计分)；缺任一项返回 None"""
+    seller = str(inv.get("seller_register_num") or "").strip().upper()
+    d = calendar_date(inv.get("invoice_date"))
+    amt = money(inv.get("amount_in_figures"))
+    if not seller or d is None or amt is None:
+        return None
+    return seller, d.isoformat(), int((amt * 100).to_integral_value())
+
+
+def _storable(inv: Dict[str, Any]) -> Dict[str, Any]:
+    """内容索引里只存识别出的要素；__ocr_raw__ 等诊断字段不落库"""
+    return {k: (str(v) if isinstance(v, Decimal) else v) for k, v in inv.items() if not k.startswith("__")}
+
+
+def _soft(fn):
+    """索引只是辅助：库损坏/锁超时等 sqlite 错误只告警，当作未命中，不影响主流程"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except sqlite3.Error as e:
+            logger.warning("invoice index %s failed: %s", fn.__name__, e)
+            return None
+    return wrapper
+
+
+class InvoiceIndex:
+    """单连接 + 锁：sqlite 单次查询微秒级，串行化足够，且避免多连接写锁竞争"""
+    def __init__(self, path: str):
+        self.path = path
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    # —— 上传内容 —— #
+    @_soft
+    def lookup_content(self, content_hash: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            row = self._conn.execute("SELECT invoices FROM contents WHERE hash = ?", (content_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @_soft
+    def remember_content(self, content_hash: str, invoices: List[Dict[str, Any]]) -> None:
+        """只记完整识别成功的文件（每张都有号码、没有 OCR 错误），否则下次还应重新识别"""
+        if not invoices or any(inv.get("__ocr_error__") or not inv.get("invoice_number") for inv in invoices):
+            return
+        blob = json.dumps([_storable(inv) for inv in invoices], ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO contents(hash, invoices, first_seen) VALUES (?, ?, ?)",
+                               (content_hash, blob, time.time()))
+
+    @_soft
+    def has_content(self, content_hash: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM contents WHERE hash = ?", (content_hash,)).fetchone() is not None
+
+    # —— 感知哈希 —— #
+    @_soft
+    def add_phash(self, phash: int, content_hash: str, filename: str = "") -> None:
+        with self._lock:
+            self._conn.execute("INSERT INTO phashes(phash, content_hash, filename, first_seen) VALUES (?, ?, ?, ?)",
+                               (f"{phash:016x}", content_hash, filename or "", time.time()))
+
+    @_soft
+    def load_phashes(self) -> List[tuple]:
+        """[(phash:int, content_hash, filename, first_seen), ...]"""
+        with self._lock:
+            rows = self._conn.execute("SELECT phash, content_hash, filename, first_seen FROM phashes").fetchall()
+        return [(int(h, 16), ch, fn, ts) for h, ch, fn, ts in rows]
+
+    # —— 发票要素 —— #
+    @_soft
+    def check_and_record(self, inv: Dict[str, Any], filename: str = "",
+                         registered: Optional[List[tuple]] = None) -> Optional[Dict[str, Any]]:
+        """
+        查重并登记（同一事务内，不会和自己撞）。
+        返回 None 表示首次出现；否则 {"match": "exact"/"fuzzy", "first_seen", "filename", "invoice_number"}。
+        registered 不为 None 时，本次新登记的行 (inv_key, first_seen) 追加进去，流程失败时交给 forget 撤销。
+        """
+        key = invoice_key(inv)
+        if key is None:
+            return None
+        fk = fuzzy_key(inv)
+        seller, date, cents = fk if fk else (None, None, None)
+        number = key if ":" not in key else key.split(":", 1)[1]
+        code = None if ":" not in key else key.split(":", 1)[0]
+        with self._lock:
+            c = self._conn
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                row = c.execute("SELECT number, filename, first_seen FROM invoices WHERE inv_key = ?",
+                                (key,)).fetchone()
+                match = "exact" if row else None
+                if row is None and fk:
+                    row = c.execute("SELECT number, filename, first_seen FROM invoices "
+                                    "WHERE seller = ? AND date = ? AND amount_cents = ? LIMIT 1",
+                                    (seller, date, cents)).fetchone()
+                    match = "fuzzy" if row else None
+                if match != "exact":
+                    now = time.time()
+                    cur = c.execute("INSERT OR IGNORE INTO invoices(inv_key, code, number, seller, date, amount_cents, "
+                                    "filename, first_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (key, code, number, seller, date, cents, filename or "", now))
+                    if registered is not None and cur.rowcount:
+                        registered.append((key, now))
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return {"match": match, "invoice_number": row[0], "filename": row[1],
+                "first_seen": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[2]))}
+
+    @_soft
+    def forget(self, registered: List[tuple]) -> None:
+        """撤销 check_and_record 登记的行（只删那一次插入的，不碰更早的记录）"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM invoices WHERE inv_key = ? AND first_seen = ?", registered)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_index: Optional[InvoiceIndex] = None
+_index_failed = False
+_index_lock = threading.Lock()
+
+
+def get_index() -> Optional[InvoiceIndex]:
+    """进程内单例；未配置或打不开库（只读盘等）时返回 None，调用方跳过去重"""
+    global _index, _index_failed
+    if not INVOICE_INDEX_DB or _index_failed:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None and not _index_failed:
+                try:
+                    _index = InvoiceIndex(INVOICE_INDEX_DB)
+                except (OSError, sqlite3.Error) as e:
+                    _index_failed = True     # 只告警一次
+                    logger.warning("invoice index unavailable (%s): %s", INVOICE_INDEX_DB, e)
+    return _index
@@ -0,0 +1,174 @@
+# invoice_record.py — 发票要素的规整记录：提取后只解析一次，验真入参 / 硬规则风控 / 回写 invoice_info 都从它取
+# -*- coding: utf-8 -*-
+"""
+invoice_info 是提取器给的原样字符串（"2025年01月02日"、"¥1,060.00"、[{"word": "6%"}]…），
+以前验真、风控、佐证比对、prompt 各自再解析一遍。现在提取后建一次 InvoiceRecord：
+- 号码/代码/校验码：纯数字串（invoice_validator.digits，纠正形近字母）
+- date：datetime.date（invoice_validator.calendar_date，日历上不存在的日期为 None）
+- excl/tax/incl：分位 Decimal（invoice_validator.money），缺一项由另两项精确推出
+- rate：小数形式的 Decimal（0.06）；免税/不征税为 0
+apply_to() 把规整值写回 invoice_info（两位小数字符串、YYYY-MM-DD、"6%"），前端、prompt、去重索引看到的都是同一份。
+"""
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, Optional, Set, Tuple
+
+from invoice_validator import CENT, calendar_date, digits, money
+
+_TAX_FREE = ("免税", "不征税", "免征", "***")
+
+
+# —— 单字段 —— #
+def cents(v: Optional[Decimal]) -> Optional[Decimal]:
+    return v.quantize(CENT, rounding=ROUND_HALF_UP) if v is not None else None
+
+
+def money_text(x: Any) -> str:
+    """金额 → 两位小数字符串（验真接口/前端的写法）；非数字返回空串"""
+    v = cents(money(x))
+    return str(v) if v is not None else ""
+
+
+def iso_date(s: Any) -> str:
+    """2025年1月2日 / 20250102 / 2025/01/02 → 2025-01-02；不是有效日期原样返回"""
+    d = calendar_date(s)
+    return d.isoformat() if d else str(s or "").strip()
+
+
+def _rate_word(raw: Any) -> str:
+    """OCR 的 [{"row": "1", "word": "6%"}] 取第一个非空 word；其余转字符串"""
+    if isinstance(raw, list):
+        return next((str(x.get("word")).strip() for x in raw if isinstance(x, dict) and x.get("word")), "")
+    return "" if raw is None else str(raw).strip()
+
+
+def parse_tax_rate(raw: Any) -> Optional[Decimal]:
+    """6% / 0.06 / 6 / [{"word": "6%"}] → Decimal("0.06")；免税/不征税 → 0；认不出返回 None"""
+    s = _rate_word(raw)
+    if not s:
+        return None
+    if any(w in s for w in _TAX_FREE):
+        return Decimal(0)
+    v = money(s.rstrip("%"))
+    if v is None or v < 0:
+        return None
+    return v / 100 if s.endswith("%") or v >= 1 else v
+
+
+def percent_text(rate: Decimal) -> str:
+    return f"{(rate * 100).normalize():f}%"
+
+
+def _rate(raw: Any) -> Tuple[str, Optional[Decimal]]:
+    """(展示写法, Decimal 税率)：免税/不征税保留原字；认不出时原样文字 + None"""
+    s = _rate_word(raw)
+    rate = parse_tax_rate(s)
+    if rate is None:
+        return s, None
+    return (s if any(w in s for w in _TAX_FREE) else percent_text(rate)), rate
+
+
+def tax_rate_fields(raw: Any) -> Tuple[str, Optional[float]]:
+    """提取器填 tax_rate / tax_rate_decimal 用：('6%', 0.06)"""
+    text, rate = _rate(raw)
+    return text, float(rate) if rate is not None else None
+
+
+# —— 整张发票 —— #
+class InvoiceRecord:
+    __slots__ = ("number", "code", "check_code", "date", "excl", "tax", "incl", "rate", "rate_text", "derived")
+
+    def __init__(self, number: str = "", code: str = "", check_code: str = "", date: Optional[date] = None,
+                 excl: Optional[Decimal] = None, tax: Optional[Decimal] = None, incl: Optional[Decimal] = None,
+                 rate: Optional[Decimal] = None, rate_text: str = ""):
+        self.number = number
+        self.code = code
+        self.check_code = check_code
+        self.date = date
+        self.excl = cents(excl)
+        self.tax = cents(tax)
+        self.incl = cents(incl)
+        self.rate = rate
+        self.rate_text = rate_text
+        self.derived: Set[str] = set()    # 推算（而不是票面/验真读到）的金额槽，验真数据可以覆盖
+        self._derive()
+
+    @classmethod
+    def from_invoice(cls, inv: Dict[str, Any]) -> "InvoiceRecord":
+        """提取器给的 invoice_info（任意原样写法）→ 规整记录"""
+        text, rate = _rate(inv.get("tax_rate"))
+        return cls(number=digits(inv.get("invoice_number")),
+                   code=digits(inv.get("invoice_code")),
+                   check_code=digits(inv.get("check_code")),
+                   date=calendar_date(inv.get("invoice_date")),
+                   excl=money(inv.get("amount_excl_tax") or inv.get("total_amount")),
+                   tax=money(inv.get("total_tax")),
+                   incl=money(inv.get("amount_in_figures")),
+                   rate=rate,
+                   rate_text=text)
+
+    def _derive(self) -> None:
+        """
+        不含税 / 税额 / 价税合计三者互推（只补缺的，分位精确）。缺的税额不当 0：
+        非数电票二维码只带不含税金额，不知道税率时税额、价税合计留空，等验真回填。
+        """
+        if self.tax is None and self.rate is not None:
+            if self.excl is not None and self.incl is None:
+                self._set_derived("tax", cents(self.excl * self.rate))
+            elif self.incl is not None and self.excl is None:
+                self._set_derived("excl", cents(self.incl / (1 + self.rate)))
+        if self.incl is None and self.excl is not None and self.tax is not None:
+            self._set_derived("incl", self.excl + self.tax)
+        if self.tax is None and self.incl is not None and self.excl is not None:
+            self._set_derived("tax", self.incl - self.excl)
+        if self.excl is None and self.incl is not None and self.tax is not None:
+            self._set_derived("excl", self.incl - self.tax)
+
+    def _set_derived(self, slot: str, value: Decimal) -> None:
+        setattr(self, slot, value)
+        self.derived.add(slot)
+
+    def fill_from_verify(self, vdata: Dict[str, Any]) -> None:
+        """验真返回的金额（sumamount/goodsamount/taxamount）补缺失项，并覆盖此前推算出的值；票面读到的不动"""
+        got = {slot: cents(money(vdata.get(key)))
+               for slot, key in (("incl", "sumamount"), ("excl", "goodsamount"), ("tax", "taxamount"))}
+        for slot, v in got.items():
+            if v is not None and (getattr(self, slot) is None or slot in self.derived):
+                setattr(self, slot, v)
+                self.derived.discard(slot)
+        # 其余推算值按新数据重推（例如验真只给了价税合计时的税额）
+        for slot in [s for s in self.derived if got.get(s) is None]:
+            setattr(self, slot, None)
+            self.derived.discard(slot)
+        self._derive()
+
+    def amounts_consistent(self) -> bool:
+        """不含税 + 税额 与 价税合计 相差不超过 1 分；缺任一项视为无从判断"""
+        if self.excl is None or self.tax is None or self.incl is None:
+            return True
+        return abs(self.excl + self.tax - self.incl) <= CENT
+
+    def verify_payload(self) -> Dict[str, str]:
+        """验真入参（repair_verify_payload 之前的原始要素）；缺的要素不带键"""
+        p = {"fpdm": self.code, "fphm": self.number,
+             "kprq": self.date.isoformat() if self.date else "",
+             "noTaxAmount": str(self.excl) if self.excl is not None else "",
+             "jshj": str(self.incl) if self.incl else "",
+             "jym": self.check_code,
+             "total_tax": str(self.tax) if self.tax is not None else ""}
+        return {k: v for k, v in p.items() if v}
+
+    def apply_to(self, inv: Dict[str, Any]) -> Dict[str, Any]:
+        """规整值写回 invoice_info；解析不了的字段保留原样，不拿空值覆盖"""
+        for key, v in (("invoice_number", self.number), ("invoice_code", self.code), ("check_code", self.check_code)):
+            if v:
+                inv[key] = v
+        if self.date:
+            inv["invoice_date"] = self.date.isoformat()
+        for key, v in (("total_amount", self.excl), ("amount_excl_tax", self.excl),
+                       ("total_tax", self.tax), ("amount_in_figures", self.incl)):
+            if v is not None:
+                inv[key] = str(v)
+        inv["tax_rate"] = self.rate_text
+        inv["tax_rate_decimal"] = float(self.rate) if self.rate is not None else None
+        return inv
@@ -0,0 +1,207 @@
+# invoice_validator.py — 验真前的本地校验与修复：格式不对的要素先就地修，修不好就不花钱调验真接口
+# -*- coding: utf-8 -*-
+import re
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Any, Dict, List, Optional, Tuple
+
+from qr_decoder import parse_vat_qr
+
+CENT = Decimal("0.01")
+
+# OCR 常把数字认成形近字母；只在“替换后整串都是数字”时才采用
+_OCR_DIGIT = str.maketrans({"O": "0", "o": "0", "D": "0", "Q": "0", "I": "1", "l": "1", "|": "1",
+                            "Z": "2", "S": "5", "s": "5", "B": "8", "g": "9"})
+_NOISE = re.compile(r"[\s\-_.·:：№#]|^No", re.I)
+_DATE = re.compile(r"(\d{4})\D{0,2}(\d{1,2})\D{0,2}(\d{1,2})")
+
+_FPHM_TXT = re.compile(r"(?:fphm|发票号码|号码)[=:：\s]*([0-9OoIlSB ]{8,24})")
+_FPDM_TXT = re.compile(r"(?:fpdm|发票代码)[=:：\s]*([0-9OoIlSB ]{10,14})")
+_KPRQ_TXT = re.compile(r"(?:kprq|开票日期)[=:：\s]*(\d{4}\D{0,2}\d{1,2}\D{0,2}\d{1,2})")
+
+# InvoiceVerifier 在缺 noTaxAmount/jshj 时会从这些键补
+_FALLBACK_KEYS = {"noTaxAmount": ("amount_excl_tax", "total_amount", "no_tax", "je"),
+                  "jshj": ("amount_in_figures", "total_with_tax", "total_tax")}
+
+
+# —— 单字段规整 —— #
+def digits(s: Any) -> str:
+    """去掉空格/分隔符/No 前缀，纠正形近字母；纠不成纯数字返回原串（去噪后）"""
+    t = _NOISE.sub("", str(s or "").strip())
+    fixed = t.translate(_OCR_DIGIT)
+    return fixed if fixed.isdigit() else t
+
+
+def valid_fphm(s: str) -> bool:
+    return bool(re.fullmatch(r"\d{8}|\d{20}", s or ""))
+
+
+def valid_fpdm(s: str) -> bool:
+    return bool(re.fullmatch(r"\d{10}|\d{12}", s or ""))
+
+
+def calendar_date(s: Any, today: Optional[date] = None) -> Optional[date]:
+    """2025年1月2日 / 2025-01-02 / 20250102 → date；日历上不存在或晚于明天返回 None"""
+    if isinstance(s, date):
+        d = s
+    else:
+        m = _DATE.search(str(s or ""))
+        if not m:
+            return None
+        try:
+            d = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            return None
+    if d.year < 2000 or d > (today or date.today()) + timedelta(days=1):   # 时区差放宽一天
+        return None
+    return d
+
+
+def money(x: Any) -> Optional[Decimal]:
+    """金额转 Decimal（允许千分位、¥ 前缀、负数红票）；非数字返回 None"""
+    if x is None or isinstance(x, bool):
+        return None
+    s = str(x).replace(",", "").replace("，", "").replace("¥", "").replace("￥", "").strip()
+    if not s:
+        return None
+    try:
+        v = Decimal(s)
+    except InvalidOperation:
+        return None
+    return v if v.is_finite() else None
+
+
+def amounts_consistent(excl: Any, tax: Any, incl: Any) -> bool:
+    """不含税 + 税额 与 价税合计 相差不超过 1 分；缺任一项视为无从判断（True）"""
+    e, t, i = money(excl), money(tax), money(incl)
+    if e is None or t is None or i is None:
+        return True
+    return abs(e + t - i) <= CENT
+
+
+def _fmt(v: Decimal) -> str:
+    return str(v.quantize(CENT, rounding=ROUND_HALF_UP))
+
+
+# —— 验真 body 的格式检查（InvoiceVerifier 发请求前的最后一道闸） —— #
+def shape_problems(bodys: Dict[str, str]) -> List[str]:
+    """bodys 为阿里云验真接口的入参；返回格式问题列表，空列表表示可以发"""
+    out: List[str] = []
+    fphm = bodys.get("fphm")
+    if fphm is not None and not valid_fphm(fphm):
+        out.append("发票号码应为 8 位或 20 位数字")
+    fpdm = bodys.get("fpdm")
+    if fpdm is not None and not valid_fpdm(fpdm):
+        out.append("发票代码应为 10 位或 12 位数字")
+    kprq = bodys.get("kprq")
+    if kprq is not None and not (re.fullmatch(r"\d{8}", kprq) and calendar_date(kprq)):
+        out.append("开票日期不是有效日期")
+    for k, name in (("noTaxAmount", "不含税金额"), ("jshj", "价税合计")):
+        if k in bodys and money(bodys[k]) is None:
+            out.append(f"{name}不是数字")
+    code = bodys.get("checkCode")
+    if code is not None and not re.fullmatch(r"\d{6}", code):
+        out.append("校验码应为 6 位数字")
+    return out
+
+
+# —— 处理器侧：按二维码/票面文字修复 —— #
+def _text_candidates(pat, text: str) -> List[str]:
+    return [m.group(1) for m in pat.finditer(text or "")]
+
+
+def repair_verify_payload(payload: Dict[str, Any], qr_text: str = "", ocr_text: str = "",
+                          today: Optional[date] = None) -> Tuple[Dict[str, Any], List[str], List[str]]:
+    """
+    返回 (修复后的 payload, 修复记录, 无法修复的问题)。
+    - 号码/代码/日期：先规整原值，不合规再依次试二维码、票面文字
+    - 金额：统一两位小数；不含税+税额≠价税合计（超 1 分）时只保留可信的一项，避免必然 1010
+    - 代码、校验码修不好就去掉（接口允许缺）；号码、日期、金额修不好记为问题
+    问题列表非空表示这组要素发出去也必然失败。
+    """
+    p = dict(payload)
+    repairs: List[str] = []
+    problems: List[str] = []
+    q = parse_vat_qr(qr_text) or {}
+    is_digital = bool(q.get("is_digital"))
+
+    def pick(key: str, label: str, check, qr_val, text_vals, required: bool):
+        raw = p.get(key)
+        if raw in (None, ""):
+            return
+        for src, val in [("原值", raw), ("二维码", qr_val)] + [("票面文字", v) for v in text_vals]:
+            if not val:
+                continue
+            v = digits(val)
+            if check(v):
+                if v != str(raw):
+                    repairs.append(f"{label}：{src}修正")
+                p[key] = v
+                return
+        p.pop(key, None)
+        (problems if required else repairs).append(
+            f"{label}格式不正确" if required else f"{label}格式不正确，已忽略")
+
+    pick("fphm", "发票号码", valid_fphm, q.get("fphm"), _text_candidates(_FPHM_TXT, ocr_text), True)
+    pick("fpdm", "发票代码", valid_fpdm, q.get("fpdm"), _text_candidates(_FPDM_TXT, ocr_text), False)
+    is_digital = is_digital or len(str(p.get("fphm") or "")) == 20
+
+    if p.get("kprq"):
+        d = None
+        for src, val in [("原值", p["kprq"]), ("二维码", q.get("kprq"))] + \
+                        [("票面文字", v) for v in _text_candidates(_KPRQ_TXT, ocr_text)]:
+            d = calendar_date(val, today) if val else None
+            if d:
+                if src != "原值":
+                    repairs.append(f"开票日期：{src}修正")
+                break
+        if d:
+            p["kprq"] = d.isoformat()
+        else:
+            p.pop("kprq", None)
+            problems.append("开票日期不是有效日期")
+
+    jym = digits(p.get("jym"))
+    if p.get("jym"):
+        if re.fullmatch(r"\d{6,20}", jym):
+            p["jym"] = jym
+        else:
+            p.pop("jym", None)
+            repairs.append("校验码格式不正确，已忽略")
+
+    # 金额：两位小数 + 交叉校验
+    had_amount = False
+    for key, label in (("noTaxAmount", "不含税金额"), ("jshj", "价税合计")):
+        if p.get(key) in (None, ""):
+            continue
+        had_amount = True
+        v = money(p[key])
+        if v is None:
+            p.pop(key, None)
+            repairs.append(f"{label}不是数字，已忽略")
+            continue
+        s = _fmt(v)
+        if v != Decimal(s):
+            repairs.append(f"{label}：按两位小数取整")
+        p[key] = s
+
+    # 二维码金额是机读的：数电票为价税合计，其余为不含税金额
+    qr_je = money(q.get("je"))
+    qr_key = "jshj" if is_digital else "noTaxAmount"
+    if qr_je is not None and p.get(qr_key) and abs(money(p[qr_key]) - qr_je) > CENT:
+        p[qr_key] = _fmt(qr_je)
+        repairs.append(f"{'价税合计' if qr_key == 'jshj' else '不含税金额'}：二维码修正")
+
+    excl = p.get("noTaxAmount")
+    incl = p.get("jshj")
+    tax = p.get("total_tax")
+    if excl and incl and money(tax) is not None and not amounts_consistent(excl, tax, incl):
+        keep = qr_key          # 有二维码时 qr_key 已对齐二维码；没有时数电票核价税合计，其余核不含税金额
+        drop = "noTaxAmount" if keep == "jshj" else "jshj"
+        for k in (drop,) + _FALLBACK_KEYS[drop]:      # 连同别名一起去掉，免得验真端又拿别名补回来
+            p.pop(k, None)
+        repairs.append(f"金额不自洽（不含税+税额≠价税合计），仅提交{'价税合计' if keep == 'jshj' else '不含税金额'}")
+
+    if had_amount and not (p.get("noTaxAmount") or p.get("jshj")):
+        problems.append("金额不是有效数字")
+    return p, repairs, problems
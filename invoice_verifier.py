@@ -3,26 +3,19 @@
 from typing import Dict, Any, Optional
 import requests
 import os
+import logging
 
-ALI_HOST = "https://fapiao.market.alicloudapi.com"
-ALI_PATH_V2 = "/v2/invoice/query"
+from resilience import guarded_call, CircuitOpenError, DeadlineExceeded
+from metrics import UPSTREAM_ERRORS, UPSTREAM_CALLS
+from log_utils import log_payload
+from singleflight import VERIFY_FLIGHT, content_key
+from invoice_validator import shape_problems, calendar_date, money
+from invoice_record import money_text
+
+logger = logging.getLogger("invoice_verifier")
 
-def _to_yyyymmdd(s: str) -> str:
-    s = str(s or "").strip().replace("年","-").replace("月","-").replace("日","").replace("/","-")
-    if "-" in s:
-        p = s.split("-")
-        if len(p) == 3 and all(p):
-            return f"{p[0]}{p[1].zfill(2)}{p[2].zfill(2)}"
-    if len(s) == 8 and s.isdigit():
-        return s
-    return s
-
-def _to_2dec(x: Any) -> str:
-    try:
-        v = float(str(x).replace(",", "").strip())
-        return f"{v:.2f}"
-    except Exception:
-        return ""
+ALI_HOST = os.getenv("ALIYUN_FAPIAO_HOST", "https://fapiao.market.alicloudapi.com").rstrip("/")
+ALI_PATH_V2 = "/v2/invoice/query"
 
 class InvoiceVerifier:
     """
@@ -47,21 +40,24 @@ class InvoiceVerifier:
 
         fpdm = str(payload.get("fpdm") or "").strip()
         fphm = str(payload.get("fphm") or "").strip()
-        kprq = _to_yyyymmdd(payload.get("kprq") or "")
+        d = calendar_date(payload.get("kprq"))
+        kprq = d.strftime("%Y%m%d") if d else str(payload.get("kprq") or "").strip()   # 认不出的交给 shape_problems 拦
         # 可能来自 processor 的 je，这里不直接用，优先显式字段
-        no_tax = _to_2dec(payload.get("noTaxAmount"))
-        jshj   = _to_2dec(payload.get("jshj"))
+        no_tax = money_text(payload.get("noTaxAmount"))
+        jshj   = money_text(payload.get("jshj"))
         jym    = str(payload.get("jym") or "").strip()
         if len(jym) > 6:
             jym = jym[-6:]
 
         # 如果上游没明确给双金额，尝试从 payload 的其他键推断（常见命名）
         if not no_tax:
-            no_tax = _to_2dec(payload.get("amount_excl_tax") or payload.get("total_amount") or payload.get("no_tax") or payload.get("je"))
+            no_tax = money_text(payload.get("amount_excl_tax") or payload.get("total_amount") or payload.get("no_tax") or payload.get("je"))
         if not jshj:
-            # 有些只给了价税合计，也兜一下
-            jshj = _to_2dec(payload.get("amount_in_figures") or payload.get("total_with_tax") or
-                            (float(payload.get("total_amount", 0)) + float(payload.get("total_tax", 0)) if payload.get("total_tax") is not None else ""))
+            # 有些只给了价税合计，也兜一下；再不行用 不含税+税额（分位精确）
+            jshj = money_text(payload.get("amount_in_figures") or payload.get("total_with_tax"))
+            excl, tax = money(payload.get("total_amount")), money(payload.get("total_tax"))
+            if not jshj and excl is not None and tax is not None:
+                jshj = money_text(excl + tax)
 
         # 构造 body（该接口允许缺 fpdm；但至少需要 fphm+kprq+金额 之一）
         bodys: Dict[str, str] = {}
@@ -83,10 +79,22 @@ class InvoiceVerifier:
             # 放行，但会在 debug 模式提示
             pass
 
-        if self.debug:
-            safe = {k: ("***" if k == "checkCode" else v) for k, v in bodys.items()}
-            print(f"[InvoiceVerifier] POST {ALI_PATH_V2} with body={safe}")
+        # 格式明显不对（号码位数、日期、金额非数字）的查询必然失败，不发请求
+        bad = shape_problems(bodys)
+        if bad:
+            UPSTREAM_CALLS.inc(dependency="aliyun_verify", outcome="skipped_invalid")
+            return {"is_valid": False, "skipped": True, "validation_problems": bad,
+                    "verify_message": f"验真要素格式不正确（本地校验）：{'；'.join(bad)}。"}
 
+        # checkCode 由 log_utils 按字段名打码
+        log_payload(logger, f"[InvoiceVerifier] POST {ALI_PATH_V2} with body=%s", bodys,
+                    level=logging.INFO if self.debug else logging.DEBUG)
+
+        # 同一组验真要素的查询在飞时（重复提交/多人同票）合并成一次
+        return VERIFY_FLIGHT.do(content_key(ALI_PATH_V2, bodys),
+                                lambda: self._query(bodys, fpdm=fpdm, jym=jym, no_tax=no_tax, jshj=jshj))
+
+    def _query(self, bodys: Dict[str, str], fpdm: str, jym: str, no_tax: str, jshj: str) -> Dict[str, Any]:
         url = f"{ALI_HOST}{ALI_PATH_V2}"
         headers = {
             "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
@@ -94,7 +102,12 @@ class InvoiceVerifier:
         }
 
         try:
-            resp = requests.post(url, data=bodys, headers=headers, timeout=self.timeout)
+            # 熔断 + 请求截止时间（HEDGE_DEPS 含 aliyun_verify 时对慢请求对冲）
+            resp = guarded_call(
+                "aliyun_verify",
+                lambda t: requests.post(url, data=bodys, headers=headers, timeout=t),
+                timeout=self.timeout, is_failure=lambda r: r.status_code >= 500,
+            )
             text = resp.text or ""
             try:
                 data = resp.json()
@@ -115,6 +128,8 @@ class InvoiceVerifier:
                     msg = "验真成功"
             if not msg:
                 msg = str(data.get("msg") or data.get("message") or "验真完成")
+            if not ok:
+                UPSTREAM_ERRORS.inc(dependency="aliyun_verify", code=code or f"http_{resp.status_code}")
 
             # 如果验真成功且有校验码，显示校验码
             if ok and jym:
@@ -136,6 +151,10 @@ class InvoiceVerifier:
                 msg = f"{msg}；建议核对：号码/日期/金额精确值与小数位。{'；'.join(hint)}"
 
             return {"is_valid": bool(ok), "verify_message": msg, "verify_result": data}
+        except CircuitOpenError:
+            return {"is_valid": False, "verify_message": "验真服务暂不可用（熔断中），请稍后重试。", "degraded": True}
+        except DeadlineExceeded:
+            return {"is_valid": False, "verify_message": "本次请求时间预算已用完，未完成验真。", "degraded": True}
         except requests.RequestException as e:
             return {"is_valid": False, "verify_message": f"验真接口网络异常：{e}"}
         except Exception as e:
@@ -33,7 +33,136 @@ def _mk_kb_url(public_base: str, rel_path: str) -> str:
     return f"{public_base}/{quote(rel_path)}"
 
 logger = logging.getLogger("knowledge_retriever")
-logger.setLevel(logging.INFO)
+
+# —— 上下文包：按 (阶段, 费用类别) 在加载时预先裁好、去重、渲染好的知识库摘录 —— #
+KB_PACK_CHARS = int(os.getenv("KB_PACK_CHARS", "2400"))   # 每个包的正文预算（analyzer 整体上限 3500，留给检索命中/当日日期）
+KB_PACK_MIN_DOC_CHARS = 400                                 # 每份文档至少分到的预算
+
+# 各阶段用哪些文档（与 reimbursement_processor 原先逐请求拼接的清单一致）
+PACK_STAGE_DOCS = {
+    "accounting": ("会计科目口径手册_rag版.md", "accounting_rules.txt", "公司报销规则.txt", "公司报销制度.md"),
+    "risk": ("发票验真要点_rag版.md", "verification_points.txt"),
+    "approval": ("approval_process.txt", "公司报销制度.md"),
+}
+
+# 费用类别 → 命中关键词（键名与审批阈值的类别一致）；general 不挑小节，按文档顺序取
+PACK_CATEGORIES = {
+    "travel": ("差旅", "住宿", "酒店", "宾馆", "交通", "机票", "火车", "高铁", "打车", "出租", "网约车", "行程"),
+    "entertain": ("招待", "宴请", "餐饮", "餐费"),
+    "office": ("办公", "文具", "耗材", "快递", "复印"),
+    "training": ("培训", "课程", "学费"),
+    "meeting": ("会议", "会务", "会场"),
+    "general": (),
+}
+
+_SECTION_SPLIT = re.compile(r"\n(?=#{1,6}\s)|\n\s*\n|\n(?=\s*\d+[.、]\s*\S)")
+
+
+def pack_category(text: str) -> str:
+    """费用类型/服务类型文字 → 上下文包类别；都不命中为 general"""
+    t = (text or "").lower()
+    for cat, keys in PACK_CATEGORIES.items():
+        if any(k in t for k in keys):
+            return cat
+    return "general"
+
+
+def _render_context(name: str, text: str) -> str:
+    """与 expense_analyzer._build_context_block 的单条格式一致：【文件名主体】\n正文"""
+    return f"【{os.path.splitext(os.path.basename(name))[0]}】\n{text}"
+
+
+# —— 引用来源：加载时建好 标题/URL 表，请求路径一次线性遍历解析 —— #
+# 结构化来源：不是知识库文件，没有链接，也不显示相似度
+STRUCT_SOURCES = ("系统当前时间", "结构化规则-审批阈值", "结构化规则-验真有效期", "结构化-调用侧上下文汇总")
+_DICT_TITLE = re.compile(r"""['"](?:title|source|doc|file|name)['"]\s*:\s*['"]([^'"]+)['"]""")
+_DOC_EXT = re.compile(r"\.(?:md|txt|pdf|docx?)$", re.I)
+CITATION_MEMO_MAX = 4096                 # 非规范写法的解析缓存上限（模型自造的文件名不让它无限长）
+
+
+def _source_key(raw: str) -> str:
+    """来源写法 → 文件名主体：去《》、路径、“ §小节”（片段引用）、扩展名"""
+    t = raw.strip().strip("《》「」【】").replace("\\", "/")
+    t = t.split("§", 1)[0].strip().rsplit("/", 1)[-1]
+    return _DOC_EXT.sub("", t).strip()
+
+
+def _score(v) -> Optional[float]:
+    """相似度 → 4 位小数；转不动/为 0 一律 None（前端不显示）"""
+    try:
+        f = round(float(v), 4)
+    except (TypeError, ValueError):
+        return None
+    return f or None
+
+
+def _covered_text(contexts: List[Dict[str, Any]]) -> str:
+    """包里实际收进的正文（去空白、小写，各文档之间用 NUL 隔开）：检索片段是它的子串就说明内容已在包里"""
+    return "\0".join(re.sub(r"\s+", "", c["content"]).lower() for c in contexts)
+
+
+class CitationResolver:
+    """
+    知识库文档 → {"title": 文件名主体, "url": 公开链接}，随 KB 加载一次建表。
+    认得的写法：文件名 / 文件名主体 / 路径 / “文件名 §小节” / "{'title': ...}" 样式的脏字符串 /
+    检索命中与上下文 dict（title/doc/source/file/name/path）。不在库里的来源保留文件名主体、链接照抄。
+    """
+    def __init__(self, filenames=(), to_url=None):
+        self.table: Dict[str, Tuple[str, Optional[str]]] = {s: (s, None) for s in STRUCT_SOURCES}
+        for fn in filenames:
+            title = _source_key(fn)
+            entry = (title, (to_url(fn) if to_url else "") or None)
+            self.table.setdefault(title, entry)
+            self.table.setdefault(fn, entry)
+        self._seen_raw: Dict[str, Tuple[str, Optional[str]]] = {}   # 其它写法（路径、§小节…）首次解析后记住
+
+    def lookup(self, raw: str) -> Tuple[str, Optional[str]]:
+        hit = self.table.get(raw) or self._seen_raw.get(raw)
+        if hit is None:
+            m = _DICT_TITLE.search(raw) if raw.startswith("{") else None
+            key = _source_key(m.group(1) if m else ("" if raw.startswith("{") else raw))
+            hit = self.table.get(key) or (key, None)
+            if len(self._seen_raw) < CITATION_MEMO_MAX:
+                self._seen_raw[raw] = hit
+        return hit
+
+    def resolve(self, *seqs) -> List[Dict[str, Any]]:
+        """
+        任意几组来源（str/dict 混合）→ [{"title", "url", "score"}]：一遍扫完，按标题去重、保留首次出现顺序；
+        重复项只在先前没有分数时补上分数。
+        """
+        out: List[Dict[str, Any]] = []
+        seen: Dict[str, int] = {}
+        for seq in seqs:
+            if isinstance(seq, (str, dict)):
+                seq = (seq,)
+            for s in seq or ():
+                if isinstance(s, dict):
+                    raw = s.get("title") or s.get("doc") or s.get("source") or s.get("file") or s.get("name") \
+                        or os.path.basename(s.get("path") or "")
+                    if isinstance(raw, dict):                 # 检索命中的 source 是 {title, url}
+                        raw = raw.get("title") or ""
+                    url, score = s.get("url") or s.get("link"), s.get("score")
+                elif isinstance(s, str):
+                    raw, url, score = s, None, None
+                else:
+                    continue
+                raw = str(raw).strip()
+                if not raw:
+                    continue
+                title, kb_url = self.lookup(raw)
+                if not title:
+                    continue
+                score = None if title in STRUCT_SOURCES else _score(score)
+                i = seen.get(title)
+                if i is None:
+                    seen[title] = len(out)
+                    out.append({"title": title, "url": kb_url or (url if isinstance(url, str) and url else None),
+                                "score": score})
+                elif out[i]["score"] is None and score is not None:
+                    out[i]["score"] = score
+        return out
+
 
 class KnowledgeRetriever:
     """
@@ -55,6 +184,10 @@ class KnowledgeRetriever:
 
         # 本地库
         self.base = os.path.abspath(local_knowledge_base_path or "./knowledge_base")
+        self.reload()
+
+    def reload(self):
+        """（重新）读取知识库目录：语料、TF-IDF、结构化规则、来源表、上下文包一次性重建"""
         self.docs: Dict[str, str] = {}
         self.filenames: List[str] = []
         self._load_local_corpus()
@@ -77,6 +210,11 @@ class KnowledgeRetriever:
         self._extract_verify_window()                         # verification_points.txt
         self._load_keyword_map()                              # 发票关键词-会计科目map表.txt
 
+        self.citations = CitationResolver(self.filenames, self._to_url)   # 来源 → 标题/URL
+
+        self.context_packs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._build_context_packs()                           # 依赖上面的结构化规则
+
     # ----------------------------------------------------------------------
     # 本地索引
     # ----------------------------------------------------------------------
@@ -167,10 +305,9 @@ class KnowledgeRetriever:
                 "url": _mk_kb_url(public_base, rel_name)
             }
             results.append({"doc": fn, "content": snippet, "score": score, "source": source_item})
-        if results:
-            logger.info("本地检索命中 TopK：")
-            for r in results[:top_k]:
-                logger.info(" - %s | score=%.4f", r["doc"], r["score"])
+        if results and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("本地检索命中 TopK：%s",
+                         " | ".join(f"{os.path.basename(r['doc'])}={r['score']:.4f}" for r in results[:top_k]))
         return results[:top_k]
 
     def _best_snippet(self, txt: str, query: str, span: int = 240) -> str:
@@ -316,6 +453,82 @@ class KnowledgeRetriever:
                 rows.append({"keyword": kw, "account": account, "weight": w, "note": note})
         self.keyword_map = rows
 
+    # ----------------------------------------------------------------------
+    # 上下文包
+    # ----------------------------------------------------------------------
+    def _compact_doc(self, text: str, category: str, budget: int, seen: set) -> str:
+        """
+        按小节（标题/空行/编号条目）切开，类别关键词命中多的小节优先，在预算内按原顺序拼回；
+        与包内已收小节重复的跳过（多份制度文件常互相抄条款）。
+        """
+        keys = PACK_CATEGORIES.get(category, ())
+        sections = []
+        for i, sec in enumerate(_SECTION_SPLIT.split(text or "")):
+            sec = sec.strip()
+            if sec:
+                sections.append((i, sec, sum(sec.count(k) for k in keys)))
+        picked, used = [], 0
+        for i, sec, _ in sorted(sections, key=lambda x: (-x[2], x[0])):
+            if used >= budget:
+                break
+            norm = re.sub(r"\s+", "", sec)
+            if norm in seen:
+                continue
+            if used + len(sec) > budget:
+                if picked:            # 放不下整节就跳过，留给后面更短的小节
+                    continue
+                sec = sec[:budget] + "…"
+            seen.add(norm)
+            picked.append((i, sec))
+            used += len(sec) + 1
+        return "\n".join(sec for _, sec in sorted(picked))
+
+    def _make_pack(self, stage: str, category: str, structured: List[Tuple[str, str]]) -> Dict[str, Any]:
+        names, seen_docs = [], set()
+        for name in PACK_STAGE_DOCS[stage]:
+            txt = self.docs.get(name)
+            if txt and txt not in seen_docs:    # 内容完全相同的两份文件只收一份
+                seen_docs.add(txt)
+                names.append(name)
+        budget = max(KB_PACK_MIN_DOC_CHARS, KB_PACK_CHARS // max(1, len(names)))
+        contexts, seen = [], set()
+        for name in names:
+            body = self._compact_doc(self.docs[name], category, budget, seen)
+            if body:
+                contexts.append({"source": name, "content": body, "url": self._to_url(name),
+                                 "rendered": _render_context(name, body)})
+        for source, body in structured:
+            contexts.append({"source": source, "content": body, "rendered": _render_context(source, body)})
+        return {"stage": stage, "category": category, "contexts": contexts,
+                "sources": self.citations.resolve(contexts),
+                "docs": frozenset(names), "covered": _covered_text(contexts),
+                "chars": sum(len(c["rendered"]) for c in contexts)}
+
+    def _build_context_packs(self):
+        """每个 (阶段, 类别) 一个包；请求路径只做字典查找（见 context_pack）"""
+        risk_struct = []
+        if self.verification_window_days:
+            risk_struct.append(("结构化规则-验真有效期", f"发票有效期（验真指导）约 {self.verification_window_days} 天"))
+        for cat in PACK_CATEGORIES:
+            self.context_packs[("accounting", cat)] = self._make_pack("accounting", cat, [])
+            self.context_packs[("risk", cat)] = self._make_pack("risk", cat, risk_struct)
+            rules = self.approval_thresholds.get(cat)
+            ap_struct = [("结构化规则-审批阈值", json.dumps({"category": cat, "rules": rules}, ensure_ascii=False))] if rules else []
+            self.context_packs[("approval", cat)] = self._make_pack("approval", cat, ap_struct)
+        if self.context_packs:
+            logger.info("上下文包已预构建：%d 个，最大 %d 字", len(self.context_packs),
+                        max(p["chars"] for p in self.context_packs.values()))
+
+    def context_pack(self, stage: str, category: str = "general") -> Dict[str, Any]:
+        """
+        O(1) 取预构建的上下文包：{"contexts": [{source, content, url, rendered}], "sources", "docs", "chars"}；
+        category 可以直接传费用类别键，也可以传费用类型/服务类型原文（内部归类）。
+        """
+        cat = category if category in PACK_CATEGORIES else pack_category(category)
+        return self.context_packs.get((stage, cat)) or self.context_packs.get((stage, "general")) or \
+            {"stage": stage, "category": cat, "contexts": [], "sources": [], "docs": frozenset(), "covered": "",
+             "chars": 0}
+
     # ----------------------------------------------------------------------
     # 对外接口
     # ----------------------------------------------------------------------
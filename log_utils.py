@@ -0,0 +1,123 @@
+# log_utils.py — 统一日志：队列异步输出、大对象惰性格式化 + 抽样截断、税号等字段脱敏
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)s:%(name)s:%(message)s")
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))   # 单个大对象最多输出多少字符
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "1.0"))        # 大对象 debug 日志的抽样比例
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") == "1"                            # 0 则同步输出（本地调试）
+
+# 按字段名整体打码
+REDACT_KEYS = {
+    "seller_register_num", "buyer_register_num", "purchaser_register_num",
+    "SellerRegisterNum", "PurchaserRegisterNum", "SellerTaxID", "PurchaserTaxID",
+    "access_token", "appcode", "api_key", "secret_key", "checkCode", "check_code",
+}
+# 自由文本里的统一社会信用代码（18 位）/ 旧纳税人识别号（15 位，含字母）
+_TAX_ID = re.compile(r"(?<![0-9A-Z])(?:[0-9A-HJ-NPQRTUWXY]{2}\d{6}[0-9A-HJ-NPQRTUWXY]{10}"
+                     r"|(?=[0-9A-Z]*[A-Z])[0-9A-Z]{15})(?![0-9A-Z])")
+_SECRET_QS = re.compile(r"(access_token=|APPCODE\s+)[^&\s'\"]+")
+
+
+def mask(v: Any) -> str:
+    s = str(v or "")
+    return "***" if len(s) <= 6 else f"{s[:2]}***{s[-4:]}"
+
+
+def redact_text(s: str) -> str:
+    s = _TAX_ID.sub(lambda m: mask(m.group(0)), s)
+    return _SECRET_QS.sub(lambda m: m.group(1) + "***", s)
+
+
+def redact(obj: Any, _depth: int = 0) -> Any:
+    """递归复制并打码（不改原对象）；字符串里的税号也会打码"""
+    if _depth > 8:
+        return "…"
+    if isinstance(obj, dict):
+        return {k: (mask(v) if k in REDACT_KEYS and v else redact(v, _depth + 1)) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [redact(x, _depth + 1) for x in obj]
+    if isinstance(obj, str):
+        return redact_text(obj)
+    return obj
+
+
+class Payload:
+    """
+    惰性包装大对象：只有这条日志真的要输出时才序列化（%s 触发 __str__），
+    输出前脱敏并截断到 max_chars。
+    """
+    __slots__ = ("obj", "max_chars")
+
+    def __init__(self, obj: Any, max_chars: Optional[int] = None):
+        self.obj = obj
+        self.max_chars = LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self) -> str:
+        try:
+            s = json.dumps(redact(self.obj), ensure_ascii=False, default=str)
+        except Exception:
+            s = redact_text(repr(self.obj))
+        if len(s) > self.max_chars:
+            s = f"{s[:self.max_chars]}…(+{len(s) - self.max_chars} chars)"
+        return s
+
+
+def log_payload(logger: logging.Logger, msg: str, obj: Any, level: int = logging.DEBUG):
+    """大对象日志入口：级别未开启或未被抽中时不做任何格式化"""
+    if not logger.isEnabledFor(level):
+        return
+    if LOG_PAYLOAD_SAMPLE < 1.0 and random.random() >= LOG_PAYLOAD_SAMPLE:
+        return
+    logger.log(level, msg, Payload(obj))
+
+
+class RedactFilter(logging.Filter):
+    """挂在出口 handler 上：最终消息统一过一遍文本脱敏（兜住 f-string / 异常信息里的税号、token）"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        try:
+            msg = record.getMessage()
+        except Exception:
+            return True
+        record.msg, record.args = redact_text(msg), None
+        return True
+
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(level: str = LOG_LEVEL):
+    """
+    进程级只装一次：根 logger → QueueHandler（调用线程只入队）→ 后台 QueueListener 写 stderr。
+    LOG_QUEUE=0 时直接同步写。
+    """
+    global _listener
+    with _setup_lock:
+        root = logging.getLogger()
+        root.setLevel(level)
+        if getattr(root, "_reimburse_configured", False):
+            return
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter(LOG_FORMAT))
+        if LOG_QUEUE:
+            qh = QueueHandler(queue.SimpleQueue())
+            qh.addFilter(RedactFilter())
+            root.addHandler(qh)
+            _listener = QueueListener(qh.queue, stream, respect_handler_level=True)
+            _listener.start()
+            atexit.register(_listener.stop)
+        else:
+            stream.addFilter(RedactFilter())
+            root.addHandler(stream)
+        root._reimburse_configured = True
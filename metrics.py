@@ -0,0 +1,128 @@
+# metrics.py — 进程内指标：阶段耗时直方图 + 计数器，按 Prometheus 文本格式导出（/metrics）
+# -*- coding: utf-8 -*-
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+# 单位秒；覆盖毫秒级本地解析到 60s 的 LLM 超时
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_num(x: float) -> str:
+    return repr(float(x)) if x != int(x) else str(int(x))
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels.get(n, "")) for n in self.labelnames), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_num(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}   # key -> [各桶计数..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, s in items:
+            for i, b in enumerate(self.buckets):
+                le = 'le="%s"' % _fmt_num(b)
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {s[i]}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, inf)} {s[-1]}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_num(round(s[-2], 6))}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {s[-1]}")
+        return lines
+
+
+_registry: List = []
+
+def counter(name: str, doc: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    c = Counter(name, doc, labelnames)
+    _registry.append(c)
+    return c
+
+def histogram(name: str, doc: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    h = Histogram(name, doc, labelnames, buckets)
+    _registry.append(h)
+    return h
+
+
+# —— 全局指标 —— #
+STAGE_SECONDS = histogram("reimburse_stage_seconds", "各处理阶段耗时（秒）", ("stage",))
+STAGE_ERRORS = counter("reimburse_stage_errors_total", "阶段内异常次数", ("stage",))
+UPSTREAM_SECONDS = histogram("upstream_call_seconds", "外部依赖单次调用耗时（秒）", ("dependency",))
+UPSTREAM_CALLS = counter("upstream_calls_total", "外部依赖调用次数（按结果）", ("dependency", "outcome"))
+UPSTREAM_ERRORS = counter("upstream_error_codes_total", "外部依赖返回的错误码", ("dependency", "code"))
+RETRIES = counter("upstream_retries_total", "重试次数", ("dependency", "reason"))
+CACHE_EVENTS = counter("cache_events_total", "缓存命中/未命中", ("cache", "result"))
+EXTRACT_ROUTES = counter("invoice_extract_routes_total", "发票要素来源（pdf_text/qr/ocr…）", ("route",))
+DEGRADED = counter("degraded_stages_total", "因预算/熔断降级的阶段", ("stage",))
+COALESCED = counter("singleflight_coalesced_total", "合并到在途相同调用上的请求数", ("group",))
+HTTP_SECONDS = histogram("http_request_seconds", "HTTP 请求耗时（秒）", ("route", "status"))
+
+
+@contextmanager
+def span(stage: str):
+    """计时一个阶段；异常照常抛出，同时记一次 reimburse_stage_errors_total"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=stage)
+
+
+def render() -> str:
+    lines: List[str] = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,157 @@
+# near_dup.py — 翻拍/重拍发票的近似重复检测：缩略图 dHash + BK 树（汉明距离），纯本地、毫秒级
+# -*- coding: utf-8 -*-
+"""
+同一张纸质发票换个光线再拍一次，字节全变、内容哈希失效，但缩略图的明暗梯度几乎不变：
+- dhash()：EXIF 转正 → 裁到票面 → 灰度 + 自动对比度（抹掉光照差）→ 9×8 缩略图 → 64 位梯度哈希
+- BKTree：按汉明距离建树，查 “距离 ≤ r 的最近一张” 只走三角不等式允许的分支
+9×8 缩略图主要反映版式：同一酒店/平台的不同发票也会落在半径内，所以命中只是候选——
+confirm_by_qr() 再本地解一次二维码，代码+号码与上次的识别结果对上才算同一张票，由调用方复用上次结果、跳过 OCR；
+解不出二维码或对不上就照常识别。全程不发任何网络请求。
+"""
+import io
+import os
+import time
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+try:  # Pillow 可选：没装就不做近似去重
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = ImageOps = None
+
+from invoice_index import get_index, invoice_key
+from qr_decoder import decode_image, parse_vat_qr
+from image_preprocess import _crop_to_content
+
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))   # 64 位里最多差几位算同一张
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "1") == "1"
+
+
+def dhash(data, size: int = 8) -> Optional[int]:
+    """图片字节 → 64 位 dHash；不是图片/解不开返回 None"""
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (size * 64, size * 64))      # JPEG 直接按 1/2~1/8 解码，大图也只要几毫秒
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img, _ = _crop_to_content(img)                  # 背景不同的翻拍先裁到票面再比
+        img = ImageOps.autocontrast(img.convert("L"), cutoff=2)
+        px = list(img.resize((size + 1, size), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    h = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            h = (h << 1) | (px[base + col] > px[base + col + 1])
+    return h
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """节点 = [哈希, 载荷, {距离: 子节点}]；插入 O(log n)，小半径查询只访问树的一小部分"""
+    def __init__(self):
+        self.root: Optional[list] = None
+        self.size = 0
+
+    def add(self, h: int, payload: Any) -> None:
+        self.size += 1
+        if self.root is None:
+            self.root = [h, payload, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, payload, {}]
+                return
+            node = child
+
+    def nearest(self, h: int, radius: int) -> Optional[Tuple[int, Any]]:
+        """距离 ≤ radius 中最近的一个 (距离, 载荷)；没有返回 None"""
+        if self.root is None:
+            return None
+        best: Optional[Tuple[int, Any]] = None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius and (best is None or d < best[0]):
+                best = (d, node[1])
+                if d == 0:
+                    break
+            r = best[0] if best else radius
+            lo, hi = d - r, d + r
+            stack.extend(c for k, c in node[2].items() if lo <= k <= hi)
+        return best
+
+
+def confirm_by_qr(near: Dict[str, Any], data) -> Optional[str]:
+    """
+    近似命中后、OCR 之前的确认：本次照片二维码里的代码+号码与上次的识别结果按发票键（invoice_index.invoice_key）比对。
+    返回对上的键；没有二维码/解不出/对不上返回 None（交给正常识别）。
+    """
+    q = parse_vat_qr(decode_image(data) or "")
+    key = invoice_key({"invoice_number": q["fphm"], "invoice_code": q["fpdm"]}) if q else None
+    if key is None:
+        return None
+    return key if any(invoice_key(inv) == key for inv in near.get("invoices") or []) else None
+
+
+class NearDupIndex:
+    """BK 树常驻内存；持久化在 invoice_index 的 phashes 表，首次使用时整体加载"""
+    def __init__(self, max_distance: int = PHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._tree: Optional[BKTree] = None
+        self._lock = threading.Lock()
+
+    def _loaded(self) -> Optional[BKTree]:
+        if self._tree is None:
+            index = get_index()
+            if index is None:
+                return None
+            tree = BKTree()
+            for h, content_hash, filename, ts in index.load_phashes() or []:
+                tree.add(h, {"content_hash": content_hash, "filename": filename, "first_seen": ts})
+            self._tree = tree
+        return self._tree
+
+    def lookup(self, h: int) -> Optional[Dict[str, Any]]:
+        """
+        命中返回 {"distance", "filename", "first_seen", "invoices"}，invoices 为上次的识别结果（确认后复用）；
+        上次的识别结果已不在索引里时视为未命中。
+        """
+        with self._lock:
+            tree = self._loaded()
+            hit = tree.nearest(h, self.max_distance) if tree is not None else None
+        if hit is None:
+            return None
+        d, meta = hit
+        invoices = get_index().lookup_content(meta["content_hash"])
+        if not invoices:
+            return None
+        return {"distance": d, "filename": meta["filename"], "invoices": invoices,
+                "first_seen": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta["first_seen"]))}
+
+    def add(self, h: int, content_hash: str, filename: str = "") -> bool:
+        """只登记已经成功识别并入库的文件（否则以后命中也没有结果可复用）"""
+        index = get_index()
+        if index is None or not index.has_content(content_hash):
+            return False
+        with self._lock:
+            tree = self._loaded()
+            if tree is None:
+                return False
+            index.add_phash(h, content_hash, filename)
+            tree.add(h, {"content_hash": content_hash, "filename": filename or "", "first_seen": time.time()})
+        return True
+
+
+NEAR_DUP = NearDupIndex()
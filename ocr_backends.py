@@ -0,0 +1,257 @@
+# ocr_backends.py — OCR 后端抽象：百度增值税发票 OCR / 本地 Tesseract，按配额、延迟、文件类型路由
+# -*- coding: utf-8 -*-
+import io
+import os
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from resilience import get_breaker, call_timeout, DeadlineExceeded
+from metrics import span
+import profiler
+
+logger = logging.getLogger("ocr_backends")
+
+try:  # 本地 OCR 全部可选：没装就只有百度
+    import pytesseract
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    pytesseract = Image = None
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # pragma: no cover
+    pdfium = None
+
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto")                          # auto / baidu / local
+LOCAL_LANG = os.getenv("OCR_LOCAL_LANG", "chi_sim+eng")
+LOCAL_WORKERS = int(os.getenv("OCR_LOCAL_WORKERS", "2"))
+LOCAL_QUEUE = int(os.getenv("OCR_LOCAL_QUEUE", str(LOCAL_WORKERS * 2)))  # 进程池排队上限
+LOCAL_TIMEOUT = float(os.getenv("OCR_LOCAL_TIMEOUT", "60"))
+LOCAL_MAX_PAGES = int(os.getenv("OCR_LOCAL_MAX_PAGES", "10"))
+BAIDU_COOLDOWN = float(os.getenv("OCR_BAIDU_COOLDOWN", "30"))          # 18/19 限流后暂停百度的秒数
+BAIDU_SLOW_MS = float(os.getenv("OCR_BAIDU_SLOW_MS", "8000"))          # 百度延迟 EWMA 超过它就暂时让给本地
+
+QUOTA_CODES = {"17"}            # 日配额用尽：到北京时间 0 点重置
+THROTTLE_CODES = {"18", "19"}   # QPS / 并发超限（client 内部已退避重试过）
+_CN_TZ = timezone(timedelta(hours=8))
+
+
+def guess_kind(filename: str, kind: Optional[str] = None) -> str:
+    if kind:
+        return kind
+    name = (filename or "").lower()
+    return "pdf" if name.endswith(".pdf") else "ofd" if name.endswith(".ofd") else "image"
+
+
+def _next_quota_reset(now: float = None) -> float:
+    now_cn = datetime.fromtimestamp(now or time.time(), _CN_TZ)
+    return (now_cn.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)).timestamp()
+
+
+def _error_code(results: List[Dict[str, Any]]) -> str:
+    """从统一结果里取百度错误码（"17:Open api daily request limit reached" → "17"）"""
+    for r in results:
+        err = (r.get("invoice_info") or {}).get("__ocr_error__")
+        if err:
+            code = str((r.get("raw_ocr") or {}).get("error_code") or "").strip()
+            return code or str(err).split(":", 1)[0].strip()
+    return ""
+
+
+# —— 本地 OCR（子进程里执行，只返回纯文本） —— #
+def _tesseract_pages(data: bytes, kind: str, lang: str, max_pages: int) -> List[str]:
+    if kind == "pdf":
+        doc = pdfium.PdfDocument(data)
+        images = [doc[i].render(scale=300 / 72).to_pil() for i in range(min(len(doc), max_pages))]
+    else:
+        images = [Image.open(io.BytesIO(data))]
+    return [pytesseract.image_to_string(img.convert("L"), lang=lang) for img in images]
+
+
+class OcrBackend(ABC):
+    """后端接口：recognize 返回与 ocr_vat_all_from_bytes 相同的 [{"invoice_info", "raw_ocr"}, ...]"""
+    name = "base"
+    kinds = ("image", "pdf", "ofd")
+
+    def available(self) -> bool:
+        return True
+
+    def supports(self, kind: str) -> bool:
+        return kind in self.kinds and self.available()
+
+    @abstractmethod
+    def recognize(self, data, filename: str, kind: str) -> List[Dict[str, Any]]:
+        ...
+
+
+class BaiduBackend(OcrBackend):
+    name = "baidu"
+
+    def recognize(self, data, filename: str, kind: str) -> List[Dict[str, Any]]:
+        from invoice_extractor import baidu_ocr_all
+        return baidu_ocr_all(data, filename, kind=kind)
+
+
+class LocalOcrBackend(OcrBackend):
+    """
+    Tesseract 本地识别 → 文本 → parse_invoice_text 映射成 EMPTY_OCR。
+    在有界进程池里跑（OCR 是纯 CPU），排队超过 LOCAL_QUEUE 直接拒绝，避免压垮机器。
+    """
+    name = "local"
+    kinds = ("image", "pdf")
+
+    def __init__(self, workers: int = LOCAL_WORKERS, queue: int = LOCAL_QUEUE, lang: str = LOCAL_LANG):
+        self.workers = workers
+        self.lang = lang
+        self._slots = threading.BoundedSemaphore(max(1, queue))
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def available(self) -> bool:
+        return pytesseract is not None
+
+    def supports(self, kind: str) -> bool:
+        if kind == "pdf" and pdfium is None:
+            return False
+        return super().supports(kind)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def text(self, data, kind: str) -> List[str]:
+        """逐页纯文本；排队满/失败/超时抛 RuntimeError，请求预算耗尽抛 DeadlineExceeded"""
+        timeout = call_timeout(LOCAL_TIMEOUT)
+        if not self._slots.acquire(timeout=min(1, timeout)):
+            raise RuntimeError("local_ocr_busy")
+        try:
+            timeout = call_timeout(LOCAL_TIMEOUT)
+            fut = self._get_pool().submit(_tesseract_pages, bytes(data), kind, self.lang, LOCAL_MAX_PAGES)
+            with profiler.upstream("local_ocr"):
+                try:
+                    return fut.result(timeout=timeout)
+                except TimeoutError:
+                    fut.cancel()
+                    if timeout < LOCAL_TIMEOUT:
+                        raise DeadlineExceeded(f"local_ocr: request budget exhausted after {timeout:.2f}s")
+                    raise RuntimeError("local_ocr_timeout")
+        except (RuntimeError, DeadlineExceeded):
+            raise
+        except Exception as e:
+            raise RuntimeError(f"local_ocr_exception:{e}") from e
+        finally:
+            self._slots.release()
+
+    def recognize(self, data, filename: str, kind: str) -> List[Dict[str, Any]]:
+        try:
+            texts = self.text(data, kind)
+        except RuntimeError as e:
+            return [{"invoice_info": {"__ocr_error__": str(e)}, "raw_ocr": {}}]
+        except DeadlineExceeded as e:
+            # 与百度后端一致：预算耗尽给出错误，由上层记为 ocr 阶段降级
+            return [{"invoice_info": {"__ocr_error__": f"{type(e).__name__}:{e}"}, "raw_ocr": {}}]
+
+        from invoice_extractor import parse_invoice_text
+        out = []
+        for text in texts:
+            info = parse_invoice_text(text)
+            if info.get("invoice_number") or info.get("amount_in_figures") or info.get("total_amount"):
+                out.append({"invoice_info": info, "raw_ocr": {"engine": "tesseract", "chars": len(text)}})
+        return out or [{"invoice_info": {"__ocr_error__": "local_ocr_empty"}, "raw_ocr": {}}]
+
+
+class OcrRouter:
+    """
+    选后端：
+    - OFD 只有百度能读；PDF 本地需要 pypdfium2 栅格化
+    - 百度日配额用尽（17）→ 本地，直到北京时间次日 0 点
+    - 百度限流（18/19，已重试仍失败）或延迟 EWMA 过高 → 本地，冷却 BAIDU_COOLDOWN 秒后再试百度
+    - 百度失败且本地可用 → 本次再用本地兜底一次
+    """
+    def __init__(self, baidu: OcrBackend = None, local: OcrBackend = None, mode: str = OCR_BACKEND):
+        self.baidu = baidu or BaiduBackend()
+        self.local = local or LocalOcrBackend()
+        self.mode = mode
+        self.quota_reset_at = 0.0
+        self.cooldown_until = 0.0
+        self.latency_ewma_ms: Optional[float] = None
+        self.stats = {"baidu": 0, "local": 0, "fallback": 0}
+        self._lock = threading.Lock()
+
+    def baidu_blocked(self, now: float = None) -> Optional[str]:
+        now = now or time.time()
+        if now < self.quota_reset_at:
+            return "quota"
+        if now < self.cooldown_until:
+            return "throttled"
+        if get_breaker("baidu_ocr").state == "open":
+            return "circuit_open"
+        return None
+
+    def choose(self, kind: str) -> List[OcrBackend]:
+        """按优先级返回可用后端列表（第二个是兜底）"""
+        local_ok = self.local.supports(kind)
+        if self.mode == "baidu" or not local_ok:
+            return [self.baidu]
+        if self.mode == "local":
+            return [self.local]
+        if self.baidu_blocked():
+            return [self.local]
+        return [self.baidu, self.local]
+
+    def _observe_baidu(self, results: List[Dict[str, Any]], elapsed_ms: float):
+        code = _error_code(results)
+        with self._lock:
+            if code in QUOTA_CODES:
+                self.quota_reset_at = _next_quota_reset()
+                logger.warning("[OCR_ROUTER] 百度日配额用尽，切本地 OCR 至 %s (UTC+8)",
+                               f"{datetime.fromtimestamp(self.quota_reset_at, _CN_TZ):%Y-%m-%d %H:%M}")
+            elif code in THROTTLE_CODES:
+                self.cooldown_until = time.time() + BAIDU_COOLDOWN
+                logger.warning("[OCR_ROUTER] 百度限流 code=%s，%.0fs 内走本地 OCR", code, BAIDU_COOLDOWN)
+            elif not code:
+                ewma = self.latency_ewma_ms
+                self.latency_ewma_ms = elapsed_ms if ewma is None else 0.8 * ewma + 0.2 * elapsed_ms
+                if self.latency_ewma_ms > BAIDU_SLOW_MS:
+                    self.cooldown_until = time.time() + BAIDU_COOLDOWN
+                    self.latency_ewma_ms = None   # 冷却后重新测
+                    logger.warning("[OCR_ROUTER] 百度延迟过高（EWMA>%.0fms），%.0fs 内走本地 OCR",
+                                   BAIDU_SLOW_MS, BAIDU_COOLDOWN)
+
+    def recognize(self, data, filename: str, kind: str = None) -> List[Dict[str, Any]]:
+        kind = guess_kind(filename, kind)
+        results: List[Dict[str, Any]] = []
+        for i, backend in enumerate(self.choose(kind)):
+            t0 = time.perf_counter()
+            with span(f"ocr_{backend.name}"):
+                results = backend.recognize(data, filename, kind)
+            if backend is self.baidu:
+                self._observe_baidu(results, (time.perf_counter() - t0) * 1000)
+            with self._lock:
+                self.stats[backend.name] = self.stats.get(backend.name, 0) + 1
+                if i:
+                    self.stats["fallback"] += 1
+            if not _error_code(results):
+                for r in results:
+                    r["invoice_info"]["ocr_backend"] = backend.name
+                return results
+        return results
+
+
+_router: Optional[OcrRouter] = None
+_router_lock = threading.Lock()
+
+def get_router() -> OcrRouter:
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = OcrRouter()
+    return _router
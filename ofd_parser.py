@@ -0,0 +1,221 @@
+# ofd_parser.py — OFD 版式发票本地解析：ZIP 包 → XML → 发票要素，不走 OCR
+# -*- coding: utf-8 -*-
+"""
+OFD（GB/T 33190）就是一个 ZIP 包，发票要素本来就是结构化的：
+- OFD.xml → DocBody/DocRoot 指向 Doc_0/Document.xml
+- Document.xml → CustomTags：税务版式的“发票标签”文件，InvoiceNo/IssueDate/… 用 ObjectRef 指向页面上的文字对象
+- Document.xml → Pages（+ TemplatePage 模板页）：TextObject/TextCode 即票面文字，按坐标排成行
+- OFD.xml → DocInfo/CustomDatas：部分开票软件把号码/日期等直接写成键值
+- Document.xml → Attachments：数电票 OFD 常附带开票原始 XML（original_invoice.xml），原样带出
+read_ofd() 只负责把这些摊平；映射成 EMPTY_OCR、判断是否够用由 invoice_extractor 决定。
+"""
+import io
+import re
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional, Tuple
+
+OFD_MAX_MEMBER_BYTES = 8 * 1024 * 1024     # 单个 XML 解压后上限（防 ZIP 炸弹）
+OFD_MAX_PAGES = 10
+_LINE_TOL = 1.5                             # 同一行的纵坐标容差（毫米）
+
+# 税务发票标签 → EMPTY_OCR 字段
+TAG_FIELDS = {
+    "InvoiceCode": "invoice_code",
+    "InvoiceNo": "invoice_number",
+    "IssueDate": "invoice_date",
+    "InvoiceCheckCode": "check_code",
+    "BuyerName": "buyer_name",
+    "BuyerTaxID": "buyer_register_num",
+    "SellerName": "seller_name",
+    "SellerTaxID": "seller_register_num",
+    "TaxExclusiveTotalAmount": "total_amount",
+    "TaxTotalAmount": "total_tax",
+    "TaxInclusiveTotalAmount": "amount_in_figures",
+    "Note": "remark",
+}
+
+# DocInfo/CustomDatas 的中文键 → EMPTY_OCR 字段
+CUSTOM_DATA_FIELDS = {
+    "发票代码": "invoice_code",
+    "发票号码": "invoice_number",
+    "开票日期": "invoice_date",
+    "校验码": "check_code",
+    "购买方名称": "buyer_name",
+    "购买方纳税人识别号": "buyer_register_num",
+    "销售方名称": "seller_name",
+    "销售方纳税人识别号": "seller_register_num",
+    "合计金额": "total_amount",
+    "合计税额": "total_tax",
+    "价税合计": "amount_in_figures",
+}
+
+
+def _local(tag: str) -> str:
+    """去掉命名空间：{http://www.ofdspec.org/2016}Page → Page"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _children(el, name: str) -> List[ET.Element]:
+    return [c for c in el if _local(c.tag) == name]
+
+
+def _iter(el, name: str):
+    return (c for c in el.iter() if _local(c.tag) == name)
+
+
+def _first(el, name: str) -> Optional[ET.Element]:
+    return next(_iter(el, name), None)
+
+
+class _Package:
+    """ZIP 内按 OFD 的路径规则取 XML：/ 开头相对包根，否则相对引用它的文件所在目录"""
+    def __init__(self, data):
+        self.zf = zipfile.ZipFile(io.BytesIO(data))
+        self.names = {n.lstrip("/"): n for n in self.zf.namelist()}
+
+    def resolve(self, loc: str, base: str = "") -> str:
+        loc = (loc or "").strip().replace("\\", "/")
+        path = loc.lstrip("/") if loc.startswith("/") else posixpath.join(posixpath.dirname(base), loc)
+        return posixpath.normpath(path)
+
+    def xml(self, path: str) -> Optional[ET.Element]:
+        name = self.names.get(path)
+        if name is None:
+            return None
+        if self.zf.getinfo(name).file_size > OFD_MAX_MEMBER_BYTES:
+            return None
+        try:
+            return ET.fromstring(self.zf.read(name))
+        except ET.ParseError:
+            return None
+
+
+def _text_objects(root: Optional[ET.Element]) -> Dict[str, Tuple[float, float, str]]:
+    """内容层里的文字对象：{ID: (x, y, 文字)}，坐标取 Boundary 原点 + 首个 TextCode 偏移"""
+    out: Dict[str, Tuple[float, float, str]] = {}
+    if root is None:
+        return out
+    for obj in _iter(root, "TextObject"):
+        codes = _children(obj, "TextCode")
+        text = "".join(c.text or "" for c in codes).strip()
+        if not text:
+            continue
+        try:
+            bx, by = (float(v) for v in (obj.get("Boundary") or "0 0").split()[:2])
+            dx = float(codes[0].get("X") or 0)
+            dy = float(codes[0].get("Y") or 0)
+        except ValueError:
+            bx = by = dx = dy = 0.0
+        out[obj.get("ID") or ""] = (bx + dx, by + dy, text)
+    return out
+
+
+def _lines(objs: List[Tuple[float, float, str]]) -> List[str]:
+    """按纵坐标聚成行、行内按横坐标排；同一行的片段用两个空格隔开（与 PDF 文本层解析的分栏习惯一致）"""
+    rows: List[List[Tuple[float, float, str]]] = []
+    for o in sorted(objs, key=lambda o: (o[1], o[0])):
+        if rows and abs(rows[-1][0][1] - o[1]) <= _LINE_TOL:
+            rows[-1].append(o)
+        else:
+            rows.append([o])
+    return ["  ".join(t for _, _, t in sorted(r)) for r in rows]
+
+
+def _tag_value(el: ET.Element, objects: Dict[str, Dict[str, Tuple[float, float, str]]]) -> str:
+    """标签可能直接带文字，也可能是若干 ObjectRef(PageRef=页ID) → 页面文字对象"""
+    refs = list(_iter(el, "ObjectRef"))
+    if not refs:
+        return "".join(el.itertext()).strip()
+    parts = []
+    for r in refs:
+        page = objects.get(r.get("PageRef") or "") or {}
+        hit = page.get((r.text or "").strip())
+        if hit is None:                     # 有的文件 PageRef 缺省/写错：在所有页里找
+            hit = next((p[(r.text or "").strip()] for p in objects.values() if (r.text or "").strip() in p), None)
+        if hit:
+            parts.append(hit[2])
+    return "".join(parts).strip()
+
+
+def read_ofd(data) -> Optional[Dict[str, Any]]:
+    """
+    返回 {"fields": {EMPTY_OCR 字段: 原样文字}, "text": 票面文字（逐行）, "pages": 页数, "attachments": [XML 附件字节]}；
+    不是 OFD / 结构损坏返回 None。fields 只含标签/CustomData 里真正取到的值。
+    """
+    try:
+        pkg = _Package(data)
+    except (zipfile.BadZipFile, ValueError):
+        return None
+    try:
+        ofd = pkg.xml("OFD.xml")
+        if ofd is None:
+            return None
+        body = _first(ofd, "DocBody")
+        doc_root = _first(body, "DocRoot") if body is not None else None
+        if doc_root is None or not (doc_root.text or "").strip():
+            return None
+        doc_path = pkg.resolve(doc_root.text, "OFD.xml")
+        doc = pkg.xml(doc_path)
+        if doc is None:
+            return None
+
+        fields: Dict[str, str] = {}
+        for cd in _iter(body, "CustomData"):
+            key = CUSTOM_DATA_FIELDS.get((cd.get("Name") or "").strip())
+            if key and (cd.text or "").strip():
+                fields[key] = cd.text.strip()
+
+        # 模板页（“名称：”“合计”等固定文字常在模板里）+ 正文页
+        templates = {t.get("ID"): pkg.resolve(t.get("BaseLoc"), doc_path) for t in _iter(doc, "TemplatePage")}
+        objects: Dict[str, Dict[str, Tuple[float, float, str]]] = {}
+        texts: List[str] = []
+        pages = [p for p in _iter(doc, "Page") if p.get("BaseLoc")][:OFD_MAX_PAGES]
+        for page in pages:
+            page_path = pkg.resolve(page.get("BaseLoc"), doc_path)
+            page_xml = pkg.xml(page_path)
+            objs = _text_objects(page_xml)
+            objects[page.get("ID") or ""] = objs
+            merged = list(objs.values())
+            for tpl in (_iter(page_xml, "Template") if page_xml is not None else ()):
+                tpl_path = templates.get(tpl.get("TemplateID"))
+                if tpl_path:
+                    merged += list(_text_objects(pkg.xml(tpl_path)).values())
+            texts.append("\n".join(_lines(merged)))
+
+        # 发票标签：CustomTags.xml → CustomTag/FileLoc → 标签文件
+        tags_loc = _first(doc, "CustomTags")
+        if tags_loc is not None and (tags_loc.text or "").strip():
+            tags_path = pkg.resolve(tags_loc.text, doc_path)
+            tags = pkg.xml(tags_path)
+            for loc in (_iter(tags, "FileLoc") if tags is not None else ()):
+                tag_root = pkg.xml(pkg.resolve(loc.text, tags_path))
+                if tag_root is None:
+                    continue
+                for el in tag_root.iter():
+                    key = TAG_FIELDS.get(_local(el.tag))
+                    if key and not fields.get(key):
+                        val = _tag_value(el, objects)
+                        if val:
+                            fields[key] = val
+
+        # 附件：Attachments.xml → Attachment/FileLoc；只带出 XML（开票原始数据），其余（签章图片等）不读
+        attachments: List[bytes] = []
+        atts_loc = _first(doc, "Attachments")
+        if atts_loc is not None and (atts_loc.text or "").strip():
+            atts_path = pkg.resolve(atts_loc.text, doc_path)
+            atts = pkg.xml(atts_path)
+            for loc in (_iter(atts, "FileLoc") if atts is not None else ()):
+                name = pkg.names.get(pkg.resolve(loc.text, atts_path))
+                if name and name.lower().endswith(".xml") and pkg.zf.getinfo(name).file_size <= OFD_MAX_MEMBER_BYTES:
+                    attachments.append(pkg.zf.read(name))
+    except (zipfile.BadZipFile, KeyError, RuntimeError, OSError):
+        return None
+    return {"fields": fields, "text": "\n\n".join(texts), "pages": len(pages), "attachments": attachments}
+
+
+def ofd_money(s: str) -> str:
+    """票面金额去 ¥/千分位；*** 之类（免税）原样返回空串交给调用方"""
+    m = re.search(r"-?\d[\d,]*(?:\.\d+)?", s or "")
+    return m.group(0).replace(",", "") if m else ""
@@ -0,0 +1,104 @@
+# payload_buffer.py — 上传文件的内存/磁盘缓冲（小文件纯内存，大文件落盘 + mmap，零拷贝给 OCR）
+# -*- coding: utf-8 -*-
+import os
+import mmap
+import tempfile
+from typing import Optional
+
+SPILL_THRESHOLD = int(os.getenv("UPLOAD_SPILL_BYTES", str(8 * 1024 * 1024)))  # 超过 8MB 才落盘
+TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "/tmp")
+
+
+class PayloadBuffer:
+    """
+    逐块写入上传内容：
+    - 总量 ≤ spill_threshold：留在一块 bytearray 里
+    - 超过阈值：整体转存到临时文件，读取时 mmap 映射，不再进 Python 堆
+    view() 给出 memoryview，一路传到 OCR client，中间不复制。
+    close() 保证删除临时文件（也可用 with 语句）。
+    """
+    def __init__(self, filename: str = "", spill_threshold: int = SPILL_THRESHOLD):
+        self.filename = filename or ""
+        self.spill_threshold = spill_threshold
+        self.size = 0
+        self._mem: Optional[bytearray] = bytearray()
+        self._file = None
+        self.path: Optional[str] = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    @property
+    def spilled(self) -> bool:
+        return self.path is not None
+
+    def write(self, chunk) -> None:
+        if not chunk:
+            return
+        if self._file is None and self.size + len(chunk) > self.spill_threshold:
+            self._spill()
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._mem += chunk
+        self.size += len(chunk)
+
+    def _spill(self) -> None:
+        suffix = os.path.splitext(self.filename)[-1].lower() or ".bin"
+        fd, self.path = tempfile.mkstemp(prefix="upload_", suffix=suffix, dir=TMP_DIR)
+        self._file = os.fdopen(fd, "wb")
+        if self._mem:
+            self._file.write(self._mem)
+        self._mem = None
+
+    def view(self) -> memoryview:
+        """只读视图；落盘的文件首次调用时 mmap。"""
+        if self._file is None:
+            return memoryview(self._mem).toreadonly()
+        if self._mmap is None:
+            self._file.flush()
+            if self.size == 0:
+                return memoryview(b"")
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def head(self, n: int = 1024) -> bytes:
+        return bytes(self.view()[:n])
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 仍有 memoryview 没释放：交给 GC；文件照删（POSIX 下已打开的映射不受影响）
+                pass
+            self._mmap = None
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self._mem = bytearray()
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.size
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,213 @@
+# profiler.py — 按请求开启的墙钟采样 profiler：折叠栈（flamegraph.pl / speedscope 可直接读）
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import uuid
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/reimburse_profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))      # 采样间隔
+PROFILE_MIN_INTERVAL_S = float(os.getenv("PROFILE_MIN_INTERVAL_S", "30"))  # 两次 profile 的最小间隔（全进程）
+PROFILE_MAX_S = float(os.getenv("PROFILE_MAX_S", "60"))                # 单次最长采样时间
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))                    # 目录里最多保留多少份
+_ID_CHARS = set("0123456789abcdef")
+
+
+class ProfileSession:
+    """
+    一次请求的采样会话：只采登记过的线程（入口线程 + submit_in_context 派发的工作线程），
+    线程阻塞在外部依赖上时栈顶追加 [upstream:名称] 帧，火焰图里直接看到各依赖占了多少墙钟时间。
+    """
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS, max_s: float = PROFILE_MAX_S):
+        self.id = uuid.uuid4().hex[:16]
+        self.interval = max(0.001, interval_ms / 1000)
+        self.max_s = max_s
+        self.threads: Set[int] = set()
+        self.seen: Set[int] = set()              # 采到过的线程（含已退出会话的工作线程）
+        self.upstream: Dict[int, str] = {}       # 线程 → 当前阻塞的依赖
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = self.ended = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        self.ended = time.time()
+
+    def _run(self):
+        deadline = time.monotonic() + self.max_s
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            for tid in list(self.threads):
+                f = frames.get(tid)
+                if f is None:
+                    continue
+                self.seen.add(tid)
+                stack: List[str] = []
+                while f is not None:
+                    co = f.f_code
+                    stack.append(f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})")
+                    f = f.f_back
+                stack.reverse()
+                dep = self.upstream.get(tid)
+                if dep:
+                    stack.append(f"[upstream:{dep}]")
+                self.stacks[";".join(s.replace(";", ",") for s in stack)] += 1
+                self.samples += 1
+
+    def folded(self) -> str:
+        """折叠栈文本：每行 "帧;帧;帧 次数"，前面几行 # 注释是元信息"""
+        ms = self.interval * 1000
+        head = [f"# profile {self.id} samples={self.samples} interval_ms={ms:g} "
+                f"wall_s={self.ended - self.started:.3f} threads={len(self.seen)}"]
+        per_dep = Counter()
+        for stack, n in self.stacks.items():
+            if stack.endswith("]") and "[upstream:" in stack:
+                per_dep[stack.rsplit("[upstream:", 1)[1][:-1]] += n
+        for dep, n in per_dep.most_common():
+            head.append(f"# upstream {dep} ~{n * ms:.0f}ms (sampled, summed over threads)")
+        body = [f"{s} {n}" for s, n in self.stacks.most_common()]
+        return "\n".join(head + body) + "\n"
+
+
+_session: contextvars.ContextVar = contextvars.ContextVar("profile_session", default=None)
+_gate = threading.Lock()
+_last_started = 0.0
+_running = False
+
+
+def _acquire() -> bool:
+    """全进程同一时间只跑一个 profile，且两次之间至少隔 PROFILE_MIN_INTERVAL_S"""
+    global _last_started, _running
+    with _gate:
+        now = time.monotonic()
+        if _running or (_last_started and now - _last_started < PROFILE_MIN_INTERVAL_S):
+            return False
+        _running, _last_started = True, now
+        return True
+
+
+def _release():
+    global _running
+    with _gate:
+        _running = False
+
+
+@contextmanager
+def maybe_profile(requested: bool):
+    """
+    requested 为真且未被限流时采样 with 块，yield 会话（结束后已落盘，.id 可用于取回）；
+    否则 yield None，with 块照常执行、零开销。
+    """
+    if not requested or not _acquire():
+        yield None
+        return
+    sess = ProfileSession()
+    sess.threads.add(threading.get_ident())
+    token = _session.set(sess)
+    sess.start()
+    try:
+        yield sess
+    finally:
+        sess.stop()
+        _session.reset(token)
+        _release()
+        try:
+            save(sess)
+        except OSError:
+            pass
+
+
+def run_in_scope(fn, *args, **kwargs):
+    """工作线程入口（由 submit_in_context 调用）：请求在 profile 中时把本线程登记进采样集合"""
+    sess = _session.get()
+    if sess is None:
+        return fn(*args, **kwargs)
+    tid = threading.get_ident()
+    sess.threads.add(tid)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sess.threads.discard(tid)
+        sess.upstream.pop(tid, None)
+
+
+@contextmanager
+def upstream(name: str):
+    """标记当前线程正阻塞在某个外部依赖上（无 profile 时只是一次 contextvar 读取）"""
+    sess = _session.get()
+    if sess is None:
+        yield
+        return
+    tid = threading.get_ident()
+    prev = sess.upstream.get(tid)
+    sess.upstream[tid] = name
+    try:
+        yield
+    finally:
+        if prev is None:
+            sess.upstream.pop(tid, None)
+        else:
+            sess.upstream[tid] = prev
+
+
+# —— 落盘 / 取回 —— #
+def _path(pid: str) -> str:
+    return os.path.join(PROFILE_DIR, f"{pid}.folded")
+
+
+def save(sess: ProfileSession) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = _path(sess.id)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(sess.folded())
+    os.replace(tmp, path)
+    _prune()
+    return path
+
+
+def _prune():
+    files = sorted((os.path.join(PROFILE_DIR, fn) for fn in os.listdir(PROFILE_DIR) if fn.endswith(".folded")),
+                   key=os.path.getmtime, reverse=True)
+    for p in files[PROFILE_KEEP:]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def list_profiles() -> List[Dict[str, object]]:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    out = []
+    for fn in os.listdir(PROFILE_DIR):
+        if fn.endswith(".folded"):
+            p = os.path.join(PROFILE_DIR, fn)
+            st = os.stat(p)
+            out.append({"id": fn[:-len(".folded")], "bytes": st.st_size, "created": int(st.st_mtime)})
+    return sorted(out, key=lambda x: x["created"], reverse=True)
+
+
+def load(pid: str) -> Optional[str]:
+    """按 id 取折叠栈文本；id 只允许十六进制，防路径穿越"""
+    if not pid or not set(pid) <= _ID_CHARS:
+        return None
+    try:
+        with open(_path(pid), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
@@ -0,0 +1,148 @@
+# qr_decoder.py — 发票二维码本地识别：图片 / PDF 页 → 二维码串 → 验真五要素
+# -*- coding: utf-8 -*-
+import io
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+# 解码后端全部可选：优先 OpenCV，其次 pyzbar；都没有就返回 None，流程照常走 OCR
+try:
+    import numpy as np
+    import cv2
+except ImportError:  # pragma: no cover
+    cv2 = None
+try:
+    from pyzbar import pyzbar
+except ImportError:  # pragma: no cover
+    pyzbar = None
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+try:  # 可选：把 PDF 页栅格化（矢量二维码没有内嵌图片时用）
+    import pypdfium2 as pdfium
+except ImportError:  # pragma: no cover
+    pdfium = None
+
+QR_MAX_EDGE = int(os.getenv("QR_MAX_EDGE", "1600"))   # 解码前把长边缩到这以内：票面二维码仍有 ~4px/模块，检测耗时随像素数线性涨
+
+# 数电票（全电发票）的票种代码：二维码里的金额是价税合计
+DIGITAL_FPLX = {"31", "32", "51", "61", "83", "84"}
+_DATE8 = re.compile(r"^\d{8}$")
+
+
+def parse_vat_qr(text: str) -> Optional[Dict[str, Any]]:
+    """
+    解析国标增值税发票二维码：
+    01,发票种类,发票代码,发票号码,金额,开票日期(YYYYMMDD),校验码,随机码/CRC
+    数电票发票代码、校验码为空。格式不符返回 None。
+    """
+    if not text:
+        return None
+    parts = [p.strip() for p in re.split(r"[,，]", text.strip())]
+    if len(parts) < 6 or parts[0] != "01":
+        return None
+    fplx, fpdm, fphm, je, kprq = parts[1], parts[2], parts[3], parts[4], parts[5]
+    jym = parts[6] if len(parts) > 6 else ""
+    if not (fphm.isdigit() and _DATE8.match(kprq)):
+        return None
+    try:
+        je = f"{float(je):.2f}"
+    except ValueError:
+        je = ""
+    return {
+        "fplx": fplx,
+        "fpdm": fpdm if fpdm.isdigit() else "",
+        "fphm": fphm,
+        "je": je,
+        "kprq": f"{kprq[:4]}-{kprq[4:6]}-{kprq[6:]}",
+        "jym": jym[-6:] if jym else "",
+        "is_digital": fplx in DIGITAL_FPLX or len(fphm) == 20,
+    }
+
+
+def qr_fields_complete(q: Optional[Dict[str, Any]]) -> bool:
+    """号码 + 日期 + 金额齐全即可发起验真"""
+    return bool(q and q.get("fphm") and q.get("kprq") and q.get("je"))
+
+
+def _bounded(img, max_edge: int = QR_MAX_EDGE):
+    """只在一份缩小的灰度图上找二维码：JPEG 直接按 1/2~1/8 解码（draft），再缩到 max_edge 以内"""
+    w, h = img.size
+    if max(w, h) > max_edge:
+        s = max_edge / max(w, h)
+        img.draft("L", (int(w * s), int(h * s)))
+    img = img.convert("L")
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.BILINEAR)
+    return img
+
+
+def _decode_pil(img) -> Optional[str]:
+    img = _bounded(img)
+    if cv2 is not None:
+        txt, _, _ = cv2.QRCodeDetector().detectAndDecode(np.asarray(img))
+        if txt:
+            return txt
+    if pyzbar is not None:
+        for sym in pyzbar.decode(img):
+            if sym.type == "QRCODE":
+                return sym.data.decode("utf-8", "ignore")
+    return None
+
+
+def available() -> bool:
+    """装了 Pillow 且至少有一个解码后端"""
+    return Image is not None and (cv2 is not None or pyzbar is not None)
+
+
+def decode_image(data) -> Optional[str]:
+    """图片字节 → 二维码串；未装解码库/没找到返回 None。"""
+    if not available():
+        return None
+    try:
+        return _decode_pil(Image.open(io.BytesIO(data)))
+    except Exception:
+        return None
+
+
+def decode_pdf_pages(data, max_pages: int = 20, only=None) -> List[Optional[str]]:
+    """
+    逐页找二维码：先试页内嵌入的位图（电子发票常见），再（装了 pypdfium2 时）栅格化整页。
+    返回与页对应的列表，没找到的页（以及 only 之外的页）为 None。
+    """
+    if not available():
+        return []
+    out: List[Optional[str]] = []
+    try:
+        from PyPDF2 import PdfReader
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted and not reader.decrypt(""):
+            return []
+        for idx, page in enumerate(reader.pages[:max_pages]):
+            found = None
+            if only is not None and idx not in only:
+                out.append(None)
+                continue
+            try:
+                for im in page.images:
+                    found = decode_image(im.data)
+                    if found:
+                        break
+            except Exception:
+                pass
+            if not found and pdfium is not None:
+                found = _decode_rendered_page(data, idx)
+            out.append(found)
+    except Exception:
+        return out
+    return out
+
+
+def _decode_rendered_page(data, idx: int) -> Optional[str]:
+    try:
+        doc = pdfium.PdfDocument(bytes(data))
+        img = doc[idx].render(scale=2).to_pil()
+        return _decode_pil(img)
+    except Exception:
+        return None
@@ -5,12 +5,37 @@ import os
 import tempfile
 from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
+from decimal import Decimal
 import re
 import json
-from urllib.parse import quote
+import time
+import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from qr_decoder import parse_vat_qr
+from resilience import (submit_in_context, deadline, track_degraded, mark_degraded, has_budget,
+                        CircuitOpenError, DeadlineExceeded, MIN_CALL_TIMEOUT, LLM_STAGE_MIN_S)
+from metrics import span, STAGE_SECONDS, EXTRACT_ROUTES, UPSTREAM_CALLS
+from log_utils import log_payload
+from invoice_validator import repair_verify_payload, calendar_date, money
+from invoice_record import InvoiceRecord, iso_date
+from invoice_index import get_index
+from evidence_extractor import PendingEvidence, merge_evidence
+from singleflight import content_key
+from knowledge_retriever import PACK_STAGE_DOCS, CitationResolver
 
 HARD_THRESHOLD_SCORE = 0.85  # 关键词打分达到则直接采用该会计科目
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))  # 多票文件并发处理的票数上限
+PIPELINE_DEADLINE_S = float(os.getenv("PIPELINE_DEADLINE_S", "14"))  # 单张票全流程预算（SLA p99 < 15s）
+VERIFY_STAGE_MIN_S = 1.0                                            # 首次验真至少要的预算
+VERIFY_RECHECK_MIN_S = LLM_STAGE_MIN_S + 1.0                        # 补齐金额后的复验：留够后面 LLM 的预算才做
+EVIDENCE_AMOUNT_TOL = Decimal("0.05")                               # 佐证金额与发票金额的容差
+
+logger = logging.getLogger("reimbursement_processor")
+
+_BARE_CITATIONS = CitationResolver()      # retriever 不带来源表时的兜底（无 URL）
 
 KB_DIR = Path(__file__).resolve().parent  # 如果知识库就在同目录；否则改成你的 kb 目录
 
@@ -71,64 +96,8 @@ def _load_kb_terms():
 EXPENSE_TYPES, ACCOUNT_SUBJECTS, KEYWORD_MAP = _load_kb_terms()
 
 import re
-from ast import literal_eval
-
-def _scrub_title(title: str) -> str:
-    """把类似 "{'title': '公司报销规则', 'url': ''}" 这种被塞进 title 的脏字符串，拆成干净标题。"""
-    if not isinstance(title, str):
-        return str(title)
-    t = title.strip()
-    # 1) 直接从形如 "{'title': 'xxx', 'url': ''}" 抠 'title'
-    m = re.search(r"'title'\s*:\s*'([^']+)'", t)
-    if m:
-        return m.group(1).strip()
-
-    # 2) 尝试把整串当 dict 解析，再取 title
-    if (t.startswith("{") and t.endswith("}")) or (t.startswith("[") and t.endswith("]")):
-        try:
-            obj = literal_eval(t)
-            if isinstance(obj, dict) and obj.get("title"):
-                return str(obj.get("title")).strip()
-        except Exception:
-            pass
-
-    # 3) 去掉路径和后缀，保留文件名主体
-    base = t.rsplit("/", 1)[-1]
-    base = base.rsplit("\\", 1)[-1]
-    base = re.sub(r"\.(md|txt|pdf|docx?)$", "", base, flags=re.IGNORECASE)
-    return base or "未知来源"
-def _coerce_float_or_none(x):
-    """把任何奇怪的分数安全转成 float 或 None。字符串空/None/转不动的，一律 None。"""
-    if x is None:
-        return None
-    if isinstance(x, str):
-        s = x.strip()
-        if s == "" or s.lower() in {"none", "null", "nan"}:
-            return None
-        try:
-            return float(s)
-        except Exception:
-            return None
-    try:
-        return float(x)
-    except Exception:
-        return None
-
-def _safe_score(v) -> float | None:
-    """把不可解析/为 0 的分数统一处理；0 -> None（前端大多不显示 None）。"""
-    try:
-        f = float(v)
-        return None if f == 0.0 else f
-    except Exception:
-        return None
 
 # --------------------------- 小工具 ---------------------------
-def _safe_float(x, default=0.0):
-    try:
-        return float(str(x).replace(",", "").strip())
-    except Exception:
-        return default
-
 def _has_any(texts: list[str], keys: list[str]) -> bool:
     t = " ".join([x for x in texts if x]).lower()
     return any(k in t for k in keys)
@@ -210,7 +179,7 @@ def infer_category_from_invoice(invoice_data: dict) -> dict:
     ]
     # goodsData 名称
     try:
-        for g in (invoice_data.get("verify_result") or {}).get("data", {}).get("goodsData", []):
+        for g in (invoice_data.get("verify_result") or {}).get("data", {}).get("goodsData", []) or invoice_data.get("goodsData") or []:
             bag_fields.append(g.get("name",""))
     except Exception:
         pass
@@ -269,23 +238,6 @@ def _choose_account_from_keywords(goods_names, user_note, remark):
     return ""
 
 
-def _parse_date_cn(date_str: Optional[str]):
-    from datetime import datetime as _dt
-    if not date_str:
-        return None
-    s = str(date_str).strip().replace("/", "-").replace("年", "-").replace("月", "-").replace("日", "")
-    if len(s) == 8 and s.isdigit():
-        try:
-            return _dt.strptime(f"{s[:4]}-{s[4:6]}-{s[6:]}", "%Y-%m-%d")
-        except Exception:
-            pass
-    for fmt in ("%Y-%m-%d",):
-        try:
-            return _dt.strptime(s, fmt)
-        except Exception:
-            continue
-    return None
-
 def json_dump(x: Any) -> str:
     return json.dumps(x, ensure_ascii=False, indent=2)
 
@@ -331,243 +283,6 @@ def _enforce_now_date_in_text(text: Any, now_date: Optional[str]) -> Any:
     nd = now_date.replace("-", "年", 1).replace("-", "月", 1) + "日" if "-" in now_date else now_date
     return re.sub(r"当前日期[为是]\s*\d{4}年\d{1,2}月\d{1,2}日", f"当前日期为{nd}", text)
 
-# —— 金额字段归一化：不含税/税额/含税三者互推 ——
-def _normalize_amount_fields(inv: Dict[str, Any]) -> Dict[str, Any]:
-    excl = _safe_float(inv.get("amount_excl_tax") or inv.get("total_amount"))
-    tax  = _safe_float(inv.get("total_tax"))
-    incl = _safe_float(inv.get("amount_in_figures"))
-
-    # 如果缺含税，用 不含税+税额 补
-    if incl == 0 and (excl or tax):
-        incl = round(excl + tax, 2)
-        inv["amount_in_figures"] = incl
-
-    # 如果缺税额，用 含税-不含税 补
-    if tax == 0 and incl and excl:
-        tax = round(incl - excl, 2)
-        inv["total_tax"] = tax
-
-    # 兜底把 amount_excl_tax / total_amount 都写上，方便前端映射
-    if not inv.get("amount_excl_tax") and excl:
-        inv["amount_excl_tax"] = round(excl, 2)
-    if not inv.get("total_amount") and excl:
-        inv["total_amount"] = round(excl, 2)
-
-    return inv
-
-
-def _hits_to_sources(hits):
-    # hits 每条形如 {"doc","path","url","content","score"}
-    out = []
-    for h in (hits or []):
-        title = h.get("doc") or os.path.basename(h.get("path",""))
-        url = h.get("url")
-        if not url and h.get("path"):
-            # 兜底：万一 retriever 没给 url
-            kb = os.getenv("KB_DIR") or os.path.join(os.path.dirname(__file__), "knowledge_base")
-            rel = os.path.relpath(h["path"], kb).replace(os.sep, "/")
-            base = os.getenv("PUBLIC_KB_BASE", "").rstrip("/")
-            url = f"{base}/{quote(rel, safe='/')}" if base else None
-        out.append({"title": title, "url": url, "score": round(float(h.get("score",0)), 4)})
-    return out
-
-# --------------------------- 来源规范化 ---------------------------
-def _fix_sources_field(block: dict, contexts: list = None) -> dict:
-    """
-    统一把 block["sources_used"] / block["sources"] 清洗成:
-    [{'title': str, 'url': str|None, 'score': float|None}]
-    - 兼容字符串/字典/混合输入
-    - 去路径、去扩展名、去"嵌套 title"
-    - 分数安全转换；对0分或结构化上下文来源不展示分数
-    - 去重
-    """
-    items = _merge_sources(block.get("sources_used"), block.get("sources"))
-
-    def _to_item(x):
-        d = _normalize_source(x)  # -> {'title','url','score'}
-        # 1) 处理"嵌套 title"或把整个 dict 当字符串的情况
-        t = d.get("title")
-        if isinstance(t, str) and t.startswith("{'title':"):
-            d["title"] = "未知来源"
-        # 2) 去掉常见噪声：路径/扩展名/多余括号等（有 _scrub_title 就用；没有就保留原值）
-        try:
-            d["title"] = _scrub_title(d["title"])  # 你之前加的小工具
-        except Exception:
-            pass
-        # 3) 分数安全转换（有 _safe_score 就用；没有就保留原值）
-        try:
-            d["score"] = _safe_score(d.get("score"))
-        except Exception:
-            # 兜底：把非数值分数清成 None
-            try:
-                d["score"] = float(d.get("score"))
-            except Exception:
-                d["score"] = None
-        return d
-
-    clean = [_to_item(x) for x in (items or []) if x]
-
-    # 4) 对"结构化上下文"来源或明显为辅助来源的，隐藏score（避免前端看到一堆 0）
-    STRUCT_TITLES = {"系统当前时间", "结构化规则-审批阈值", "结构化-调用侧上下文汇总"}
-    for it in clean:
-        title = (it.get("title") or "").strip()
-        if title in STRUCT_TITLES or (it.get("score") in (0, 0.0, "0", "0.0")):
-            it["score"] = None
-
-    # 5) 去重
-    block["sources_used"] = _dedup_sources(clean)
-
-    # 6) 最后再清一次对象里的 None/空串
-    return _clean_obj(block)
-
-def _normalize_sources(sources):
-    out = []
-    for s in (sources or []):
-        if isinstance(s, dict) and s.get("title"):
-            out.append({"title": s["title"], "url": s.get("url"), "score": s.get("score", 0)})
-        elif isinstance(s, str) and s.strip():
-            base = os.getenv("PUBLIC_KB_BASE", "").rstrip("/")
-            url = f"{base}/{quote(s)}" if base else None
-            out.append({"title": os.path.splitext(os.path.basename(s))[0], "url": url, "score": 0})
-    return out
-
-# ---- utils: normalize + merge sources (REPLACE WHOLE) ----
-def _normalize_source(s):
-    """
-    把任意形态的来源项规范成统一字典：
-    {"title": "...", "url": str|None, "score": float}
-    - 去路径、去扩展名，title 只留文件名主体
-    """
-    import os
-    from urllib.parse import quote
-
-    if not s:
-        return None
-
-    if isinstance(s, str):
-        title = os.path.splitext(os.path.basename(s.strip()))[0]
-        title = _scrub_title(title)  # << 新增：拆掉嵌在 title 里面的 dict 串
-        return {"title": title, "url": None, "score": 0.0}
-        
-
-    if isinstance(s, dict):
-        title = (
-            s.get("title")
-            or s.get("source")
-            or s.get("doc")
-            or s.get("file")
-            or s.get("name")
-        )
-        if not title:
-            return None
-        # 标题统一为"文件名主体"
-        title = os.path.splitext(os.path.basename(str(title)))[0]
-
-        url = s.get("url")
-        if url and not isinstance(url, str):
-            url = str(url)
-
-        score = s.get("score", 0)
-        try:
-            score = float(score)
-        except Exception:
-            score = 0.0
-
-        return {"title": title, "url": url or None, "score": score}
-
-    # 其他类型：兜底
-    return {"title": os.path.splitext(os.path.basename(str(s)))[0], "url": None, "score": 0.0}
-
-
-def _dedup_sources(items):
-    """
-    去重 & 统一结构:
-    input: 可能是 str/dict 混合；title 里可能带 {'title': ...}
-    output: [{'title': str, 'url': str|None, 'score': float|None}]
-    """
-    if not items:
-        return []
-
-    seen = set()
-    out = []
-
-    for it in items:
-        # 1) 统一成 dict
-        if isinstance(it, str):
-            # 处理 "{"title": "..."}" 这种脏字符串
-            t = it
-            if t.startswith("{'title':") or t.startswith('{"title":'):
-                title = "未知来源"
-            else:
-                title = t
-            url = None
-            score = None
-        elif isinstance(it, dict):
-            title = it.get("title") or it.get("name") or "未知来源"
-            # 把 "{'title': ...}" 这种再清一次
-            if isinstance(title, str) and (title.startswith("{'title':") or title.startswith('{"title":')):
-                title = "未知来源"
-            url = it.get("url") or it.get("link") or None
-            score = _coerce_float_or_none(it.get("score"))
-        else:
-            # 非法类型直接跳
-            continue
-
-        # 2) 标题再做一次轻清洗（去掉明显的路径/扩展名噪声）
-        if isinstance(title, str):
-            t = title.strip()
-            # 常见文件扩展名和路径痕迹简单裁剪
-            for bad in (".md", ".txt", ".pdf"):
-                if t.endswith(bad):
-                    t = t[: -len(bad)]
-            t = t.replace("\\", "/")
-            if "/" in t:
-                t = t.split("/")[-1]
-            # 括号/全角空格等简单收拾
-            t = t.replace("（RAGflow 版）", "RAGflow 版").replace("（", "(").replace("）", ")")
-            title = t or "未知来源"
-
-        # 3) 组 key 去重
-        key = (title, url or "")
-        if key in seen:
-            continue
-        seen.add(key)
-
-        # 4) 输出时分数保持 None（隐藏 0 分视觉噪音）
-        out.append({"title": title, "url": (url or None), "score": score})
-
-    return out
-
-
-def _sources_from_contexts(ctxs):
-    """
-    contexts 里可能是 dict / str / 混合；这里统一抽成来源字典数组。
-    """
-    out = []
-    for c in (ctxs or []):
-        if isinstance(c, dict):
-            out.append(
-                _normalize_source({
-                    "title": c.get("source") or c.get("doc") or c.get("title") or c.get("file"),
-                    "url": c.get("url"),
-                    "score": c.get("score", 0),
-                })
-            )
-        else:
-            out.append(_normalize_source(c))
-    return _dedup_sources([x for x in out if x])
-
-
-def _merge_sources(a, b):
-    """合并两个来源列表（任意形态），规范化 + 去重。"""
-    items = []
-    for seq in (a or []), (b or []):
-        for s in (seq or []):
-            norm = _normalize_source(s)
-            if norm:
-                items.append(norm)
-    return _dedup_sources(items)
-
 # --------------------------- 二维码/文本 五要素解析 ---------------------------
 FPDM_PAT = re.compile(r"(?:fpdm|发票代码)[=:：\s]*([0-9]{10,12})")
 FPHM_PAT = re.compile(r"(?:fphm|发票号码|号码)[=:：\s]*([0-9]{8,20})")
@@ -579,19 +294,22 @@ CSV_LIKE_PAT = re.compile(
     r"\b01[,，]\s*([0-9]{10,12})[,，]\s*([0-9]{8,20})[,，]\s*([0-9]{8})[,，]\s*([0-9]{6})[,，]\s*(-?[0-9]+(?:\.[0-9]{1,2})?)"
 )
 
-def _norm_date8_or_dash(s: str) -> str:
-    s = str(s).strip().replace("/", "-").replace("年", "-").replace("月", "-").replace("日", "")
-    if re.fullmatch(r"\d{8}", s):
-        return f"{s[:4]}-{s[4:6]}-{s[6:]}"
-    return s
-
 def parse_from_qr_and_ocr(qr_text: str = "", ocr_text: str = "") -> Dict[str, Optional[str]]:
     raw = f"{qr_text}\n{ocr_text}".strip()
 
+    # 国标发票二维码（本地解码所得）：01,票种,代码,号码,金额,日期,校验码,CRC
+    q = parse_vat_qr(qr_text)
+    if q:
+        jym, inferred = q["jym"], False
+        if q["is_digital"] and not jym and len(q["fphm"]) >= 6:
+            jym, inferred = q["fphm"][-6:], True
+        return {"fpdm": q["fpdm"] or None, "fphm": q["fphm"], "kprq": q["kprq"], "je": q["je"] or None,
+                "jym": jym or None, "inferred": inferred, "is_digital": q["is_digital"], "route": "qr"}
+
     m = CSV_LIKE_PAT.search(raw)
     if m:
         fpdm, fphm, kprq, jym, je = m.groups()
-        return {"fpdm": fpdm, "fphm": fphm, "kprq": _norm_date8_or_dash(kprq),
+        return {"fpdm": fpdm, "fphm": fphm, "kprq": iso_date(kprq),
                 "je": je, "jym": jym, "inferred": False, "route": "csv-like"}
 
     def _pick(pat, raw_key=None):
@@ -610,7 +328,7 @@ def parse_from_qr_and_ocr(qr_text: str = "", ocr_text: str = "") -> Dict[str, Op
     jym  = _pick(JYM_PAT, "jym")
 
     if kprq:
-        kprq = _norm_date8_or_dash(kprq)
+        kprq = iso_date(kprq)
 
     looks_digital = False
     if fphm and len(fphm) == 20:
@@ -655,61 +373,120 @@ class ReimbursementProcessor:
         self.retriever = retriever
         self.verifier = verifier
 
-    def _safe_call(self, fn, fallback):
+    def _safe_call(self, fn, fallback, stage: str = None, min_budget: float = 0.0):
         """
         安全调用函数，即使出错也返回结果，确保HTTP状态为200
-        用于包装可能失败的分析步骤
+        用于包装可能失败的分析步骤；给了 stage 时，预算不足直接走兜底并记入 degraded_stages
         """
+        if stage and not has_budget(min_budget):
+            mark_degraded(stage)
+            return {**fallback, "degraded": True, "error": "时间预算不足，已跳过该分析"}
         try:
-            return fn() or fallback
+            with (span(stage) if stage else nullcontext()):
+                return fn() or fallback
         except Exception as e:
+            if stage and (isinstance(e, (CircuitOpenError, DeadlineExceeded)) or not has_budget(MIN_CALL_TIMEOUT)):
+                mark_degraded(stage)
             # 统一结构：让前端能展示错误卡片，而不是 500
             return {**fallback, "error": f"{type(e).__name__}: {e}"}
 
-    # 新增一个 run 方法，专门给 API 调用，它接收文件内容而不是路径
-    def run(self, file_content: bytes, filename: str, user_input: str = "") -> Dict[str, Any]:
-        import tempfile
-        import os
-
-        # 根据文件名判断是图片还是PDF
-        file_type = 'pdf' if filename.lower().endswith('.pdf') else 'image'
-
-        # 1. 在服务器上创建一个临时的空文件
-        # delete=False 意思是文件关闭后先别删掉，我们一会儿自己删
-        # suffix 可以给临时文件加个后缀，方便我们看日志时辨认
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{filename}") as temp_f:
-            # 2. 把接收到的文件内容，写入这个临时文件
-            temp_f.write(file_content)
-            # 3. 获取这个临时文件的完整路径
-            temp_path = temp_f.name
+    # 兼容旧 UI：吃 bytes 的入口（filename 可选，主要用于判断 pdf/ofd/image）
+    def run(self, file_bytes: bytes, filename: str = "upload.bin",
+            user_input: str = "", evidence_data=None) -> dict:
+        suffix = os.path.splitext(filename)[1].lower() or ".bin"
+        file_type = {".pdf": "pdf", ".ofd": "ofd", ".xml": "xml"}.get(suffix, "image")
+        return self.process_reimbursement(
+            file_type=file_type, user_input=user_input, evidence_data=evidence_data,
+            file_bytes=file_bytes, filename=filename,
+        )
 
-        try:
-            # 4. 用这个临时文件的路径，去调用你已经写好的、完整的处理流程
-            #    这完美复用了你现有的所有逻辑！
-            result = self.process_reimbursement(
-                temp_path,
-                file_type=file_type,
-                user_input=user_input
+    # ---------------- 批量：一份文件多张票（多页 PDF） ----------------
+    def process_reimbursement_batch(self, file_bytes, filename: str = "", file_type: str = "image",
+                                    user_input: str = "", evidence_data: Optional[List[Dict[str, Any]]] = None,
+                                    reuse_invoices: Optional[List[Dict[str, Any]]] = None,
+                                    evidence_files: Optional[List[Tuple[Any, str, str]]] = None) -> Dict[str, Any]:
+        """
+        拆出文件里的每一张票，各自走完整流程（并发）。
+        返回值顶层仍是第一张票的结果（兼容单票前端），另附 items=[每张票的结果] 与 invoice_count。
+        reuse_invoices：调用方已确认是翻拍件（近似哈希命中且二维码号码一致）时传入上次的识别结果，跳过 OCR。
+        evidence_files：[(内容, 文件名, 类型)]，与主票据并行抽取日期/金额/行程段，风控比对时再取。
+        """
+        fn = getattr(self.extractor, "extract_all_from_bytes", None)
+        if reuse_invoices:
+            def extract():
+                return [dict(inv, extract_route="phash_index") for inv in reuse_invoices]
+        elif fn is not None:
+            def extract():
+                return fn(file_bytes, filename, file_type=file_type) or []
+        else:
+            with deadline(PIPELINE_DEADLINE_S):
+                pending = PendingEvidence(evidence_files) if evidence_files else None
+                return self.process_reimbursement(file_type=file_type, user_input=user_input, evidence_data=evidence_data,
+                                                  file_bytes=file_bytes, filename=filename, evidence_pending=pending)
+        # 提取也计入整体预算；每张票的流程在剩余预算内各自再收紧
+        with deadline(PIPELINE_DEADLINE_S), track_degraded() as extract_degraded:
+            # 佐证先提交到后台，和主票据的 OCR/验真/LLM 同时跑
+            pending = PendingEvidence(evidence_files) if evidence_files else None
+            with span("extract"):
+                invoices = self._extract_indexed(file_bytes, extract)
+            if len(invoices) <= 1:
+                result = self.process_reimbursement(file_type=file_type, user_input=user_input, evidence_data=evidence_data,
+                                                    filename=filename, invoice_data=(invoices or [{}])[0],
+                                                    evidence_pending=pending)
+                result["degraded_stages"] = list(dict.fromkeys(extract_degraded + result.get("degraded_stages", [])))
+                return result
+            return self._process_batch_items(invoices, filename, file_type, user_input, evidence_data, extract_degraded,
+                                             pending)
+
+    def _process_batch_items(self, invoices, filename, file_type, user_input, evidence_data, extract_degraded,
+                             evidence_pending=None):
+        """多张票并发走完整流程；degraded_stages 汇总提取阶段与每张票的降级"""
+        def _one(inv):
+            return self._safe_call(
+                lambda: self.process_reimbursement(file_type=file_type, user_input=user_input,
+                                                   evidence_data=list(evidence_data or []),
+                                                   filename=filename, invoice_data=inv,
+                                                   evidence_pending=evidence_pending),
+                {"invoice_info": inv}
             )
-        finally:
-            # 5. 任务完成，把这个临时文件删掉，保持服务器干净整洁
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
 
+        # 子线程继承本请求的截止时间
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(invoices))) as ex:
+            items = [f.result() for f in [submit_in_context(ex, _one, inv) for inv in invoices]]
+        result = dict(items[0])
+        result["items"] = items
+        result["invoice_count"] = len(items)
+        result["degraded_stages"] = list(dict.fromkeys(
+            extract_degraded + [st for it in items for st in (it.get("degraded_stages") or [])]))
         return result
 
-    # 兼容旧 UI：吃 bytes 的入口（filename 可选，主要用于判断 pdf/image）
-    def run(self, file_bytes: bytes, filename: str = "upload.bin",
-            user_input: str = "", evidence_data=None) -> dict:
-        suffix = os.path.splitext(filename)[1].lower() or ".bin"
-        file_type = "pdf" if suffix == ".pdf" else "image"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
+    # 同一文件再次上传：内容哈希命中历史索引就直接复用上次的识别结果（不调 OCR）；否则识别后登记
+    def _extract_indexed(self, file_bytes, extract) -> List[Dict[str, Any]]:
+        index = get_index()
+        if index is None:
+            return extract()
+        h = content_key(file_bytes)
+        with span("dedup"):
+            cached = index.lookup_content(h)
+        if cached:
+            for inv in cached:
+                inv["extract_route"] = "content_index"
+            return cached
+        invoices = extract()
+        index.remember_content(h, invoices)
+        return invoices
+
+    # 内存数据直通提取器；老提取器没有 extract_from_bytes 时才落临时文件（用完即删）
+    def _extract_invoice_bytes(self, file_bytes, filename: str = "", file_type: str = "image"):
+        fn = getattr(self.extractor, "extract_from_bytes", None)
+        if fn is not None:
+            return self._extract_indexed(file_bytes, lambda: [fn(file_bytes, filename, file_type=file_type)])[0]
+        suffix = os.path.splitext(filename or "")[1].lower() or ".bin"
+        with span("save_tmp"), tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
             f.write(file_bytes)
             tmp_path = f.name
         try:
-            return self.process_reimbursement(
-                tmp_path, file_type=file_type, user_input=user_input, evidence_data=evidence_data
-            )
+            return self._extract_invoice(tmp_path, file_type=file_type)
         finally:
             try:
                 os.remove(tmp_path)
@@ -760,8 +537,27 @@ class ReimbursementProcessor:
                         pass
         return {"is_valid": False, "verify_message": "未找到可用验真方法（verify_invoice/verify/run）。"}
 
+    def _verify_within_budget(self, invoice_data: Dict[str, Any], record: Optional[InvoiceRecord] = None,
+                              previous: Optional[Dict[str, Any]] = None):
+        """
+        验真带预算：复验（previous 非空）要留够后面 LLM 的时间，否则沿用上一次结果；
+        首次验真预算不足直接返回未验真。
+        """
+        if previous is not None and not has_budget(VERIFY_RECHECK_MIN_S):
+            mark_degraded("verification_recheck")
+            return previous
+        if not has_budget(VERIFY_STAGE_MIN_S):
+            mark_degraded("verification")
+            return {"is_valid": False, "verify_message": "本次请求时间预算已用完，未完成验真。", "degraded": True}
+        with span("verification"):
+            result = self._verify_invoice(invoice_data, record)
+        if isinstance(result, dict) and result.get("degraded"):
+            mark_degraded("verification")
+        return result
+
     # 新版验真路由
-    def _verify_invoice(self, invoice_data: Dict[str, Any]):
+    def _verify_invoice(self, invoice_data: Dict[str, Any], record: Optional[InvoiceRecord] = None):
+        record = record or InvoiceRecord.from_invoice(invoice_data)
         qr_text = invoice_data.get("qr_raw") or invoice_data.get("qr_text") or ""
         ocr_text = " ".join([str(invoice_data.get(k, "")) for k in (
             "raw_text", "remark", "invoice_type", "seller_name", "buyer_name",
@@ -775,50 +571,34 @@ class ReimbursementProcessor:
         service_type = _infer_service_type(invoice_data, goods_names, "", invoice_data.get("remark",""))
         invoice_data["service_type"] = service_type  # 覆盖给 LLM 的上下文
 
-        fpdm = parsed.get("fpdm") or invoice_data.get("invoice_code") or ""
-        fphm = parsed.get("fphm") or invoice_data.get("invoice_number") or ""
-        kprq = parsed.get("kprq") or invoice_data.get("invoice_date") or ""
-        je_excl = invoice_data.get("amount_excl_tax") or invoice_data.get("total_amount") or ""
-        try:
-            je_with = invoice_data.get("amount_in_figures") or (
-                (float(invoice_data.get("total_amount", 0)) + float(invoice_data.get("total_tax", 0)))
-                if invoice_data.get("total_tax") is not None else ""
-            )
-        except (ValueError, TypeError):
-            je_with = ""
-        jym  = parsed.get("jym") or invoice_data.get("check_code") or ""
-
-        def _norm_cn_date(s: str) -> str:
-            s = str(s).strip().replace("年", "-").replace("月", "-").replace("日", "").replace("/", "-")
-            if len(s) == 8 and s.isdigit():
-                return f"{s[:4]}-{s[4:6]}-{s[6:]}"
-            return s
-        if kprq:
-            kprq = _norm_cn_date(kprq)
-
-        if parsed.get("inferred") and jym:
-            invoice_data["check_code"] = jym
+        # 要素来自 record（已规整）；二维码/票面文字里解析到的号码、代码、日期、校验码优先
+        payload = record.verify_payload()
+        for k in ("fpdm", "fphm", "kprq", "jym"):
+            if parsed.get(k):
+                payload[k] = parsed[k]
+
+        if parsed.get("inferred") and payload.get("jym"):
+            record.check_code = payload["jym"]
+            invoice_data["check_code"] = payload["jym"]
             invoice_data["check_code_from"] = "号码后6(数电票兜底)"
 
-        if not fpdm:
+        if not payload.get("fpdm"):
             guess, src = _guess_fpdm_from_text(invoice_data)
             if guess:
-                fpdm = guess
-                invoice_data["invoice_code"] = fpdm
+                payload["fpdm"] = record.code = guess
+                invoice_data["invoice_code"] = guess
                 invoice_data["invoice_code_from"] = f"推断({src})"
 
-        payload = {
-            **({"fpdm": fpdm} if fpdm else {}),
-            **({"fphm": fphm} if fphm else {}),
-            **({"kprq": kprq} if kprq else {}),
-            **({"noTaxAmount": je_excl} if je_excl else {}),
-            **({"jshj": je_with} if je_with else {}),
-            **({"jym": jym} if jym else {}),
-            "total_amount": invoice_data.get("total_amount"),
-            "total_tax": invoice_data.get("total_tax"),
-            "amount_in_figures": invoice_data.get("amount_in_figures"),
-            "amount_excl_tax": invoice_data.get("amount_excl_tax"),
-        }
+        # 本地先校验/修复：号码位数、日期、金额精度与 不含税+税额=价税合计；修不好就不花钱调接口
+        payload, repairs, problems = repair_verify_payload(payload, qr_text=qr_text, ocr_text=ocr_text)
+        if repairs:
+            invoice_data["verify_repairs"] = repairs
+        if problems:
+            UPSTREAM_CALLS.inc(dependency="aliyun_verify", outcome="skipped_invalid")
+            return {"is_valid": False, "skipped": True, "validation_problems": problems,
+                    "verify_message": f"本地校验未通过：{'；'.join(problems)}。未调用验真接口，请上传原始 PDF/OFD 或清晰票面（含二维码）。"}
+        fpdm, fphm, kprq, jym = (payload.get(k) or "" for k in ("fpdm", "fphm", "kprq", "jym"))
+        je_excl, je_with = payload.get("noTaxAmount") or "", payload.get("jshj") or ""
 
         has_min = bool(fphm and kprq and (je_excl or je_with))
         if fpdm and fphm and kprq and (je_excl or je_with) and jym:
@@ -836,11 +616,40 @@ class ReimbursementProcessor:
             return {"is_valid": False, "verify_message": f"验真要素不足：缺少 {','.join(miss)}。请上传原始 PDF/OFD 或清晰票面（含二维码）。"}
         return {"is_valid": False, "verify_message": "验真要素不足。"}
 
+    def _context_pack(self, stage: str, category: str) -> Dict[str, Any]:
+        """知识库上下文包（retriever 加载时按 阶段×类别 预构建，这里只是查表）；老 retriever 没有时整篇拼接"""
+        fn = getattr(self.retriever, "context_pack", None)
+        if fn is not None:
+            return fn(stage, category)
+        docs = getattr(self.retriever, "docs", None) or {}
+        contexts = [{"source": n, "content": docs[n]} for n in PACK_STAGE_DOCS.get(stage, ()) if n in docs]
+        return {"contexts": contexts, "sources": self._cite(contexts),
+                "docs": frozenset(c["source"] for c in contexts),
+                "covered": "\0".join(_norm(c["content"]) for c in contexts)}
+
+    def _cite(self, *seqs) -> List[Dict[str, Any]]:
+        """引用来源解析：用 retriever 加载 KB 时建好的标题/URL 表；老 retriever 没有时只规整成文件名主体"""
+        return (getattr(self.retriever, "citations", None) or _BARE_CITATIONS).resolve(*seqs)
+
+    @staticmethod
+    def _outside_pack(pack: Dict[str, Any], items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        去掉内容已在上下文包里的检索片段（按正文比对，不按文档名：包里每篇只收了与类别相关的部分小节，
+        其余小节的命中仍要保留）
+        """
+        covered = pack.get("covered") or ""
+
+        def inside(h) -> bool:
+            text = _norm(h.get("content")) if isinstance(h, dict) else ""
+            return bool(text) and text in covered
+
+        return [h for h in (items or []) if not inside(h)]
+
     def _fetch_hits(self, invoice_data: Dict[str, Any], user_input: Optional[str] = None, topk: int = 6) -> List[Dict[str, Any]]:
         """兼容不同 retriever API：尽可能把命中取回来，避免 AttributeError。"""
         r = getattr(self, "retriever", None)
         if r is None:
-            print("Retriever 未初始化，返回空命中。")
+            logger.warning("Retriever 未初始化，返回空命中。")
             return []
 
         # 拼一个朴素 query（不依赖外部工具函数，避免再引入未定义名）
@@ -873,7 +682,7 @@ class ReimbursementProcessor:
                     except TypeError:
                         continue
                     except Exception as e:
-                        print(f"retriever.{name} 调用失败：{e}")
+                        logger.warning("retriever.%s 调用失败：%s", name, e)
 
         # 万能兜底：如果 retriever 有 docs 字典，就先返回前 topk 个
         try:
@@ -883,34 +692,70 @@ class ReimbursementProcessor:
         except Exception:
             pass
 
-        print("未匹配到可用的检索方法，返回空命中。")
+        logger.warning("未匹配到可用的检索方法，返回空命中。")
         return []
 
     # ---------------- 主流程：新增 evidence_data 注入 & 风控后处理 ----------------
-    def process_reimbursement(self, file_path: str, file_type: str = "image",
-                              user_input: str = "", evidence_data: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
-        invoice_data = self._extract_invoice(file_path, file_type=file_type)
-        invoice_data = _normalize_amount_fields(invoice_data)
-        print(f"Extracted invoice data: {invoice_data}")
-        
-        # ===== 统一税率：支持 ["tax_rate": [{"row":"1","word":"3%"}]] / "3%" / 0.03 三种形态 =====
-        tr = invoice_data.get("tax_rate")
-        def _to_percent_string(x):
-            if x is None: return ""
-            if isinstance(x, str):
-                return x if "%" in x else (f"{float(x)*100:.0f}%" if x.replace(".","",1).isdigit() else x)
-            if isinstance(x, (int, float)):
-                return f"{x*100:.0f}%"
-            if isinstance(x, list) and x and isinstance(x[0], dict):
-                w = (x[0].get("word") or "").strip()
-                return w if w else ""
-            return ""
-
-        invoice_data["tax_rate"] = _to_percent_string(tr)
+    def process_reimbursement(self, file_path: Optional[str] = None, file_type: str = "image",
+                              user_input: str = "", evidence_data: Optional[List[Dict[str, Any]]] = None,
+                              file_bytes=None, filename: str = "",
+                              invoice_data: Optional[Dict[str, Any]] = None,
+                              deadline_s: Optional[float] = None,
+                              evidence_pending: Optional[PendingEvidence] = None) -> Dict[str, Any]:
+        """
+        全流程带总预算（默认 PIPELINE_DEADLINE_S，外层已有更紧的预算时取更紧的）。
+        剩余预算随 contextvar 传到 OCR / 验真 / LLM；来不及的阶段走兜底，
+        并在结果 degraded_stages 里列出被跳过或截断的阶段。
+        去重索引的登记只在流程完整跑完时保留：出错或有阶段降级就撤销，重试不会被当成重复报销。
+        """
+        t0 = datetime.now()
+        registered: List[tuple] = []
+        completed = False
+        try:
+            with deadline(PIPELINE_DEADLINE_S if deadline_s is None else deadline_s), track_degraded() as degraded, \
+                    span("pipeline"):
+                result = self._process_reimbursement(file_path=file_path, file_type=file_type, user_input=user_input,
+                                                     evidence_data=evidence_data, file_bytes=file_bytes,
+                                                     filename=filename, invoice_data=invoice_data,
+                                                     evidence_pending=evidence_pending, registered=registered)
+            completed = not degraded
+        finally:
+            if registered and not completed:
+                get_index().forget(registered)
+        result["degraded_stages"] = degraded
+        result["elapsed_ms"] = int((datetime.now() - t0).total_seconds() * 1000)
+        return result
+
+    def _process_reimbursement(self, file_path: Optional[str] = None, file_type: str = "image",
+                               user_input: str = "", evidence_data: Optional[List[Dict[str, Any]]] = None,
+                               file_bytes=None, filename: str = "",
+                               invoice_data: Optional[Dict[str, Any]] = None,
+                               evidence_pending: Optional[PendingEvidence] = None,
+                               registered: Optional[List[tuple]] = None) -> Dict[str, Any]:
+        # 已提取好的 invoice_data（批量模式）直接进入后续流程
+        if invoice_data is not None:
+            invoice_data = dict(invoice_data)
+        # file_bytes（bytes/memoryview）优先：上传内容直通 OCR，不再绕一圈临时文件
+        elif file_bytes is not None:
+            with span("extract"):
+                invoice_data = self._extract_invoice_bytes(file_bytes, filename or file_path or "", file_type=file_type)
+        else:
+            with span("extract"):
+                invoice_data = self._extract_invoice(file_path, file_type=file_type)
+        EXTRACT_ROUTES.inc(route=invoice_data.get("extract_route") or
+                           (f"ocr_{invoice_data['ocr_backend']}" if invoice_data.get("ocr_backend") else "ocr"))
+        t_norm = time.perf_counter()
+        # 要素只规整这一次：验真入参、硬规则风控、佐证比对都用 record；invoice_info 里写回规整后的写法
+        record = InvoiceRecord.from_invoice(invoice_data)
+        record.apply_to(invoice_data)
+        log_payload(logger, "Extracted invoice data: %s", invoice_data)
+        STAGE_SECONDS.observe(time.perf_counter() - t_norm, stage="normalization")
         
         # 提取后立刻做一个"可用性"检查
         if invoice_data.get("__ocr_error__"):
             msg = str(invoice_data["__ocr_error__"])
+            if any(k in msg for k in ("DeadlineExceeded", "CircuitOpenError")):
+                mark_degraded("ocr")
             return {
                 # —— 前端可见：把关键诊断字段也透出去 —— #
                 "invoice_info": invoice_data,
@@ -944,33 +789,37 @@ class ReimbursementProcessor:
                 }
             }
         
+        # === 历史去重：号码精确命中（数电票看 20 位号码）/ 销方税号+日期+价税合计 疑似命中 ===
+        index = get_index()
+        if index is not None:
+            with span("dedup"):
+                dup = index.check_and_record(invoice_data, filename or file_path or "", registered)
+            if dup:
+                invoice_data["duplicate_of"] = dup
+
         # === 固定"今天"，供 LLM 使用 ===
         invoice_data["now_date"] = datetime.now().strftime("%Y-%m-%d")
 
         # === 调用retriever获取相关文档 ===
-        hits = self._fetch_hits(invoice_data,user_input=user_input,topk=6)  # 命中里要有 doc/text/score/url
+        with span("retrieval"):
+            hits = self._fetch_hits(invoice_data,user_input=user_input,topk=6)  # 命中里要有 doc/text/score/url
 
         # === 先验真，再做分析（拿到金额+货物/服务名） ===
-        verify_result = self._verify_invoice(invoice_data)
-        print(f"Verification result: {verify_result}")
+        verify_result = self._verify_within_budget(invoice_data, record)
+        log_payload(logger, "Verification result: %s", verify_result)
 
         # 将验真金额写回（只在缺失时补齐）
         vr = (verify_result or {}).get("verify_result", {}) or {}
         vdata = (vr.get("data") or {}) if isinstance(vr, dict) else {}
-        try:
-            if vdata.get("sumamount"):
-                invoice_data.setdefault("amount_in_figures", float(vdata["sumamount"]))
-            if vdata.get("goodsamount"):
-                invoice_data.setdefault("total_amount", float(vdata["goodsamount"]))
-            if vdata.get("taxamount"):
-                invoice_data.setdefault("total_tax", float(vdata["taxamount"]))
-        except Exception:
-            pass
+        # 明细以验真返回为准；验真跳过/失败时用票据自带的（数电 XML 直接带 goodsData）
+        goods_data = vdata.get("goodsData") or invoice_data.get("goodsData") or []
+        record.fill_from_verify(vdata)
+        record.apply_to(invoice_data)
 
         # 收集关键字用于"差旅"纠偏（发票、验真、用户输入都算上）
         goods_names = []
         try:
-            for g in (vdata.get("goodsData") or []):
+            for g in goods_data:
                 nm = (g.get("name") or "").strip()
                 if nm:
                     goods_names.append(nm)
@@ -1010,8 +859,7 @@ class ReimbursementProcessor:
         # ===== 通用 flags（可选但实用）=====
         signals = []
         # goodsData.name
-        vr_data = (verify_result.get("verify_result") or {}).get("data", {}) if isinstance(verify_result, dict) else {}
-        for g in vr_data.get("goodsData") or []:
+        for g in goods_data:
             n = (g.get("name") or "").strip()
             if n: signals.append(n)
         signals += [invoice_data.get("service_type_detail",""), invoice_data.get("remark",""), invoice_data.get("seller_name",""), user_input or "", invoice_data.get("filename","")]
@@ -1030,7 +878,8 @@ class ReimbursementProcessor:
                 },
                 user_input=user_input or ""
             ),
-            {"expense_type": "UNKNOWN", "account_subject": "UNKNOWN", "confidence": 0.0}
+            {"expense_type": "UNKNOWN", "account_subject": "UNKNOWN", "confidence": 0.0},
+            stage="llm_decision"
         )
 
         expense_type = llm_decision.get("expense_type") or "UNKNOWN"
@@ -1041,7 +890,7 @@ class ReimbursementProcessor:
 
         if expense_type == "UNKNOWN" or mapped_account == "UNKNOWN" or confidence < 0.75:
             keyword_account = _choose_account_from_keywords(
-                [g.get("name","") for g in (vr_data.get("goodsData") or [])],
+                [g.get("name","") for g in goods_data],
                 user_input,
                 invoice_data.get("remark","")
             )
@@ -1075,7 +924,7 @@ class ReimbursementProcessor:
         if force_travel or (invoice_data.get("service_type") == "交通"):
             expense_type = "差旅费"
             # initial_analysis["expense_type"] = "差旅费"
-        print(f"初步分析费用类型: {expense_type}")
+        logger.debug("初步分析费用类型: %s", expense_type)
 
         # === 新增：做一次 KB 检索，带上 URL，传给三个分析器 ===
         # 1) 组合一个查询串（费用类型 + 用户说明 + 卖方名等关键信息）
@@ -1090,19 +939,20 @@ class ReimbursementProcessor:
 
         hits = []
         try:
-            hits = self.retriever.search_policy_documents(query, top_k=5)
+            with span("retrieval"):
+                hits = self.retriever.search_policy_documents(query, top_k=5)
         except Exception:
             hits = []
 
-        # 2) 把命中转成 sources_used，带 url（如果 retriever 没给 url，会用 PUBLIC_KB_BASE 兜底）
-        sources_used = _hits_to_sources(hits)
-        
+        # 2) 命中即引用来源；各阶段只往里追加原样条目，标题/URL/去重在收尾时按 KB 来源表一次解析
+        sources_used = list(hits)
 
         # 关键词映射兜底
         text_blob = " ".join(str(invoice_data.get(k, "")) for k in [
             "service_type", "remark", "invoice_type", "seller_name", "buyer_name"
         ])
-        kw_candidates = self.retriever.score_accounts(text_blob, top_k=3)
+        with span("retrieval"):
+            kw_candidates = self.retriever.score_accounts(text_blob, top_k=3)
 
         # ★ 统一变量名：只用 mapped_account
         kw_direct = _choose_account_from_keywords(
@@ -1117,18 +967,9 @@ class ReimbursementProcessor:
             mapped_account = kw_candidates[0].get("account", "")
 
         # 会计科目
-        print("开始进行会计科目匹配分析...")
-        acc_pkg = self.retriever.get_accounting_rules(expense_type)
-        acc_contexts: List[Dict[str, str]] = []
-        for name in ("会计科目口径手册_rag版.md", "accounting_rules.txt", "公司报销规则.txt", "公司报销制度.md"):
-            try:
-                if hasattr(self.retriever, "docs") and name in self.retriever.docs:
-                    acc_contexts.append({"source": name, "content": self.retriever.docs[name]})
-            except Exception:
-                pass
-        for t in acc_pkg.get("texts", []):
-            if isinstance(t, str) and t.strip():
-                acc_contexts.append({"source": "知识库片段", "content": t})
+        logger.debug("开始进行会计科目匹配分析...")
+        acc_pack = self._context_pack("accounting", expense_type)
+        acc_extra: List[Dict[str, Any]] = []
 
         # 添加更精准的检索关键词提示
         qhint_terms = []
@@ -1141,26 +982,28 @@ class ReimbursementProcessor:
         query_hint = " ".join(qhint_terms)
         # 使用增强的查询提示检索更多相关上下文
         try:
-            acc_contexts += self.retriever.search_policy_documents(query_hint, top_k=8)
+            with span("retrieval"):
+                acc_extra += self._outside_pack(acc_pack, self.retriever.search_policy_documents(query_hint, top_k=8))
         except Exception:
             pass
+        acc_contexts = acc_pack["contexts"] + acc_extra
 
-        # 1) 先把 context 名字并进来
-        sources_used = _merge_sources(sources_used, _sources_from_contexts(acc_contexts))
+        # 1) 先把 context 名字并进来（包内来源已预先规范化）
+        sources_used = sources_used + acc_pack["sources"] + acc_extra
 
         # ===== 会计科目详细分析（LLM 版），把知识库片段塞进去提升说理性 =====
         accounting_analysis = self._safe_call(
             lambda: self.analyzer.analyze_accounting_subjects(
-                invoice_data, expense_type=expense_type, contexts=(acc_contexts + hits)
+                invoice_data, expense_type=expense_type, contexts=(acc_contexts + self._outside_pack(acc_pack, hits))
             ),
-            {"account_subject": "UNKNOWN", "basis": "", "suggestions": [], "sources_used": []}
+            {"account_subject": "UNKNOWN", "basis": "", "suggestions": [], "sources_used": []},
+            stage="accounting_analysis", min_budget=LLM_STAGE_MIN_S
         )
         accounting_analysis = _clean_obj(accounting_analysis)
 
-        # 2) 再把模块自己的 sources 并进来（得到对象数组，已去重）
-        accounting_analysis["sources_used"] = _merge_sources(
-            accounting_analysis.get("sources_used"), sources_used
-        )
+        # 2) 再把模块自己的 sources 并进来
+        _ensure_list_field(accounting_analysis, "sources_used")
+        accounting_analysis["sources_used"] += sources_used
         # ===== 把最终"科目"回填，如果 LLM detailed 返回为空就用前面的 subject =====
         final_account_subject = accounting_analysis.get("account_subject") or mapped_account or "UNKNOWN"
         
@@ -1198,11 +1041,7 @@ class ReimbursementProcessor:
             accounting_analysis["account_subject"] = _normalize_subject(accounting_analysis["account_subject"])
             _ensure_list_field(accounting_analysis, "basis")
             accounting_analysis["basis"].append("命中差旅关键词，按口径归集为差旅费。")
-            # 引用来源用合并，确保是统一结构
-            accounting_analysis["sources_used"] = _merge_sources(
-                accounting_analysis.get("sources_used"),
-                ["发票关键词-会计科目map表.txt"]
-            )
+            accounting_analysis["sources_used"].append("发票关键词-会计科目map表.txt")
 
         # —— 打车/市内交通 → 强制归并到差旅费 —— 
         subject_hint_blob = " ".join([
@@ -1218,10 +1057,7 @@ class ReimbursementProcessor:
             accounting_analysis["account_subject"] = _normalize_subject(accounting_analysis["account_subject"])
             _ensure_list_field(accounting_analysis, "basis")
             accounting_analysis["basis"].append("命中交通/差旅关键词，强制归并到差旅费。")
-            accounting_analysis["sources_used"] = _merge_sources(
-                accounting_analysis.get("sources_used"),
-                ["发票关键词-会计科目map表.txt"]
-            )
+            accounting_analysis["sources_used"].append("发票关键词-会计科目map表.txt")
 
         ai_subj = (accounting_analysis.get("account_subject") or "")
         accounting_analysis["account_subject"] = _normalize_subject(ai_subj)
@@ -1237,40 +1073,30 @@ class ReimbursementProcessor:
             accounting_analysis["basis"].append("根据住宿/差旅强信号，将误判的'办公费'纠偏为'6603-差旅费'。")
 
         # 风险点
-        print("开始进行发票风险点分析...")
-        ver_contexts: List[Dict[str, str]] = []
-        for name in ("发票验真要点_rag版.md", "verification_points.txt"):
-            try:
-                if hasattr(self.retriever, "docs") and name in self.retriever.docs:
-                    ver_contexts.append({"source": name, "content": self.retriever.docs[name]})
-            except Exception:
-                pass
-        if getattr(self.retriever, "verification_window_days", None):
-            ver_contexts.append({
-                "source": "结构化规则-验真有效期",
-                "content": f"发票有效期（验真指导）约 {self.retriever.verification_window_days} 天"
-            })
-
+        logger.debug("开始进行发票风险点分析...")
+        ver_pack = self._context_pack("risk", expense_type)     # 验真要点 + 有效期（包内已含）
+        ver_extra: List[Dict[str, Any]] = []
         _now = invoice_data.get("now_date")
         if _now:
-            ver_contexts.append({"source": "系统当前时间", "content": f"今天是 {_now}（调用方提供）。"})
+            ver_extra.append({"source": "系统当前时间", "content": f"今天是 {_now}（调用方提供）。"})
+        ver_contexts = ver_pack["contexts"] + ver_extra
 
         # 1) 先把 context 名字并进来
-        sources_used = _merge_sources(sources_used, _sources_from_contexts(ver_contexts))
+        sources_used = sources_used + ver_pack["sources"] + ver_extra
 
         risk_analysis = self._safe_call(
-            lambda: self.analyzer.generate_risk_analysis(invoice_data, contexts=(ver_contexts + hits), flags=flags),
-            {"risk_points": [], "basis": "", "risk_level": "未知", "sources_used": []}
-        )
-        # 2) 再把模块自己的 sources 并进来（得到对象数组，已去重）
-        risk_analysis["sources_used"] = _merge_sources(
-            risk_analysis.get("sources_used"), sources_used
+            lambda: self.analyzer.generate_risk_analysis(invoice_data, contexts=(ver_contexts + self._outside_pack(ver_pack, hits)), flags=flags),
+            {"risk_points": [], "basis": "", "risk_level": "未知", "sources_used": []},
+            stage="risk_analysis", min_budget=LLM_STAGE_MIN_S
         )
+        # 2) 再把模块自己的 sources 并进来
+        _ensure_list_field(risk_analysis, "sources_used")
+        risk_analysis["sources_used"] += sources_used
         risk_analysis = _clean_obj(risk_analysis)               # ★新增
 
         # —— 新增：basis 为空，用来源兜底 —— #
         if not risk_analysis.get("basis"):
-            seeds = risk_analysis.get("sources_used", [])
+            seeds = self._cite(risk_analysis["sources_used"])
             risk_analysis["basis"] = [
                 (f"命中《{s.get('title','知识库片段')}》相似度 {float(s.get('score',0)):.3f}"
                  if isinstance(s.get('score'), (int,float)) else f"命中《{s.get('title','知识库片段')}》")
@@ -1278,61 +1104,48 @@ class ReimbursementProcessor:
             ]
 
         # —— 硬校验补充 ——（价税合计、缺要素、报销周期）
-        hard_risks = self._hard_risk_checks(invoice_data)
+        hard_risks = self._hard_risk_checks(invoice_data, record)
         for r in hard_risks:
             if r not in risk_analysis.get("risk_points", []):
                 risk_analysis.setdefault("risk_points", []).append(r)
 
-        # —— 佐证对比：从 evidence filename 抽取的日期/金额 与发票对齐 —— 
-        self._evidence_enrich_and_align(invoice_data, risk_analysis)
+        # —— 佐证对比：后台抽取的日期/金额/行程段 与发票对齐（到这里才等佐证结果，不占关键路径） —— 
+        if evidence_pending is not None:
+            with span("evidence_wait"):
+                invoice_data["evidence_list"] = merge_evidence(invoice_data.get("evidence_list") or [],
+                                                               evidence_pending.results())
+        self._evidence_enrich_and_align(invoice_data, risk_analysis, record)
 
         # —— 如果用户已上传相关佐证，移除"请上传行程单/票据"类提示 —— 
         self._dedup_evidence_related_warnings(invoice_data, risk_analysis)
 
-        print(f"Risk analysis result: {risk_analysis}")
+        log_payload(logger, "Risk analysis result: %s", risk_analysis)
 
         # —— 验真（提前）——
-        verify_result = self._verify_invoice(invoice_data)
-        print(f"Verification result: {verify_result}")
+        verify_result = self._verify_within_budget(invoice_data, record, previous=verify_result)
+        log_payload(logger, "Verification result: %s", verify_result)
 
         vr = (verify_result or {}).get("verify_result", {})
         vdata = (vr or {}).get("data", {}) if isinstance(vr, dict) else {}
-
-        try:
-            if vdata.get("sumamount"):
-                invoice_data.setdefault("amount_in_figures", float(vdata["sumamount"]))
-            if vdata.get("goodsamount"):
-                invoice_data.setdefault("total_amount", float(vdata["goodsamount"]))
-            if vdata.get("taxamount"):
-                invoice_data.setdefault("total_tax", float(vdata["taxamount"]))
-            _normalize_amount_fields(invoice_data)
-        except Exception:
-            pass
-
-        # 强制补齐 amount_in_figures（至少有含税总额）
-        excl = _safe_float(invoice_data.get("total_amount"))
-        tax  = _safe_float(invoice_data.get("total_tax"))
-        if not invoice_data.get("amount_in_figures") and (excl or tax):
-            invoice_data["amount_in_figures"] = round((excl or 0) + (tax or 0), 2)
+        record.fill_from_verify(vdata)       # 只补缺失的金额，价税合计随之推出
+        record.apply_to(invoice_data)
 
         # 审批要点
-        print("开始进行报销审核要点分析...")
-        ap_pkg = self.retriever.get_approval_process(invoice_data)
-        ap_contexts: List[Dict[str, str]] = []
-        for name in ("approval_process.txt", "公司报销制度.md"):
-            try:
-                if hasattr(self.retriever, "docs") and name in self.retriever.docs:
-                    ap_contexts.append({"source": name, "content": self.retriever.docs[name]})
-            except Exception:
-                pass
-        ap_contexts.append({"source": "结构化规则-审批阈值", "content": json_dump(ap_pkg)})
+        logger.debug("开始进行报销审核要点分析...")
+        with span("retrieval"):
+            ap_pkg = self.retriever.get_approval_process(invoice_data)
+        ap_pack = self._context_pack("approval", ap_pkg.get("category") or expense_type)
+        if any(c.get("source") == "结构化规则-审批阈值" for c in ap_pack["contexts"]):
+            ap_pkg = {k: v for k, v in ap_pkg.items() if k != "rules"}     # 全部档位已在包里，只补命中档位
+        ap_extra: List[Dict[str, Any]] = [{"source": "结构化规则-审批阈值", "content": json_dump(ap_pkg)}]
 
         _now = invoice_data.get("now_date")
         if _now:
-            ap_contexts.append({"source": "系统当前时间", "content": f"今天是 {_now}（调用方提供）。"})
+            ap_extra.append({"source": "系统当前时间", "content": f"今天是 {_now}（调用方提供）。"})
+        ap_contexts = ap_pack["contexts"] + ap_extra
 
         # 1) 先把 context 名字并进来
-        sources_used = _merge_sources(sources_used, _sources_from_contexts(ap_contexts))
+        sources_used = sources_used + ap_pack["sources"] + ap_extra
 
         # 将flags信息添加到invoice_data中，供审核模块使用
         invoice_data["flags"] = flags
@@ -1361,23 +1174,20 @@ class ReimbursementProcessor:
             lambda: self.analyzer.generate_approval_notes(
                 invoice_data,                   # ← 按现有签名传参
                 expense_type,
-                contexts=(ap_contexts + hits + extra_struct_ctx),
+                contexts=(ap_contexts + self._outside_pack(ap_pack, hits) + extra_struct_ctx),
                 flags=flags
             ),
-            {"approval_notes": [], "basis": "", "suggestions": [], "sources_used": []}
+            {"approval_notes": [], "basis": "", "suggestions": [], "sources_used": []},
+            stage="approval_analysis", min_budget=LLM_STAGE_MIN_S
         ) or {}
 
-        # 2) 再把模块自己的 sources 并进来（得到对象数组，已去重）
-        approval_analysis["sources_used"] = _merge_sources(
-            approval_analysis.get("sources_used"), sources_used
-        )
-        approval_analysis["sources_used"] = _dedup_sources(
-    [ _normalize_source(x) for x in (approval_analysis.get("sources_used") or []) if x ]
-)
+        # 2) 再把模块自己的 sources 并进来
+        _ensure_list_field(approval_analysis, "sources_used")
+        approval_analysis["sources_used"] += sources_used
         approval_analysis = _clean_obj(approval_analysis)       # ★新增
         # —— 新增：basis 为空，用来源兜底 —— #
         if not approval_analysis.get("basis"):
-            seeds = approval_analysis.get("sources_used", [])
+            seeds = self._cite(approval_analysis["sources_used"])
             approval_analysis["basis"] = [
                 (f"命中《{s.get('title','知识库片段')}》相似度 {float(s.get('score',0)):.3f}"
                  if isinstance(s.get('score'), (int,float)) else f"命中《{s.get('title','知识库片段')}》")
@@ -1396,56 +1206,30 @@ class ReimbursementProcessor:
                 approval_analysis["approval_notes"] = [
                     f"【结构化阈值】类别={ap_pkg.get('category')} 金额区间={sel['min']}~{sel.get('max','∞')}元，审批链：{sel['approvers']}"
                 ]
-        print(f"Approval analysis result: {approval_analysis}")
+        log_payload(logger, "Approval analysis result: %s", approval_analysis)
 
         # 验真
-        verify_result = self._verify_invoice(invoice_data)
-        print(f"Verification result: {verify_result}")
+        verify_result = self._verify_within_budget(invoice_data, record, previous=verify_result)
+        log_payload(logger, "Verification result: %s", verify_result)
 
         vr = (verify_result or {}).get("verify_result", {})
         vdata = (vr or {}).get("data", {}) if isinstance(vr, dict) else {}
-        try:
-            if vdata.get("sumamount"):
-                invoice_data.setdefault("amount_in_figures", float(vdata["sumamount"]))
-            if vdata.get("goodsamount"):
-                invoice_data.setdefault("total_amount", float(vdata["goodsamount"]))
-            if vdata.get("taxamount"):
-                invoice_data.setdefault("total_tax", float(vdata["taxamount"]))
-            _normalize_amount_fields(invoice_data)
-        except Exception:
-            pass
-
-        # 强制补齐amount_in_figures
-        excl = _safe_float(invoice_data.get("total_amount"))
-        tax  = _safe_float(invoice_data.get("total_tax"))
-        if not invoice_data.get("amount_in_figures") and (excl or tax):
-            invoice_data["amount_in_figures"] = round(excl + tax, 2)
+        record.fill_from_verify(vdata)
+        record.apply_to(invoice_data)
 
         # —— 字段别名，兼容前端各种取法 —— 
+        t_post = time.perf_counter()
         for blk in (accounting_analysis, risk_analysis, approval_analysis):
             if isinstance(blk, dict):
-                if blk.get("sources_used") and not blk.get("references"):
-                    blk["references"] = blk["sources_used"]     # 引用来源别名
                 if blk is approval_analysis and not blk.get("approval_points"):
                     blk["approval_points"] = blk.get("approval_notes", [])  # 审核注意事项别名
 
-        # **关键：从验真结果拿数据（金额 / 明细）并“只在缺失时补齐”**
+        # **关键：从验真结果拿明细（金额已在上面经 record 补齐）**
         vr    = (verify_result or {}).get("verify_result", {}) or {}
         vdata = (vr.get("data") or {}) if isinstance(vr, dict) else {}
 
-        # 金额三件套补齐
-        try:
-            if vdata.get("sumamount"):
-                invoice_data.setdefault("amount_in_figures", float(vdata["sumamount"]))
-            if vdata.get("goodsamount"):
-                invoice_data.setdefault("total_amount",     float(vdata["goodsamount"]))
-            if vdata.get("taxamount"):
-                invoice_data.setdefault("total_tax",        float(vdata["taxamount"]))
-        except Exception:
-            pass
-
         # **关键：回填明细 & 用明细/备注/用户输入纠偏服务类型**
-        invoice_data["goodsData"] = vdata.get("goodsData") or []
+        invoice_data["goodsData"] = vdata.get("goodsData") or invoice_data.get("goodsData") or []
         goods_names = [g.get("name","") for g in invoice_data["goodsData"]]
         invoice_data["service_type"] = _infer_service_type(
             invoice_data, goods_names, user_input, invoice_data.get("remark","")
@@ -1475,28 +1259,6 @@ class ReimbursementProcessor:
         }
         result["policy_warnings"] = self._collect_policy_warnings(invoice_data, verify_result)
 
-        # 给前端一个纯文本引用来源，防止前端只认识字符串数组
-        def _titles(srcs):
-            out = []
-            for s in (srcs or []):
-                if isinstance(s, dict):
-                    t = s.get("title") or s.get("name") or s.get("source")
-                    if t:
-                        out.append(t)
-                elif isinstance(s, str):
-                    out.append(s)
-            return out
-
-        # 确保三块分析结果都经过同一把清洗
-        result["accounting_analysis"] = _fix_sources_field(result["accounting_analysis"], contexts=hits)
-        result["risk_analysis"] = _fix_sources_field(result["risk_analysis"], contexts=hits)
-        result["approval_analysis"] = _fix_sources_field(result["approval_analysis"], contexts=hits)
-
-        for blk_key in ("accounting_analysis", "risk_analysis", "approval_analysis"):
-            blk = result.get(blk_key) or {}
-            if blk.get("sources_used") and not blk.get("references_text"):
-                blk["references_text"] = _titles(blk["sources_used"])
-
         # 金额别名，避免前端拿错字段
         info = result.get("invoice_info", {})
         if "amount_in_figures" in info and "amount_with_tax" not in info:
@@ -1509,48 +1271,40 @@ class ReimbursementProcessor:
         # 总收尾
         for blk_key in ("accounting_analysis", "risk_analysis", "approval_analysis"):
             blk = result.get(blk_key) or {}
-            # 二次规范来源结构 + 去除将 dict 字面量当标题的脏字符串
-            blk = _fix_sources_field(blk)
+            # 引用来源：一次线性解析（查 KB 来源表得标题/URL、按标题去重、结构化来源与 0 分不显示分数）
+            blk["sources_used"] = self._cite(blk.get("sources_used"), blk.get("sources"))
+            if blk["sources_used"]:
+                if not blk.get("references"):
+                    blk["references"] = blk["sources_used"]     # 引用来源别名
+                if not blk.get("references_text"):              # 纯文本标题，给只认字符串数组的前端
+                    blk["references_text"] = [x["title"] for x in blk["sources_used"]]
             # 文本里的 (total_amount) 等英文字段提示、以及"当前日期为XXXX"统一清理/规范
             blk = _clean_obj(blk)
             result[blk_key] = blk
 
+        STAGE_SECONDS.observe(time.perf_counter() - t_post, stage="post_processing")
         return result
 
     # ---------------- 规则校验 ----------------
-    def _hard_risk_checks(self, invoice_data: Dict[str, Any]) -> List[str]:
+    def _hard_risk_checks(self, invoice_data: Dict[str, Any], record: Optional[InvoiceRecord] = None) -> List[str]:
+        record = record or InvoiceRecord.from_invoice(invoice_data)
         risks: List[str] = []
-        excl = _safe_float(invoice_data.get("total_amount"))
-        tax = _safe_float(invoice_data.get("total_tax"))
-        incl = _safe_float(invoice_data.get("amount_in_figures") or _safe_float(excl + tax))
-        if round(excl + tax, 2) != round(incl, 2):
+        if not record.amounts_consistent():
             risks.append("价税合计与不含税+税额不一致")
 
-        if not invoice_data.get("invoice_number"):
+        if not record.number:
             risks.append("发票号码缺失")
-        if invoice_data.get("invoice_type", "").find("电子") >= 0 and not invoice_data.get("check_code"):
+        dup = invoice_data.get("duplicate_of")
+        if dup:
+            same = "发票号码相同" if dup.get("match") == "exact" else "销方税号、开票日期、价税合计均相同"
+            risks.append(f"疑似重复报销：与 {dup.get('first_seen')} 提交的发票（{dup.get('filename') or '未命名文件'}）{same}")
+        if invoice_data.get("invoice_type", "").find("电子") >= 0 and not record.check_code:
             risks.append("电子发票校验码缺失")
 
-        inv_dt = _parse_date_cn(invoice_data.get("invoice_date"))
+        inv_dt = record.date
         if inv_dt:
-            # 原来：days = (datetime.now() - inv_dt).days
-            # 修改为：优先用 invoice_data['now_date']，没有就不要写"距今/超过XX天"类风险
-            now_dt = None
-            now_raw = invoice_data.get("now_date")
-            if now_raw:
-                try:
-                    if isinstance(now_raw, str):
-                        # 兼容 "2025年08月21日" / "2025-08-21"
-                        s = now_raw.replace("年", "-").replace("月", "-").replace("日", "").replace("/", "-").strip()
-                        if len(s) == 8 and s.isdigit():
-                            s = f"{s[:4]}-{s[4:6]}-{s[6:]}"
-                        from datetime import datetime
-                        now_dt = datetime.fromisoformat(s)
-                    else:
-                        now_dt = now_raw  # 已是 datetime
-                except Exception:
-                    now_dt = None
-
+            # 只用 invoice_data['now_date']（调用方固定的"今天"），没有就不要写"距今/超过XX天"类风险
+            now_dt = calendar_date(invoice_data.get("now_date"))
             if now_dt:
                 days = (now_dt - inv_dt).days
                 max_days = 180
@@ -1568,11 +1322,13 @@ class ReimbursementProcessor:
         return warnings
 
     # ---------------- 佐证比对&清洗 ----------------
-    def _evidence_enrich_and_align(self, invoice_data: Dict[str, Any], risk_analysis: Dict[str, Any]) -> None:
-        """利用 evidence_data 中 filename 解析出的日期/金额，对比发票"""
+    def _evidence_enrich_and_align(self, invoice_data: Dict[str, Any], risk_analysis: Dict[str, Any],
+                                   record: Optional[InvoiceRecord] = None) -> None:
+        """利用佐证抽取出的日期/金额/行程段（evidence_extractor），对比发票"""
         evs: List[Dict[str, Any]] = invoice_data.get("evidence_list") or []
         if not evs:
             return
+        record = record or InvoiceRecord.from_invoice(invoice_data)
         # 汇总证据的日期/金额线索
         ev_dates = []
         ev_amounts = []
@@ -1581,25 +1337,17 @@ class ReimbursementProcessor:
             t = (e.get("type") or "").strip()
             if t:
                 ev_types.add(t)
-            d = e.get("derived_date")
+            d = calendar_date(e.get("derived_date"))
             if d:
-                try:
-                    ev_dates.append(_parse_date_cn(d))
-                except Exception:
-                    pass
-            a = e.get("derived_amount")
+                ev_dates.append(d)
+            a = money(e.get("derived_amount"))
             if a is not None:
-                try:
-                    ev_amounts.append(float(a))
-                except Exception:
-                    pass
+                ev_amounts.append(a)
 
         # 对比日期：任何一个佐证日期与发票开票日相差 > 90 天，提示一次
-        inv_dt = _parse_date_cn(invoice_data.get("invoice_date"))
+        inv_dt = record.date
         if inv_dt and ev_dates:
             for d in ev_dates:
-                if not d:
-                    continue
                 delta = abs((inv_dt - d).days)
                 if delta > 90:
                     msg = f"佐证日期与发票日期相差 {delta} 天（>90 天）"
@@ -1609,13 +1357,21 @@ class ReimbursementProcessor:
                         risk_analysis.setdefault("sources_used", []).extend(["verification_points.txt", "公司报销制度.md"])
                         break
 
+        # 行程段晚于开票日：先开票后乘车，行程单与发票对不上
+        if inv_dt:
+            late = sorted({l["date"] for e in evs for l in (e.get("trip_legs") or [])
+                           if l.get("date") and (calendar_date(l["date"]) or inv_dt) > inv_dt})
+            if late:
+                msg = f"行程单中有 {len(late)} 天的行程晚于发票开票日期（最晚 {late[-1]}）"
+                if msg not in risk_analysis.get("risk_points", []):
+                    risk_analysis.setdefault("risk_points", []).append(msg)
+                    risk_analysis.setdefault("basis", []).append("行程与发票日期一致性核验（内部控制）")
+
         # 对比金额：如有佐证金额线索，且与发票不含税/价税合计明显不一致，提示一次
-        inv_excl = _safe_float(invoice_data.get("total_amount"))
-        inv_incl = _safe_float(invoice_data.get("amount_in_figures"))
-        if ev_amounts and (inv_excl or inv_incl):
-            ref = inv_incl or inv_excl
+        ref = record.incl or record.excl
+        if ev_amounts and ref:
             for a in ev_amounts:
-                if abs(a - ref) >= 0.05:  # 容忍 5 分差
+                if abs(a - ref) >= EVIDENCE_AMOUNT_TOL:  # 容忍 5 分差
                     msg = f"佐证金额线索（{a:.2f}）与发票金额（{ref:.2f}）不一致"
                     if msg not in risk_analysis.get("risk_points", []):
                         risk_analysis.setdefault("risk_points", []).append(msg)
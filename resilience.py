@@ -0,0 +1,258 @@
+# resilience.py — 外部依赖（百度 OCR / 阿里云验真 / LLM）的熔断、截止时间传递与对冲请求
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+from metrics import UPSTREAM_SECONDS, UPSTREAM_CALLS, DEGRADED
+import profiler
+
+logger = logging.getLogger("resilience")
+
+CB_FAILURES = int(os.getenv("CB_FAILURES", "5"))             # 连续失败多少次打开熔断
+CB_OPEN_SECONDS = float(os.getenv("CB_OPEN_SECONDS", "30"))  # 打开多久后进入半开探测
+CB_HALF_OPEN_PROBES = int(os.getenv("CB_HALF_OPEN_PROBES", "1"))
+HEDGE_DEPS = {x.strip() for x in os.getenv("HEDGE_DEPS", "").split(",") if x.strip()}  # 开启对冲的依赖名
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))
+HEDGE_MIN_SAMPLES = 20
+MIN_CALL_TIMEOUT = 0.5   # 剩余预算不足它就不再发起调用
+LLM_STAGE_MIN_S = float(os.getenv("LLM_STAGE_MIN_S", "3"))   # 剩余预算低于它就不再发起 LLM 分析/调用（processor 与 analyzer 共用）
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断打开：直接失败，交给调用方既有的兜底（_safe_call 等）"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """本次请求的时间预算已用完"""
+
+
+# —— 截止时间：从入口请求一路传到每个外部调用 —— #
+_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """在 with 块内设置截止时间（只会收紧，不会放宽外层预算）"""
+    if not seconds or seconds <= 0:
+        yield
+        return
+    new = time.monotonic() + seconds
+    cur = _deadline.get()
+    token = _deadline.set(new if cur is None else min(cur, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """剩余秒数；没设截止时间返回 None"""
+    d = _deadline.get()
+    return None if d is None else d - time.monotonic()
+
+
+def call_timeout(default: float) -> float:
+    """本次调用可用的超时 = min(默认超时, 剩余预算)；预算耗尽直接抛 DeadlineExceeded"""
+    left = remaining()
+    if left is None:
+        return default
+    if left < MIN_CALL_TIMEOUT:
+        raise DeadlineExceeded(f"request budget exhausted ({left:.2f}s left)")
+    return min(default, left)
+
+
+def has_budget(seconds: float) -> bool:
+    """剩余预算是否还够 seconds（没设截止时间视为够）"""
+    left = remaining()
+    return left is None or left >= seconds
+
+
+# —— 降级记录：哪些阶段因预算/熔断被跳过或截断 —— #
+_degraded: contextvars.ContextVar = contextvars.ContextVar("degraded_stages", default=None)
+
+
+@contextmanager
+def track_degraded():
+    """with 块内 mark_degraded 记到同一个列表里（子线程经 submit_in_context 继承）"""
+    stages = []
+    token = _degraded.set(stages)
+    try:
+        yield stages
+    finally:
+        _degraded.reset(token)
+
+
+def mark_degraded(stage: str):
+    stages = _degraded.get()
+    if stages is not None and stage not in stages:
+        stages.append(stage)
+        DEGRADED.inc(stage=stage)
+        if logger.isEnabledFor(logging.INFO):
+            left = remaining()
+            logger.info("[DEADLINE] 阶段降级：%s（剩余预算 %s）", stage, "-" if left is None else f"{left:.2f}s")
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """线程池不会继承 contextvars：在调用线程里复制上下文（含截止时间、profile 会话）再提交"""
+    return executor.submit(contextvars.copy_context().run, profiler.run_in_scope, fn, *args, **kwargs)
+
+
+# —— 熔断器 —— #
+class CircuitBreaker:
+    """
+    closed：正常放行，连续失败 ≥ failures 次 → open
+    open：直接抛 CircuitOpenError，open_seconds 后 → half_open
+    half_open：只放行 probes 个探测请求，成功 → closed，失败 → 再次 open
+    同时记录成功调用的延迟，给对冲请求算 p95。
+    """
+    def __init__(self, name: str, failures: int = CB_FAILURES, open_seconds: float = CB_OPEN_SECONDS,
+                 probes: int = CB_HALF_OPEN_PROBES):
+        self.name = name
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = "closed"
+        self.fail_count = 0
+        self.opened_at = 0.0
+        self.inflight_probes = 0
+        self.latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """放行返回 True（是否为半开探测）；不放行抛 CircuitOpenError"""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    raise CircuitOpenError(f"{self.name} circuit open")
+                self.state, self.inflight_probes = "half_open", 0
+            if self.state == "half_open":
+                if self.inflight_probes >= self.probes:
+                    raise CircuitOpenError(f"{self.name} circuit half-open, probe in flight")
+                self.inflight_probes += 1
+                return True
+            return False
+
+    def on_success(self, latency: float, probe: bool = False):
+        with self._lock:
+            self.latencies.append(latency)
+            self.fail_count = 0
+            if probe or self.state == "half_open":
+                self.state = "closed"
+                self.inflight_probes = 0
+                logger.info("[CB] %s 探测成功，熔断关闭", self.name)
+
+    def on_failure(self, probe: bool = False):
+        with self._lock:
+            self.fail_count += 1
+            if probe or self.state == "half_open" or (self.state == "closed" and self.fail_count >= self.failures):
+                if self.state != "open":
+                    logger.warning("[CB] %s 熔断打开（连续失败 %d 次），%.0fs 后探测",
+                                   self.name, self.fail_count, self.open_seconds)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.inflight_probes = 0
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            xs = sorted(self.latencies)
+        return xs[min(len(xs) - 1, int(len(xs) * 0.95))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"state": self.state, "fail_count": self.fail_count, "p95": self.p95()}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name: str) -> CircuitBreaker:
+    br = _breakers.get(name)
+    if br is None:
+        with _breakers_lock:
+            br = _breakers.setdefault(name, CircuitBreaker(name))
+    return br
+
+
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_hedge_lock = threading.Lock()
+
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_lock:
+            if _hedge_pool is None:
+                _hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_WORKERS", "8")),
+                                                 thread_name_prefix="hedge")
+    return _hedge_pool
+
+
+def _hedged(fn: Callable[[float], Any], timeout: float, delay: float):
+    """
+    先发一个；delay 秒还没回来再发一个，谁先成功用谁（慢的那个结果丢弃）。
+    两次都经 submit_in_context 提交：截止时间、降级记录、profile 会话跟到对冲线程里。
+    """
+    pool = _get_hedge_pool()
+    futs = [submit_in_context(pool, fn, timeout)]
+    done, _ = wait(futs, timeout=delay)
+    if not done and (remaining() is None or remaining() > delay + MIN_CALL_TIMEOUT):
+        futs.append(submit_in_context(pool, fn, max(MIN_CALL_TIMEOUT, timeout - delay)))
+    err = None
+    pending = set(futs)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                return f.result()
+            err = f.exception()
+    raise err
+
+
+def guarded_call(name: str, fn: Callable[[float], Any], timeout: float,
+                 is_failure: Callable[[Any], bool] = None, hedge: bool = None):
+    """
+    用熔断 + 截止时间 + （可选）对冲包一次外部调用。
+    fn(timeout) 必须按传入的超时发请求；is_failure(result) 判定"返回了但算依赖故障"（如 5xx）。
+    hedge 缺省看 HEDGE_DEPS 是否包含 name；只对幂等、可并发重放的调用开启。
+    """
+    br = get_breaker(name)
+    try:
+        probe = br.before_call()
+    except CircuitOpenError:
+        UPSTREAM_CALLS.inc(dependency=name, outcome="circuit_open")
+        raise
+    try:
+        t = call_timeout(timeout)
+    except DeadlineExceeded:
+        UPSTREAM_CALLS.inc(dependency=name, outcome="deadline")
+        if probe:
+            with br._lock:
+                br.inflight_probes = max(0, br.inflight_probes - 1)
+        raise
+    hedge = (name in HEDGE_DEPS) if hedge is None else hedge
+    delay = br.p95() if hedge and not probe else None
+
+    t0 = time.monotonic()
+    try:
+        with profiler.upstream(name):
+            result = _hedged(fn, t, max(delay, HEDGE_MIN_DELAY)) if delay else fn(t)
+    except Exception:
+        br.on_failure(probe)
+        UPSTREAM_CALLS.inc(dependency=name, outcome="exception")
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(time.monotonic() - t0, dependency=name)
+    if is_failure is not None and is_failure(result):
+        br.on_failure(probe)
+        UPSTREAM_CALLS.inc(dependency=name, outcome="failure")
+    else:
+        br.on_success(time.monotonic() - t0, probe)
+        UPSTREAM_CALLS.inc(dependency=name, outcome="ok")
+    return result
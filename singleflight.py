@@ -0,0 +1,86 @@
+# singleflight.py — 同 key 的并发外部调用只真正发一次，其余等待并共享结果（不做结果缓存）
+# -*- coding: utf-8 -*-
+import copy
+import json
+import hashlib
+import threading
+from typing import Any, Callable, Dict
+
+from resilience import remaining, DeadlineExceeded
+from metrics import COALESCED
+
+
+def content_key(*parts: Any) -> str:
+    """bytes / memoryview 直接喂哈希（不复制）；其余 JSON 规范化后再哈希"""
+    h = hashlib.sha256()
+    for p in parts:
+        if isinstance(p, (bytes, bytearray, memoryview)):
+            h.update(p)
+        else:
+            h.update(json.dumps(p, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+class _Call:
+    __slots__ = ("done", "result", "shared", "exc", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.shared = self.exc = None
+        self.waiters = 0
+
+
+class Group:
+    """
+    do(key, fn)：
+    - 没有同 key 的调用在飞 → 本线程执行 fn（leader），拿到原始结果
+    - 已有 → 等 leader 结束，拿结果的深拷贝（各自可随意修改）；leader 抛异常则同样抛出
+    等待受请求截止时间约束，超时抛 DeadlineExceeded（不影响 leader）。
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            return self._wait(call)
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.exc = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]     # 之后到的同 key 调用重新发起，不会读到这次的结果
+                waiters = call.waiters
+            if waiters and call.exc is None:
+                call.shared = copy.deepcopy(call.result)   # 在 leader 改动结果之前拍快照
+            call.done.set()
+
+    def _wait(self, call: _Call) -> Any:
+        COALESCED.inc(group=self.name)
+        left = remaining()
+        if not call.done.wait(timeout=None if left is None else max(0.0, left)):
+            raise DeadlineExceeded(f"{self.name}: waiting for in-flight call exceeded request budget")
+        if call.exc is not None:
+            raise call.exc
+        return copy.deepcopy(call.shared)
+
+    def inflight(self) -> int:
+        return len(self._calls)
+
+
+OCR_FLIGHT = Group("ocr")
+VERIFY_FLIGHT = Group("aliyun_verify")
+LLM_FLIGHT = Group("llm")